@@ -14,5 +14,8 @@ setup(
         "Django",
         "suds-jurko >= 0.6",
         "requests",
-    ]
+    ],
+    extras_require={
+        "printing": ["pypdf"],
+    }
 )
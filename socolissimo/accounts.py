@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Named SoColissimo accounts, for projects shipping for several brands."""
+import threading
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from socolissimo.client import DEFAULT_MAX_WORKERS, SoColissimoClient
+from socolissimo.exceptions import UnknownAccount
+
+
+class AccountRegistry(object):
+    """
+    Long-lived clients of named SoColissimo accounts.
+
+    Each account is a dict of the keyword arguments of SoColissimoClient,
+    such as:
+
+        {
+            'brand_a': {'contract_number': '...', 'password': '...'},
+            'brand_b': {'contract_number': '...', 'password': '...',
+                        'engine': 'template'},
+        }
+
+    The clients are created, and their credentials checked, once. They all
+    share the parsed WSDL, the soap client pool and the HTTP connection pool
+    of the process.
+
+    Args:
+        accounts (dict): The accounts, by name.
+
+    Raises:
+        ImproperlyConfigured: An account is invalid.
+    """
+
+    def __init__(self, accounts):
+        self._clients = {}
+        for name, options in accounts.items():
+            try:
+                self._clients[name] = SoColissimoClient(**options)
+            except (TypeError, ValueError) as exc:
+                raise ImproperlyConfigured(
+                    'Invalid SoColissimo account {} : {}'.format(name, exc))
+
+    def __contains__(self, name):
+        return name in self._clients
+
+    def names(self):
+        """Return the names of the accounts, sorted."""
+        return sorted(self._clients)
+
+    def get(self, name):
+        """Return the client of an account.
+
+        Raises:
+            UnknownAccount: No account of this name is configured.
+        """
+        try:
+            return self._clients[name]
+        except KeyError:
+            raise UnknownAccount('No SoColissimo account named {}'.format(
+                name))
+
+    def get_letters(self, letters, max_workers=DEFAULT_MAX_WORKERS):
+        """Generate labels of several accounts concurrently.
+
+        Each letter is issued by the client of its account, on a single
+        bounded pool of worker threads. As with SoColissimoClient.get_letters,
+        a failing letter does not interrupt the rest of the batch.
+
+        Args:
+            letters (iterable of dict): The keyword arguments of get_letter,
+                one dict per label, with the name of the account under the
+                'account' key.
+            max_workers (int, optional): Maximum number of concurrent calls
+                to the webservice, across all the accounts.
+
+        Returns:
+            A list with one outcome per letter, in input order. Each outcome
+            is either a tuple (parcel_number, pdf_url), or the
+            SoColissimoException or SchemaValidationError raised for this
+            letter, an UnknownAccount when its account is not configured.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.get_letter_outcome, letter)
+                       for letter in letters]
+        return [future.result() for future in futures]
+
+    def get_letter_outcome(self, letter):
+        """Route a letter to the client of its account, see
+        SoColissimoClient.get_letter_outcome.
+
+        Args:
+            letter (dict): The keyword arguments of get_letter, with the name
+                of the account under the 'account' key.
+
+        Returns:
+            The outcome of the letter, or an UnknownAccount when its account
+            is not configured.
+        """
+        letter = dict(letter)
+        try:
+            client = self.get(letter.pop('account', None))
+        except UnknownAccount as exc:
+            return exc
+        return client.get_letter_outcome(letter)
+
+
+_REGISTRY = None
+_REGISTRY_SETTINGS = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_account_registry():
+    """Return the registry of the accounts of the SOCOLISSIMO_ACCOUNTS
+    setting, a dict of accounts by name as described in AccountRegistry.
+
+    The registry is created once, and again only if the setting changes.
+
+    Raises:
+        ImproperlyConfigured: An account is invalid.
+    """
+    global _REGISTRY, _REGISTRY_SETTINGS  # pylint: disable=W0603
+    accounts = getattr(settings, 'SOCOLISSIMO_ACCOUNTS', {})
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None or _REGISTRY_SETTINGS != accounts:
+            _REGISTRY = AccountRegistry(accounts)
+            _REGISTRY_SETTINGS = deepcopy(accounts)
+        return _REGISTRY
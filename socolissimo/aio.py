@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""Asyncio client for the web service SoColissimo."""
+import asyncio
+import ssl
+import time
+from functools import partial
+from urllib.parse import urlsplit
+
+from suds import WebFault
+
+from socolissimo import metrics
+from socolissimo.client import (ENGINE_TEMPLATE, SoColissimoClient,
+                                SoColissimoException, classify_fault,
+                                count_call)
+from socolissimo.envelope import SoapFault, parse_letter_response
+from socolissimo.exceptions import (DeadlineExceeded, ServiceTimeout,
+                                    TransientServiceError)
+from socolissimo.resilience import get_deadline
+from socolissimo.routing import get_router
+from socolissimo.schema import SchemaValidationError
+
+
+# Default number of letters in flight for batches of letters.
+DEFAULT_MAX_CONCURRENCY = 100
+# Default timeout of a webservice call, in seconds.
+DEFAULT_TIMEOUT = 30
+
+
+async def http_post(url, body, headers, timeout=DEFAULT_TIMEOUT):
+    """POST a body to an url without blocking the event loop.
+
+    The connection is closed after the exchange.
+
+    Args:
+        url (str): The http or https URL to post to.
+        body (bytes): The request body.
+        headers (dict): Additional request headers.
+        timeout (float, optional): Timeout of the whole exchange, in seconds.
+
+    Returns:
+        A tuple (status, body) of the HTTP response.
+
+    Raises:
+        OSError: The connection failed.
+        asyncio.TimeoutError: The exchange did not complete in time.
+    """
+    return await asyncio.wait_for(_http_post(url, body, headers), timeout)
+
+
+async def _http_post(url, body, headers):
+    parts = urlsplit(url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path = '{}?{}'.format(path, parts.query)
+
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, port, ssl=ssl.create_default_context() if secure
+        else None)
+    try:
+        request_headers = {
+            'Host': parts.netloc,
+            'Content-Length': str(len(body)),
+            'Connection': 'close',
+        }
+        request_headers.update(headers)
+        head = 'POST {} HTTP/1.1\r\n'.format(path)
+        head += ''.join('{}: {}\r\n'.format(name, value)
+                        for name, value in request_headers.items())
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise ConnectionError('Invalid HTTP status line {!r}'.format(
+                status_line))
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            response_body = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            response_body = await reader.readexactly(
+                int(response_headers['content-length']))
+        else:
+            response_body = await reader.read()
+    finally:
+        writer.close()
+    return status, response_body
+
+
+class AsyncSoColissimoClient(SoColissimoClient):
+    """Asyncio entry point for generating SoColissimo letters.
+
+    The letters are validated and marshalled with the same schema than
+    SoColissimoClient, but the HTTP exchange with the webservice does not
+    block the event loop. Like SoColissimoClient, the letters go through the
+    result cache, when the SOCOLISSIMO_RESULT_CACHE setting configures one,
+    and the calls through the retry policy, its circuit breaker and its
+    deadline, and are counted in the metrics.
+
+    Args:
+        contract_number (str or int, optional): Your SoColissimo contract
+            number.
+        password (str, optional): Your SoColissimo password.
+        timeout (float, optional): Timeout of a webservice call, in seconds.
+        engine (str, optional): See SoColissimoClient.
+        use_result_cache (bool, optional): See SoColissimoClient.
+        retry_policy (RetryPolicy, optional): See SoColissimoClient.
+    """
+
+    def __init__(self, contract_number=None, password=None,
+                 timeout=DEFAULT_TIMEOUT, engine=None, use_result_cache=True,
+                 retry_policy=None):
+        super(AsyncSoColissimoClient, self).__init__(
+            contract_number, password, engine=engine,
+            use_result_cache=use_result_cache, retry_policy=retry_policy)
+        self.timeout = timeout
+        self._request_client = None
+
+    @property
+    def request_client(self):
+        """Soap client building the requests without sending them."""
+        if self._request_client is None:
+            # pylint: disable=C0415
+            from socolissimo.client import SOAP_CLIENT
+            self._request_client = SOAP_CLIENT.clone()
+            self._request_client.set_options(nosend=True)
+        return self._request_client
+
+    async def get_letter(self, service_call_context, parcel, recipient,
+                         sender):
+        """Issue a request to the webservice to generate a SoColissimo label.
+
+        See SoColissimoClient.get_letter for the expected arguments, the
+        result cache and the retries.
+
+        Returns:
+            A tuple (parcel_number, pdf_url)
+
+        Raises:
+            SoColissimoException: Something goes wrong with the webservice call.
+                Network and server errors raise a TransientServiceError,
+                timeouts a ServiceTimeout, calls not issued because the
+                service is down a ServiceUnavailable.
+            SchemaValidationError: The labelling data do not validate.
+        """
+        with metrics.time_phase(metrics.PHASE_VALIDATE, self.engine):
+            records = self._validate_letter(service_call_context, parcel,
+                                            recipient, sender)
+        if self.result_cache is None:
+            return await self._issue_async(records)
+        key = self.result_cache.make_key(self.contract_number, records)
+        return await self.result_cache.get_or_call_async(
+            key, lambda: self._issue_async(records))
+
+    async def _issue_async(self, records):
+        """Issue a letter, retrying transient failures, like
+        SoColissimoClient._issue."""
+        async def issue_letter():
+            with count_call():
+                return await self._call_service_async(records)
+
+        return await self.retry_policy.call_async(issue_letter)
+
+    async def _call_service_async(self, records):
+        """Send the letter to the webservice and read its response."""
+        context = None
+        if self.engine == ENGINE_TEMPLATE:
+            # pylint: disable=C0415
+            from socolissimo.client import SOAP_CLIENT
+            template = SOAP_CLIENT.envelope_template
+            envelope = self._marshal_letter(records)
+            location, soap_action = template.location, template.soap_action
+        else:
+            soap_client = self.request_client
+            with metrics.time_phase(metrics.PHASE_BUILD, self.engine):
+                letter = self._build_letter(soap_client, records)
+            method = soap_client.service.getLetterColissimo
+            with metrics.time_phase(metrics.PHASE_MARSHAL, self.engine):
+                context = method(letter)
+            envelope = context.envelope
+            location = method.method.location
+            soap_action = method.method.soap.action
+
+        headers = {
+            'Content-Type': 'text/xml; charset=utf-8',
+            'SOAPAction': soap_action,
+        }
+        await self._wait_rate_limit_async()
+        timeout = self._get_timeout()
+        with get_router().route() as endpoint:
+            try:
+                status, reply = await http_post(
+                    endpoint.url or location, envelope, headers, timeout)
+            except asyncio.TimeoutError as exc:
+                raise ServiceTimeout('SOAP service timed out : {}'.format(
+                    exc or timeout))
+            except (OSError, asyncio.IncompleteReadError) as exc:
+                raise TransientServiceError(
+                    'Cannot reach the SOAP service : {}'.format(exc))
+            with metrics.time_phase(metrics.PHASE_PARSE, self.engine):
+                response = self._process_reply(context, status, reply)
+
+        return self._read_response(response)
+
+    def _get_timeout(self):
+        """Return the timeout of a call, bounded by the deadline of the
+        current task.
+
+        Raises:
+            DeadlineExceeded: The deadline already passed.
+        """
+        at = get_deadline()
+        if at is None:
+            return self.timeout
+        remaining = at - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded('No time left for the call')
+        return min(self.timeout, remaining)
+
+    async def _wait_rate_limit_async(self):
+        """Wait for the rate limiter, if any, to allow a call, without
+        blocking the event loop.
+
+        The token is reserved in the default executor, as the bucket lives in
+        the django cache, then awaited on the event loop. The deadline of the
+        task is passed along, as the executor thread does not see it.
+
+        Raises:
+            RateLimitExceeded: The token would come after max_wait.
+            DeadlineExceeded: The token would come after the deadline.
+        """
+        limiter = self.rate_limiter
+        if limiter is None:
+            return
+        wait = await asyncio.get_running_loop().run_in_executor(
+            None, partial(limiter.reserve, get_deadline(), limiter.max_wait))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    @staticmethod
+    def _process_reply(context, status, reply):
+        """Parse the reply of the webservice, converting the failures to
+        SoColissimoException like SoColissimoClient._call_service.
+
+        Args:
+            context: The suds request context of the call, None for a call
+                built from the envelope template.
+            status (int): The HTTP status of the reply.
+            reply (bytes): The body of the reply.
+
+        Raises:
+            SoColissimoException: The webservice answered with an error.
+            TransientServiceError: The webservice answered with a server
+                error.
+        """
+        if context is None:
+            try:
+                return parse_letter_response(reply)
+            except SoapFault as exc:
+                raise classify_fault(status, exc.faultcode)(
+                    'Exception in the SOAP client : {}'.format(exc))
+        try:
+            return context.process_reply(reply, status)
+        except WebFault as exc:
+            raise classify_fault(status, exc.fault.faultcode)(
+                'Exception in the SOAP client : {}'.format(exc))
+        except Exception as exc:  # pylint: disable=W0703
+            # suds reports HTTP errors without a SOAP fault as a bare
+            # Exception((status, reason)).
+            if not exc.args or not isinstance(exc.args[0], tuple):
+                raise
+            raise classify_fault(status, None)(
+                'Error {} from the SOAP service : {}'.format(*exc.args[0]))
+
+    async def get_letters(self, letters,
+                          max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """Generate several SoColissimo labels concurrently.
+
+        Args:
+            letters (iterable of dict): The keyword arguments of get_letter,
+                one dict per label.
+            max_concurrency (int, optional): Maximum number of letters in
+                flight at once.
+
+        Returns:
+            A list with one outcome per letter, in input order. Each outcome
+            is either a tuple (parcel_number, pdf_url), or the
+            SoColissimoException or SchemaValidationError raised for this
+            letter.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def get_letter_outcome(letter):
+            async with semaphore:
+                try:
+                    return await self.get_letter(**letter)
+                except (SoColissimoException, SchemaValidationError) as exc:
+                    return exc
+
+        tasks = [asyncio.ensure_future(get_letter_outcome(letter))
+                 for letter in letters]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""Django application of the SoColissimo client."""
+import logging
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class SocolissimoConfig(AppConfig):
+    """
+    Configuration of the socolissimo application.
+
+    When the SOCOLISSIMO_WARM_UP setting is True, the WSDL is loaded and the
+    schemas compiled as soon as django is set up, see client.warm_up. A
+    failure to load the WSDL does not prevent the server from starting: it
+    is logged, and the WSDL is loaded again on the first call.
+    """
+
+    name = 'socolissimo'
+    verbose_name = 'SoColissimo'
+
+    def ready(self):
+        if not getattr(settings, 'SOCOLISSIMO_WARM_UP', False):
+            return
+        from socolissimo.client import warm_up  # pylint: disable=C0415
+        try:
+            warm_up()
+        except Exception:  # pylint: disable=W0703
+            logger.exception('Cannot warm the SoColissimo client up')
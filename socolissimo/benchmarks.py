@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the SoColissimo client, against a local stand-in of the
+webservice.
+
+Run them with :
+
+    $ python -m socolissimo.benchmarks --output results.json
+    $ python -m socolissimo.benchmarks --compare results.json
+
+The results are saved as JSON, so runs can be compared across versions.
+Durations are in seconds, throughputs in letters per second.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import django
+from django.conf import settings
+from suds.cache import ObjectCache
+from suds.client import Client
+
+from socolissimo import client as client_module
+from socolissimo.resilience import RetryPolicy
+from socolissimo.schema import (ServiceCallContext, Parcel, ParcelRecipient,
+                                ParcelSender, RecipientAddress, Address)
+from socolissimo.testing import FakeLetterService
+from socolissimo.transport import RequestsTransport, TimingPlugin
+
+
+# Version of the results format.
+RESULTS_VERSION = 1
+
+DEFAULT_CALLS = 50
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_CONCURRENCY_LEVELS = (1, 5, 10, 20)
+DEFAULT_VALIDATIONS = 2000
+DEFAULT_STARTUPS = 5
+
+BENCHMARK_LETTER = dict(
+    service_call_context={
+        'dateDeposite': datetime.datetime(2016, 3, 1, 10, 30),
+        'commercialName': 'Chuck Norris',
+        'commandNumber': 'CMD-42',
+    },
+    parcel={
+        'weight': '10.20',
+        'insuranceValue': 5000,
+        'Instructions': 'Fragile',
+    },
+    recipient={
+        'addressVO': {
+            'Name': 'Norris',
+            'Surname': 'Chuck',
+            'email': 'chuck.norris@awesome.com',
+            'line2': '1 round-kick street',
+            'countryCode': 'FR',
+            'postalCode': '01000',
+            'city': 'Bourg-en-Bresse',
+            'phone': '0102030405',
+        }
+    },
+    sender={
+        'addressVO': {
+            'companyName': 'Awesome Inc',
+            'line2': '1 round-kick street',
+            'countryCode': 'FR',
+            'postalCode': '01000',
+            'city': 'Bourg-en-Bresse',
+        }
+    })
+
+# Schema classes validated by the validation benchmark, with their data.
+VALIDATED_SCHEMAS = (
+    (ServiceCallContext, BENCHMARK_LETTER['service_call_context']),
+    (Parcel, BENCHMARK_LETTER['parcel']),
+    (RecipientAddress, BENCHMARK_LETTER['recipient']['addressVO']),
+    (Address, BENCHMARK_LETTER['sender']['addressVO']),
+    (ParcelRecipient, BENCHMARK_LETTER['recipient']),
+    (ParcelSender, BENCHMARK_LETTER['sender']),
+)
+
+
+def summarize(durations):
+    """Return the statistics of a list of durations."""
+    durations = sorted(durations)
+    return {
+        'count': len(durations),
+        'min': durations[0],
+        'mean': statistics.mean(durations),
+        'median': statistics.median(durations),
+        'p95': durations[min(int(len(durations) * 0.95),
+                             len(durations) - 1)],
+        'max': durations[-1],
+    }
+
+
+def make_client(engine):
+    """Return a client making a single attempt per call, without caches."""
+    return client_module.SoColissimoClient(
+        contract_number='123', password='password', engine=engine,
+        use_result_cache=False, retry_policy=RetryPolicy(max_attempts=1))
+
+
+def bench_startup(service, number=DEFAULT_STARTUPS):
+    """Time the creation of a soap client, parsing the WSDL.
+
+    Returns:
+        The statistics of a cold start, downloading and parsing the WSDL,
+        and of a start from the persistent WSDL cache.
+    """
+    cold = []
+    for _ in range(number):
+        start = time.perf_counter()
+        Client(service.wsdl_url, cache=None, transport=RequestsTransport())
+        cold.append(time.perf_counter() - start)
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        Client(service.wsdl_url, cache=ObjectCache(cache_dir),
+               cachingpolicy=1, transport=RequestsTransport())
+        cached = []
+        for _ in range(number):
+            start = time.perf_counter()
+            Client(service.wsdl_url, cache=ObjectCache(cache_dir),
+                   cachingpolicy=1, transport=RequestsTransport())
+            cached.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(cache_dir)
+    return {'cold': summarize(cold), 'cached': summarize(cached)}
+
+
+def bench_validation(number=DEFAULT_VALIDATIONS):
+    """Time the validation of each schema class, without any call.
+
+    Returns:
+        For each schema class, the mean duration of a validation through the
+        compiled schema and through the django form.
+    """
+    results = {}
+    for schema_class, data in VALIDATED_SCHEMAS:
+        compiled = schema_class.compiled()
+        start = time.perf_counter()
+        for _ in range(number):
+            compiled.validate(data)
+        compiled_duration = (time.perf_counter() - start) / number
+
+        start = time.perf_counter()
+        for _ in range(number):
+            schema_class(data).validated_data()
+        form_duration = (time.perf_counter() - start) / number
+
+        results[schema_class.__name__] = {
+            'compiled': compiled_duration,
+            'form': form_duration,
+        }
+    return results
+
+
+def bench_single_call(engine, number=DEFAULT_CALLS):
+    """Time the calls to get_letter, one at a time.
+
+    Returns:
+        The statistics of the call durations, and the number of errors.
+    """
+    client = make_client(engine)
+    durations = []
+    errors = 0
+    for _ in range(number):
+        start = time.perf_counter()
+        try:
+            client.get_letter(**BENCHMARK_LETTER)
+        except client_module.SoColissimoException:
+            errors += 1
+        durations.append(time.perf_counter() - start)
+    result = summarize(durations)
+    result['errors'] = errors
+    return result
+
+
+def bench_batch(engine, size=DEFAULT_BATCH_SIZE,
+                concurrency_levels=DEFAULT_CONCURRENCY_LEVELS):
+    """Time batches of letters through get_letters.
+
+    Returns:
+        For each concurrency level, the batch duration, the throughput and
+        the number of errors.
+    """
+    client = make_client(engine)
+    letters = [BENCHMARK_LETTER] * size
+    results = {}
+    for max_workers in concurrency_levels:
+        start = time.perf_counter()
+        outcomes = client.get_letters(letters, max_workers=max_workers)
+        duration = time.perf_counter() - start
+        results[str(max_workers)] = {
+            'duration': duration,
+            'throughput': size / duration,
+            'errors': sum(1 for outcome in outcomes
+                          if isinstance(outcome, Exception)),
+        }
+    return results
+
+
+def run(latency=0, error_rate=0, fault_rate=0, calls=DEFAULT_CALLS,
+        batch_size=DEFAULT_BATCH_SIZE,
+        concurrency_levels=DEFAULT_CONCURRENCY_LEVELS,
+        validations=DEFAULT_VALIDATIONS, startups=DEFAULT_STARTUPS,
+        seed=0):
+    """Run every benchmark against a local stand-in of the webservice.
+
+    Args:
+        latency (float, optional): Seconds the stand-in waits before
+            answering each call.
+        error_rate (float, optional): Share of the calls answered with an
+            errorID.
+        fault_rate (float, optional): Share of the calls answered with a
+            server fault.
+        calls (int, optional): Number of calls of the single call benchmark.
+        batch_size (int, optional): Number of letters of each batch.
+        concurrency_levels (tuple, optional): Concurrency levels of the batch
+            benchmark.
+        validations (int, optional): Number of validations of each schema.
+        startups (int, optional): Number of soap clients created.
+        seed (optional): Seed of the errors drawn by the stand-in.
+
+    Returns:
+        The results, as a JSON serializable dict.
+    """
+    import suds  # pylint: disable=C0415
+
+    results = {
+        'version': RESULTS_VERSION,
+        'environment': {
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'django': django.get_version(),
+            'suds': suds.__version__,
+        },
+        'parameters': {
+            'latency': latency,
+            'error_rate': error_rate,
+            'fault_rate': fault_rate,
+            'calls': calls,
+            'batch_size': batch_size,
+            'concurrency_levels': list(concurrency_levels),
+            'validations': validations,
+            'startups': startups,
+        },
+    }
+
+    pool = client_module.SOAP_CLIENT
+    master = pool.client
+    with FakeLetterService(latency=latency, error_rate=error_rate,
+                           fault_rate=fault_rate, seed=seed) as service:
+        results['startup'] = bench_startup(service, startups)
+        results['validation'] = bench_validation(validations)
+        try:
+            pool.client = Client(service.wsdl_url,
+                                 transport=RequestsTransport(),
+                                 plugins=[TimingPlugin()])
+            results['single_call'] = {}
+            results['batch'] = {}
+            for engine in client_module.ENGINES:
+                results['single_call'][engine] = bench_single_call(engine,
+                                                                   calls)
+                results['batch'][engine] = bench_batch(engine, batch_size,
+                                                       concurrency_levels)
+        finally:
+            pool.client = master
+    return results
+
+
+def _flatten(results, prefix=''):
+    """Return the numeric results, by dotted path."""
+    values = {}
+    for key, value in results.items():
+        path = '{}{}'.format(prefix, key)
+        if isinstance(value, dict):
+            values.update(_flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def compare(previous, current):
+    """Compare two benchmark results.
+
+    Returns:
+        A list of (path, previous value, current value, ratio) tuples, for
+        the measures found in both results.
+    """
+    previous_values = _flatten(previous)
+    current_values = _flatten(current)
+    comparison = []
+    for path in sorted(current_values):
+        if path not in previous_values or path.startswith('parameters.') \
+                or path == 'version':
+            continue
+        before = previous_values[path]
+        after = current_values[path]
+        ratio = after / before if before else None
+        comparison.append((path, before, after, ratio))
+    return comparison
+
+
+def _configure_django():
+    """Configure django with minimal settings, unless a project is set."""
+    if not settings.configured \
+            and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+        settings.configure(INSTALLED_APPS=['socolissimo'])
+    django.setup()
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the SoColissimo client against a local '
+                    'stand-in of the webservice.')
+    parser.add_argument('--output', help='File to save the results into.')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Previous results to compare with.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds the stand-in waits before answering.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Share of calls answered with an errorID.')
+    parser.add_argument('--fault-rate', type=float, default=0,
+                        help='Share of calls answered with a server fault.')
+    parser.add_argument('--calls', type=int, default=DEFAULT_CALLS)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=list(DEFAULT_CONCURRENCY_LEVELS))
+    parser.add_argument('--validations', type=int,
+                        default=DEFAULT_VALIDATIONS)
+    parser.add_argument('--startups', type=int, default=DEFAULT_STARTUPS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    _configure_django()
+    results = run(latency=args.latency, error_rate=args.error_rate,
+                  fault_rate=args.fault_rate, calls=args.calls,
+                  batch_size=args.batch_size,
+                  concurrency_levels=args.concurrency,
+                  validations=args.validations, startups=args.startups,
+                  seed=args.seed)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+        for path, before, after, ratio in compare(previous, results):
+            print('{:<60} {:>12.6g} {:>12.6g} {:>8}'.format(
+                path, before, after,
+                '{:.2f}x'.format(ratio) if ratio is not None else '-'),
+                file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
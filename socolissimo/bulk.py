@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Bulk generation of labels from CSV or JSONL files, as exported by ERPs.
+
+The records are read lazily and issued with a bounded concurrency, so a file
+of any size runs in constant memory. The outcomes are written as they
+complete, and the records which got a label are saved to a checkpoint, so an
+interrupted run can resume without issuing their labels again. The records
+whose call timed out may have got a label too : they are saved as unknown,
+and only issued again when asked to.
+"""
+import csv
+import io
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from socolissimo.client import DEFAULT_MAX_WORKERS
+from socolissimo.exceptions import ServiceTimeout
+
+
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+FORMATS = (FORMAT_CSV, FORMAT_JSONL)
+
+# Keyword arguments of get_letter, the first part of the column paths.
+LETTER_PARTS = ('service_call_context', 'parcel', 'recipient', 'sender')
+# Separator of the parts of the column paths.
+PATH_SEPARATOR = '.'
+
+
+def guess_format(path):
+    """Return the format of a file from its extension, FORMAT_CSV or
+    FORMAT_JSONL.
+
+    Raises:
+        ValueError: The extension is not known.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return FORMAT_CSV
+    if extension in ('.jsonl', '.ndjson'):
+        return FORMAT_JSONL
+    raise ValueError('Unknown format of {}, expected .csv or .jsonl'.format(
+        path))
+
+
+def build_letter(row, mapping=None):
+    """Build the keyword arguments of get_letter from a flat row.
+
+    Each column is named by its path in the letter, such as
+    recipient.addressVO.city, or mapped to it. Empty values are left out, as
+    are the columns without path.
+
+    Args:
+        row (dict): The values of a record, by column.
+        mapping (dict, optional): The paths, by column. Columns missing from
+            the mapping are named by their path.
+
+    Returns:
+        A dict with the service_call_context, parcel, recipient and sender
+        dicts.
+    """
+    letter = dict((part, {}) for part in LETTER_PARTS)
+    for column, value in row.items():
+        if value is None or value == '':
+            continue
+        path = mapping.get(column, column) if mapping else column
+        if not path:
+            continue
+        parts = path.split(PATH_SEPARATOR)
+        if parts[0] not in letter:
+            continue
+        target = letter
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return letter
+
+
+def read_records(source, file_format, mapping=None, id_column=None,
+                 delimiter=','):
+    """Read the letters of a CSV or JSONL file, lazily.
+
+    A JSONL line holds either the keyword arguments of get_letter, or a flat
+    object whose keys are columns, like a CSV row.
+
+    Args:
+        source (file): The file, opened as text.
+        file_format (str): FORMAT_CSV or FORMAT_JSONL.
+        mapping (dict, optional): The paths of the columns, see build_letter.
+        id_column (str, optional): The column identifying the records, such
+            as an order number. Defaults to the position of the records in
+            the file, starting at 1.
+        delimiter (str, optional): The delimiter of the CSV columns.
+
+    Yields:
+        The (record id, letter) tuples, the id being a str.
+
+    Raises:
+        ValueError: A JSONL line is not a JSON object.
+    """
+    if file_format == FORMAT_CSV:
+        rows = csv.DictReader(source, delimiter=delimiter)
+    else:
+        rows = (json.loads(line) for line in source if line.strip())
+
+    for position, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            raise ValueError('Record {} is not an object'.format(position))
+        record_id = str(row[id_column] if id_column else position)
+        if all(isinstance(row.get(part), dict) for part in LETTER_PARTS):
+            letter = dict((part, row[part]) for part in LETTER_PARTS)
+        else:
+            letter = build_letter(row, mapping)
+        yield record_id, letter
+
+
+class Checkpoint(object):
+    """
+    Records which got a label, saved as JSON lines as soon as they do.
+
+    Each line is flushed and synced to the disk before the record is
+    reported, so a crash loses at most the labels being issued. The records
+    whose call timed out are saved as unknown, as the webservice may have
+    issued their label.
+
+    Args:
+        path (str): The checkpoint file, created if missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.unknown = set()
+        if os.path.exists(path):
+            with io.open(path, encoding='utf-8') as checkpoint_file:
+                for line in checkpoint_file:
+                    try:
+                        entry = json.loads(line)
+                        record_id = entry['record']
+                    except (ValueError, KeyError, TypeError):
+                        # Line torn by a crash.
+                        continue
+                    if entry.get('unknown'):
+                        self.unknown.add(record_id)
+                    else:
+                        self.done.add(record_id)
+                        self.unknown.discard(record_id)
+        self._file = io.open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, record_id):
+        return record_id in self.done or record_id in self.unknown
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add(self, record_id, result):
+        """Save a record which got a label."""
+        parcel_number, pdf_url = result
+        self._write({'record': record_id, 'parcel_number': parcel_number,
+                     'pdf_url': pdf_url})
+        self.done.add(record_id)
+        self.unknown.discard(record_id)
+
+    def add_unknown(self, record_id, error):
+        """Save a record whose call timed out, which may have got a label."""
+        self._write({'record': record_id, 'unknown': True,
+                     'error': str(error)})
+        self.unknown.add(record_id)
+
+    def close(self):
+        """Close the checkpoint file."""
+        self._file.close()
+
+
+def format_outcome(record_id, outcome):
+    """Return the outcome of a record, as a JSON serializable dict."""
+    if isinstance(outcome, Exception):
+        return {'record': record_id, 'error': str(outcome),
+                'error_type': outcome.__class__.__name__}
+    parcel_number, pdf_url = outcome
+    return {'record': record_id, 'parcel_number': parcel_number,
+            'pdf_url': pdf_url}
+
+
+def run_bulk(client, records, output, checkpoint=None,
+             max_workers=DEFAULT_MAX_WORKERS, max_pending=None,
+             retry_unknown=False):
+    """Issue the letters of records with a bounded concurrency.
+
+    At most max_pending letters are read ahead of the calls, so the records
+    are consumed as the calls complete. Records found in the checkpoint are
+    skipped; the others are added to it once they got their label, or as
+    unknown when their call timed out.
+
+    Args:
+        client (SoColissimoClient): The client issuing the letters.
+        records (iterable): The (record id, letter) tuples, see read_records.
+        output (file): Where the outcomes are written as JSON lines, in
+            completion order, see format_outcome.
+        checkpoint (Checkpoint, optional): The records which got a label.
+        max_workers (int, optional): Maximum number of concurrent calls to
+            the webservice.
+        max_pending (int, optional): Maximum number of letters submitted and
+            not completed. Defaults to twice max_workers.
+        retry_unknown (bool, optional): Issue again the records saved as
+            unknown, once checked that they got no label.
+
+    Returns:
+        A dict counting the records which got a label ('ok'), failed
+        ('failed'), timed out and may have got a label ('unknown') and were
+        skipped as already done or unknown ('skipped').
+    """
+    if max_pending is None:
+        max_pending = 2 * max_workers
+    counts = {'ok': 0, 'failed': 0, 'unknown': 0, 'skipped': 0}
+
+    def skip(record_id):
+        if checkpoint is None or record_id not in checkpoint:
+            return False
+        return not retry_unknown or record_id in checkpoint.done
+
+    def write(done):
+        for future in done:
+            record_id = pending.pop(future)
+            outcome = future.result()
+            if isinstance(outcome, ServiceTimeout):
+                counts['unknown'] += 1
+                if checkpoint is not None:
+                    checkpoint.add_unknown(record_id, outcome)
+            elif isinstance(outcome, Exception):
+                counts['failed'] += 1
+            else:
+                counts['ok'] += 1
+                if checkpoint is not None:
+                    checkpoint.add(record_id, outcome)
+            output.write(json.dumps(format_outcome(record_id, outcome))
+                         + '\n')
+        output.flush()
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for record_id, letter in records:
+                if skip(record_id):
+                    counts['skipped'] += 1
+                    continue
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    write(done)
+                future = executor.submit(client.get_letter_outcome, letter)
+                pending[future] = record_id
+        except BaseException:
+            # Interrupted, don't issue the letters not started yet.
+            for future in pending:
+                future.cancel()
+            raise
+        finally:
+            # Report the letters issued meanwhile.
+            done, _ = wait(pending)
+            write([future for future in done if not future.cancelled()])
+    return counts
@@ -1,13 +1,32 @@
 # -*- coding: utf-8 -*-
-"""Client for the web service SoColissimo."""
-import requests
+"""Client for the web service SoColissimo.
+
+Importing this module is cheap: suds, requests and the django forms of the
+schemas are imported on first use. See warm_up to load them, parse the WSDL
+and compile the schemas ahead of the first call.
+"""
+import collections
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
+from functools import partial
+from urllib.request import pathname2url
 
 from django.conf import settings
-from suds.client import Client
-from suds import WebFault
+from django.core.exceptions import ImproperlyConfigured
 
-from socolissimo.schema import (ServiceCallContext, ParcelRecipient, Parcel,
-                                ParcelSender)
+from socolissimo import metrics
+from socolissimo.exceptions import (LocalError, SoColissimoException,
+                                    ServiceTimeout, TransientServiceError)
+from socolissimo.idempotency import LetterResultCache, get_result_cache
+from socolissimo.ratelimit import get_rate_limiter
+from socolissimo.resilience import CircuitBreaker, RetryPolicy
+from socolissimo.envelope import (EnvelopeTemplate, SoapFault,
+                                  parse_letter_response)
 
 
 # Service URLs.
@@ -16,41 +35,372 @@ WSDL_URL = '{}{}'.format(BASE_SERVICE_URL, 'WSColiPosteLetterService?wsdl')
 ENDPOINT_URL = '{}{}'.format(BASE_SERVICE_URL, 'WSColiPosteLetterService')
 SUPERVISION_URL = 'http://ws.colissimo.fr/supervisionWSShipping/supervision.jsp'
 
+# Directory of the WSDL snapshot which can be shipped within the package.
+BUNDLED_WSDL_DIR = os.path.join(os.path.dirname(__file__), 'wsdl')
+# Name of the WSDL within a snapshot directory, next to its schemas.
+WSDL_SNAPSHOT_NAME = 'WSColiPosteLetterService.wsdl'
+# Default time to live of the parsed WSDL cache, in seconds.
+DEFAULT_WSDL_CACHE_TTL = 24 * 60 * 60
 
-class SoColissimoException(Exception):
-    """Exception happening in the SoColissimo scope"""
+# Engines building the requests and reading the responses of the webservice.
+ENGINE_SUDS = 'suds'
+ENGINE_TEMPLATE = 'template'
+ENGINES = (ENGINE_SUDS, ENGINE_TEMPLATE)
+
+# How the soap client pool hands out clients.
+POOL_THREAD = 'thread'
+POOL_CHECKOUT = 'checkout'
+# Default maximum number of soap clients checked out at once.
+DEFAULT_POOL_SIZE = 10
+
+# Constants of the Letter instances, as (name, value) pairs.
+LETTER_CONSTANTS = (('coordinate', None),)
+
+# Default number of concurrent webservice calls for batches of letters.
+DEFAULT_MAX_WORKERS = 10
+
+
+# Letter prepared by SoColissimoClient.prepare_letter: its request envelope,
+# as bytes, and its key in the result cache.
+PreparedLetter = collections.namedtuple('PreparedLetter', ['envelope', 'key'])
+
+
+class SoapClientPoolTimeout(LocalError):
+    """No soap client could be checked out of the pool in time."""
     pass
 
 
-class SoapClientConstructor(object):  # pylint: disable=R0903
-    """"Constructor to creat soap client at first call.
+def get_wsdl_snapshot_path():
+    """Return the path of the WSDL snapshot, within the directory given by the
+    SOCOLISSIMO_WSDL_SNAPSHOT_DIR setting, which defaults to the snapshot
+    bundled within the package."""
+    directory = getattr(settings, 'SOCOLISSIMO_WSDL_SNAPSHOT_DIR', None) \
+        or BUNDLED_WSDL_DIR
+    return os.path.join(directory, WSDL_SNAPSHOT_NAME)
+
+
+def get_wsdl_url():
+    """Return the URL of the WSDL to build the soap client from.
+
+    The WSDL snapshot is used when the SOCOLISSIMO_USE_BUNDLED_WSDL setting
+    is set, see get_wsdl_snapshot_path. Otherwise the SOCOLISSIMO_WSDL_URL
+    setting is used, which defaults to the WSDL of the webservice.
 
-    We can't set client as a constant because it prevent server to start without
-    connexion to service.
+    Raises:
+        ImproperlyConfigured: The WSDL snapshot is missing.
+    """
+    if getattr(settings, 'SOCOLISSIMO_USE_BUNDLED_WSDL', False):
+        path = get_wsdl_snapshot_path()
+        if not os.path.exists(path):
+            raise ImproperlyConfigured(
+                'No WSDL snapshot found at {}, run "manage.py '
+                'socolissimo_refresh_wsdl --snapshot" to create it'.format(
+                    path))
+        return 'file:{}'.format(pathname2url(path))
+    return getattr(settings, 'SOCOLISSIMO_WSDL_URL', WSDL_URL)
+
+
+def get_wsdl_cache():
+    """Return the persistent cache of the parsed WSDL.
+
+    The cache location is given by the SOCOLISSIMO_WSDL_CACHE_DIR setting,
+    defaulting to a temporary directory, and its time to live in seconds by
+    the SOCOLISSIMO_WSDL_CACHE_TTL setting (0 means the cache never expires).
+    """
+    location = getattr(settings, 'SOCOLISSIMO_WSDL_CACHE_DIR', None)
+    from suds.cache import ObjectCache  # pylint: disable=C0415
+    ttl = getattr(settings, 'SOCOLISSIMO_WSDL_CACHE_TTL',
+                  DEFAULT_WSDL_CACHE_TTL)
+    return ObjectCache(location, seconds=ttl)
+
+
+def create_soap_client():
+    """Create a soap client, going through the persistent WSDL cache and the
+    keep-alive transport."""
+    # pylint: disable=C0415
+    from suds.client import Client
+    from socolissimo.transport import RequestsTransport, TimingPlugin
+    return Client(get_wsdl_url(), cache=get_wsdl_cache(), cachingpolicy=1,
+                  transport=RequestsTransport(), plugins=[TimingPlugin()])
+
+
+def clone_soap_client(soap_client):
+    """Clone a soap client, sharing its parsed WSDL.
+
+    The clone gets its own copy of the options, so it can be configured and
+    used independently of the original client. Unlike suds' Client.clone,
+    each option is copied separately, as deep-copying the whole set of
+    options recurses infinitely on recent python versions.
+
+    Args:
+        soap_client (suds.client.Client): The client to clone.
+
+    Returns:
+        A new suds.client.Client.
+    """
+    # pylint: disable=C0415
+    from suds.client import Client, ServiceSelector
+    from suds.options import Options
+    from suds.properties import Unskin
+    clone = Client.__new__(Client)
+    clone.options = Options()
+    source = Unskin(soap_client.options)
+    target = Unskin(clone.options)
+    for name in source.definitions:
+        target.set(name, deepcopy(source.get(name)))
+    clone.wsdl = soap_client.wsdl
+    clone.factory = soap_client.factory
+    clone.service = ServiceSelector(clone, soap_client.wsdl.services)
+    clone.sd = soap_client.sd
+    clone.messages = dict(tx=None, rx=None)
+    return clone
+
+
+class SoapClientPool(object):
+    """Pool of soap clients, all cloned from a single parsed WSDL.
+
+    suds clients can't be used from several threads at once, so each call to
+    the webservice goes through its own client. The WSDL is only downloaded
+    and parsed once, at first use, by the master client; the clients handed
+    out are cheap clones sharing it.
+
+    Two modes are available:
+
+    - POOL_THREAD: each thread gets its own client, kept for its lifetime.
+    - POOL_CHECKOUT: clients are checked out of a pool of at most size
+      clients, waiting for timeout seconds (forever if None) when they are
+      all in use.
+
+    We can't create the master client at import because it prevent server to
+    start without connexion to service.
+
+    Args:
+        mode (str, optional): Defaults to the SOCOLISSIMO_POOL_MODE setting,
+            or POOL_THREAD.
+        size (int, optional): Defaults to the SOCOLISSIMO_POOL_SIZE setting,
+            or DEFAULT_POOL_SIZE.
+        timeout (float, optional): Defaults to the SOCOLISSIMO_POOL_TIMEOUT
+            setting, or None.
     """
 
     client = None
+    template = None
+    prototypes = None
+
+    def __init__(self, mode=None, size=None, timeout=None):
+        self._mode = mode
+        self._size = size
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._available = threading.Condition(threading.Lock())
+        self._local = threading.local()
+        self._idle = []
+        self._checked_out = 0
+
+    @property
+    def mode(self):
+        """How the clients are handed out, POOL_THREAD or POOL_CHECKOUT."""
+        if self._mode is not None:
+            return self._mode
+        return getattr(settings, 'SOCOLISSIMO_POOL_MODE', POOL_THREAD)
+
+    @property
+    def size(self):
+        """Maximum number of clients checked out at once."""
+        if self._size is not None:
+            return self._size
+        return getattr(settings, 'SOCOLISSIMO_POOL_SIZE', DEFAULT_POOL_SIZE)
+
+    @property
+    def timeout(self):
+        """Seconds to wait for a client to check out, None to wait forever."""
+        if self._timeout is not None:
+            return self._timeout
+        return getattr(settings, 'SOCOLISSIMO_POOL_TIMEOUT', None)
 
     def instanciate(self):
-        """Instanciate the soap client."""
+        """Instanciate the master soap client, parsing the WSDL."""
         if self.client is None:
-            self.client = Client(WSDL_URL)
+            with self._lock:
+                if self.client is None:
+                    self.client = create_soap_client()
 
     @property
-    def soap_client(self):
-        """Return soap client."""
+    def master(self):
+        """Return the master soap client, holding the parsed WSDL.
+
+        It must not be used to call the webservice.
+        """
         self.instanciate()
         return self.client
 
+    @property
+    def soap_client(self):
+        """Return the soap client of the calling thread.
+
+        In POOL_CHECKOUT mode, the master soap client is returned instead, to
+        access the WSDL types; use checkout to call the webservice.
+        """
+        master = self.master
+        if self.mode != POOL_THREAD:
+            return master
+        if getattr(self._local, 'master', None) is not master:
+            self._local.client = clone_soap_client(master)
+            self._local.master = master
+        return self._local.client
+
+    def clone(self):
+        """Return a new soap client, cloned from the master, out of the pool.
+        """
+        return clone_soap_client(self.master)
+
+    @contextmanager
+    def checkout(self):
+        """Hand out a soap client to call the webservice.
 
-SOAP_CLIENT = SoapClientConstructor()
+        Yields:
+            A suds.client.Client for the exclusive use of the caller.
+
+        Raises:
+            SoapClientPoolTimeout: No client became available in time.
+        """
+        if self.mode == POOL_THREAD:
+            yield self.soap_client
+            return
+
+        master, soap_client = self._acquire()
+        try:
+            yield soap_client
+        finally:
+            self._release(master, soap_client)
+
+    def _acquire(self):
+        master = self.master
+        timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        with self._available:
+            while self._checked_out >= self.size:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise SoapClientPoolTimeout(
+                        'No soap client available after {} seconds'.format(
+                            timeout))
+                self._available.wait(remaining)
+            self._checked_out += 1
+            while self._idle:
+                client_master, soap_client = self._idle.pop()
+                if client_master is master:
+                    return master, soap_client
+        return master, clone_soap_client(master)
+
+    def _release(self, master, soap_client):
+        with self._available:
+            self._checked_out -= 1
+            if master is self.client:
+                self._idle.append((master, soap_client))
+            self._available.notify()
+
+    @property
+    def envelope_template(self):
+        """Return the request envelope template, compiled from the WSDL."""
+        master = self.master
+        if self.template is None or self.template.soap_client is not master:
+            self.template = EnvelopeTemplate(master)
+        return self.template
+
+    @property
+    def type_prototypes(self):
+        """Return the prototypes of the WSDL types, built from the WSDL."""
+        # pylint: disable=C0415
+        from socolissimo.prototypes import TypePrototypes
+        master = self.master
+        if self.prototypes is None or self.prototypes.soap_client is not master:
+            self.prototypes = TypePrototypes(master)
+        return self.prototypes
+
+
+# Backward compatible name of the pool.
+SoapClientConstructor = SoapClientPool
+
+
+SOAP_CLIENT = SoapClientPool()
 # soap_client = Client(WSDL_URL)
 
 
+def warm_up():
+    """Load everything the first call would: the modules, the parsed WSDL,
+    the envelope template and the compiled schemas.
+
+    Run in the master process of a preforking server, such as gunicorn with
+    preload_app, every worker inherits them through copy-on-write memory
+    instead of loading them on its first call.
+
+    Raises:
+        Whatever the download and parsing of the WSDL raise.
+    """
+    # pylint: disable=C0415
+    from socolissimo.schema import (ServiceCallContext, Parcel,
+                                    ParcelRecipient, ParcelSender)
+    for schema_class in (ServiceCallContext, Parcel, ParcelRecipient,
+                         ParcelSender):
+        schema_class.compiled()
+    SOAP_CLIENT.instanciate()
+    SOAP_CLIENT.envelope_template  # pylint: disable=W0104
+    SOAP_CLIENT.type_prototypes  # pylint: disable=W0104
+
+
+@contextmanager
+def count_call():
+    """Count the outcome of a webservice call in the metrics."""
+    try:
+        yield
+    except TransientServiceError:
+        metrics.increment(metrics.CALLS_METRIC, outcome='transient')
+        raise
+    except SoColissimoException:
+        metrics.increment(metrics.CALLS_METRIC, outcome='error')
+        raise
+    metrics.increment(metrics.CALLS_METRIC, outcome='ok')
+
+
+def is_server_fault(faultcode):
+    """Tell if a SOAP fault code blames the server, rather than the request.
+
+    Responses which are not valid SOAP, without fault code, are blamed on the
+    server too.
+    """
+    return faultcode is None or faultcode.rsplit(':', 1)[-1] == 'Server'
+
+
+def classify_fault(status, faultcode):
+    """Return the exception class of a call the webservice answered with a
+    fault, for every engine and client to retry the same faults.
+
+    A SOAP fault is transient when its fault code blames the server, whatever
+    the HTTP status, as suds reports every SOAP fault as an internal server
+    error. A reply which is not a SOAP fault is transient on a server error
+    status.
+
+    Args:
+        status (int): The HTTP status of the reply.
+        faultcode (str): The fault code of the SOAP fault, None when the
+            reply is not a SOAP fault.
+
+    Returns:
+        TransientServiceError or SoColissimoException.
+    """
+    if faultcode is None:
+        transient = status is not None and status >= 500
+    else:
+        transient = is_server_fault(faultcode)
+    return TransientServiceError if transient else SoColissimoException
+
+
 class SoColissimoClient(object):
     """Main entry point for generating SoColissimo letters via the webservice"""
 
-    def __init__(self, contract_number=None, password=None):
+    def __init__(self, contract_number=None, password=None, engine=None,
+                 use_result_cache=True, retry_policy=None):
         """Prepare the client to generate some letters with credentials.
 
         If no credentials are explicitely given, will try to fallback on the
@@ -60,9 +410,19 @@ class SoColissimoClient(object):
             contract_number (str or int, optional): Your SoColissimo contract
                 number.
             password (str, optional): Your SoColissimo password.
+            engine (str, optional): How the requests are built and the
+                responses read: ENGINE_SUDS, through the suds marshalling, or
+                ENGINE_TEMPLATE, through precompiled envelope templates.
+                Defaults to the SOCOLISSIMO_ENGINE setting, or ENGINE_SUDS.
+            use_result_cache (bool, optional): Whether to go through the
+                result cache, when the SOCOLISSIMO_RESULT_CACHE setting
+                configures one.
+            retry_policy (RetryPolicy, optional): How failed calls are
+                retried. Defaults to a policy configured by the settings,
+                going through the process wide CIRCUIT_BREAKER.
 
         Raises:
-            ValueError: The credentials are invalid.
+            ValueError: The credentials or the engine are invalid.
         """
         if contract_number is None:
             contract_number = getattr(settings, 'SOCOLISSIMO_CONTRACT_NUMBER',
@@ -79,19 +439,29 @@ class SoColissimoClient(object):
         except ValueError:
             raise ValueError('SoColissimo contract number must be an int')
         self.password = password
-        # Start client.
-        SOAP_CLIENT.instanciate()
+
+        if engine is None:
+            engine = getattr(settings, 'SOCOLISSIMO_ENGINE', ENGINE_SUDS)
+        if engine not in ENGINES:
+            raise ValueError('SoColissimo engine must be one of {}'.format(
+                ', '.join(ENGINES)))
+        self.engine = engine
+        self.result_cache = get_result_cache() if use_result_cache else None
+        self.rate_limiter = get_rate_limiter()
+        if retry_policy is None:
+            retry_policy = RetryPolicy(CIRCUIT_BREAKER)
+        self.retry_policy = retry_policy
 
     @staticmethod
     def check_service_health():
-        """Tell if the colissimo service is up and healthy.
+        """Tell if the colissimo service is up and healthy, through the
+        supervision pages of the endpoints, see routing.EndpointRouter.
 
         Returns:
             True if the service is up, False if the service is down
         """
-        response = requests.get(SUPERVISION_URL)
-        return response.status_code == 200 \
-            and response.content.strip() == "[OK]"
+        from socolissimo.routing import get_router  # pylint: disable=C0415
+        return get_router().check_health()
 
     def get_letter(self, service_call_context, parcel, recipient, sender):
         """Issue a request to the webservice to generate a SoColissimo label.
@@ -127,40 +497,458 @@ class SoColissimoClient(object):
 
         For complete description of available fields, see the schema module.
 
+        With a result cache, a letter already issued is not issued again: its
+        stored result is returned instead, and identical concurrent calls
+        only issue the letter once. The letter is identified by the
+        commandNumber of the service call context when there is one, or by
+        its whole data otherwise.
+
+        Transient failures of the webservice are retried according to the
+        retry policy, see RetryPolicy.
+
+        Returns:
+            A tuple (parcel_number, pdf_url)
+
+        Raises:
+            SoColissimoException: Something goes wrong with the webservice call.
+                Transient failures raise a TransientServiceError, calls not
+                issued because the service is down a ServiceUnavailable.
+            SchemaValidationError: The labelling data do not validate.
+        """
+        with metrics.time_phase(metrics.PHASE_VALIDATE, self.engine):
+            records = self._validate_letter(service_call_context, parcel,
+                                            recipient, sender)
+        return self._issue_records(records)
+
+    def shipment_session(self, service_call_context, sender):
+        """Start a shipment session, issuing letters which share their
+        service call context and sender.
+
+        The shared parts are validated and built once, see
+        session.ShipmentSession.
+
+        Args:
+            service_call_context (dict): The service call context of the
+                letters, as for get_letter.
+            sender (dict): The sender of the letters, as for get_letter.
+
+        Returns:
+            A ShipmentSession.
+
+        Raises:
+            SchemaValidationError: The shared labelling data do not validate.
+        """
+        from socolissimo.session import ShipmentSession  # pylint: disable=C0415
+        return ShipmentSession(self, service_call_context, sender)
+
+    def prepare_letter(self, service_call_context, parcel, recipient, sender):
+        """Do the CPU work of get_letter, without calling the webservice:
+        validate the labelling data and marshal the request envelope.
+
+        The arguments are the ones of get_letter. The prepared letter is
+        picklable, so it can be prepared in another process, then sent with
+        send_prepared.
+
+        Returns:
+            A PreparedLetter.
+
+        Raises:
+            SchemaValidationError: The labelling data do not validate.
+        """
+        with metrics.time_phase(metrics.PHASE_VALIDATE, self.engine):
+            records = self._validate_letter(service_call_context, parcel,
+                                            recipient, sender)
+        return PreparedLetter(self._marshal_letter(records),
+                              LetterResultCache.make_key(self.contract_number,
+                                                         records))
+
+    def send_prepared(self, prepared):
+        """Send a letter prepared by prepare_letter to the webservice.
+
+        Only the I/O of get_letter is left: the call, with its retries and
+        result cache, and the parsing of the response.
+
+        Args:
+            prepared (PreparedLetter): The letter, as prepared by a client
+                with the same credentials.
+
         Returns:
             A tuple (parcel_number, pdf_url)
 
+        Raises:
+            SoColissimoException: Something goes wrong with the webservice call,
+                see get_letter.
+        """
+        return self._issue(prepared.key, partial(self._call_prepared,
+                                                 prepared.envelope))
+
+    def _issue_records(self, records, built=None):
+        """Issue a letter from its validated labelling data.
+
+        Args:
+            records (dict): The validated SchemaRecord, by Letter field name.
+            built (dict, optional): Parts of the letter already built with
+                _build_parts, by Letter field name.
+        """
+        key = None
+        if self.result_cache is not None:
+            key = self.result_cache.make_key(self.contract_number, records)
+        return self._issue(key, partial(self._call_service, records, built))
+
+    def _issue(self, key, call_service):
+        """Issue a letter through the result cache, retrying transient
+        failures.
+
+        Args:
+            key (str): The key of the letter in the result cache.
+            call_service (callable): Sends the letter and returns the
+                response of the webservice.
+        """
+        def issue_letter():
+            """Issue the letter, retrying transient failures."""
+            return self.retry_policy.call(
+                lambda: self._issue_letter(call_service))
+
+        if self.result_cache is None:
+            return issue_letter()
+        return self.result_cache.get_or_call(key, issue_letter)
+
+    def _issue_letter(self, call_service):
+        """Issue a request to the webservice, counting the outcome in the
+        metrics.
+
+        Args:
+            call_service (callable): Sends the letter and returns the
+                response of the webservice.
+
         Raises:
             SoColissimoException: Something goes wrong with the webservice call.
+            TransientServiceError: The call failed on a network or server
+                error, or a transient errorID.
+        """
+        with count_call():
+            return self._send_letter(call_service)
+
+    def _send_letter(self, call_service):
+        """Send the letter, converting the failures to SoColissimoException.
+        """
+        import requests  # pylint: disable=C0415
+        try:
+            return self._read_response(call_service())
+        except requests.Timeout as exc:
+            if isinstance(exc, requests.ConnectTimeout):
+                raise TransientServiceError(
+                    'Cannot connect to the SOAP service : {}'.format(exc))
+            raise ServiceTimeout('SOAP service timed out : {}'.format(exc))
+        except requests.RequestException as exc:
+            raise TransientServiceError(
+                'Cannot reach the SOAP service : {}'.format(exc))
+        except socket.timeout as exc:
+            raise ServiceTimeout('SOAP service timed out : {}'.format(exc))
+        except OSError as exc:
+            # Network errors of the transports based on urllib.
+            raise TransientServiceError(
+                'Cannot reach the SOAP service : {}'.format(exc))
+
+    def _call_service(self, records, built=None):
+        """Send the letter to the webservice and return its response."""
+        if self.engine == ENGINE_TEMPLATE:
+            return self._call_prepared(self._marshal_letter(records, built))
+
+        # pylint: disable=C0415
+        import requests
+        from suds import WebFault
+        from socolissimo.routing import get_router
+
+        # Wait before checking a soap client out, not to hold it meanwhile.
+        self._wait_rate_limit()
+        with SOAP_CLIENT.checkout() as soap_client:
+            with metrics.time_phase(metrics.PHASE_BUILD, self.engine):
+                letter = self._build_letter(soap_client, records, built)
+            with get_router().route() as endpoint:
+                # None restores the location of the WSDL.
+                soap_client.set_options(location=endpoint.url)
+                try:
+                    with metrics.time_soap_call(self.engine):
+                        return soap_client.service.getLetterColissimo(letter)
+                except WebFault as exc:
+                    # suds raises WebFault on internal server errors only.
+                    raise classify_fault(500, exc.fault.faultcode)(
+                        'Exception in the SOAP client : {}'.format(exc))
+                except requests.RequestException:
+                    raise
+                except Exception as exc:  # pylint: disable=W0703
+                    # suds reports HTTP errors without a SOAP fault as a bare
+                    # Exception((status, reason)).
+                    if not exc.args or not isinstance(exc.args[0], tuple):
+                        raise
+                    status, reason = exc.args[0]
+                    raise classify_fault(status, None)(
+                        'Error {} from the SOAP service : {}'.format(
+                            status, reason))
+
+    def _call_prepared(self, envelope):
+        """Send a marshalled envelope to the webservice and return its
+        response."""
+        self._wait_rate_limit()
+        return self._send_envelope(envelope)
+
+    def _marshal_letter(self, records, built=None):
+        """Marshal the request envelope of validated labelling data, with the
+        engine of the client.
+
+        Returns:
+            The envelope, as bytes.
+        """
+        if self.engine == ENGINE_TEMPLATE:
+            with metrics.time_phase(metrics.PHASE_BUILD, self.engine):
+                letter = self._build_letter_data(records, built)
+            with metrics.time_phase(metrics.PHASE_MARSHAL, self.engine):
+                return SOAP_CLIENT.envelope_template.render(letter=letter)
+
+        with SOAP_CLIENT.checkout() as soap_client:
+            with metrics.time_phase(metrics.PHASE_BUILD, self.engine):
+                letter = self._build_letter(soap_client, records, built)
+            with metrics.time_phase(metrics.PHASE_MARSHAL, self.engine):
+                # suds marshals the envelope, then hands it back unsent.
+                soap_client.set_options(nosend=True)
+                try:
+                    return soap_client.service.getLetterColissimo(
+                        letter).envelope
+                finally:
+                    soap_client.set_options(nosend=False)
+
+    def get_letters(self, letters, max_workers=DEFAULT_MAX_WORKERS,
+                    processes=None):
+        """Generate several SoColissimo labels concurrently.
+
+        Each letter is issued with get_letter on a bounded pool of worker
+        threads. A letter failing to validate or rejected by the webservice
+        does not interrupt the rest of the batch.
+
+        In pipeline mode, when processes is given, the letters are instead
+        prepared in a pool of processes and sent by the worker threads, see
+        pipeline.LetterPipeline.
+
+        Args:
+            letters (iterable of dict): The keyword arguments of get_letter,
+                one dict per label.
+            max_workers (int, optional): Maximum number of concurrent calls
+                to the webservice.
+            processes (int, optional): Number of processes preparing the
+                letters in pipeline mode, 0 for one per CPU.
+
+        Returns:
+            A list with one outcome per letter, in input order. Each outcome
+            is either a tuple (parcel_number, pdf_url), or the
+            SoColissimoException or SchemaValidationError raised for this
+            letter.
         """
-        soap_client = SOAP_CLIENT.soap_client
+        if processes is not None:
+            # pylint: disable=C0415
+            from socolissimo.pipeline import LetterPipeline
+            return LetterPipeline(self, processes,
+                                  max_workers).get_letters(letters)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.get_letter_outcome, letter)
+                       for letter in letters]
+        return [future.result() for future in futures]
 
-        letter = soap_client.factory.create('Letter')
+    def get_letter_outcome(self, letter):
+        """Call get_letter, returning the expected exceptions as outcome.
+
+        Args:
+            letter (dict): The keyword arguments of get_letter.
+
+        Returns:
+            Either a tuple (parcel_number, pdf_url), or the
+            SoColissimoException or SchemaValidationError raised for the
+            letter.
+        """
+        # pylint: disable=C0415
+        from socolissimo.schema import SchemaValidationError
+        try:
+            return self.get_letter(**letter)
+        except (SoColissimoException, SchemaValidationError) as exc:
+            return exc
+
+    def validate_letters(self, letters):
+        """Validate the labelling data of several letters, without any call to
+        the webservice.
+
+        Args:
+            letters (iterable of dict): The keyword arguments of get_letter,
+                one dict per label.
+
+        Returns:
+            A list with, for each letter in input order, None if the letter is
+            valid, or the SchemaValidationError raised.
+        """
+        # pylint: disable=C0415
+        from socolissimo.schema import SchemaValidationError
+        results = []
+        for letter in letters:
+            try:
+                self._validate_letter(**letter)
+            except SchemaValidationError as exc:
+                results.append(exc)
+            else:
+                results.append(None)
+        return results
+
+    def _build_letter(self, soap_client, records,  # pylint: disable=W0613
+                      built=None):
+        """Build the suds Letter instance from the validated labelling data.
+
+        The instances are cloned from the prototypes of the WSDL types, see
+        SoapClientPool.type_prototypes.
+
+        Args:
+            soap_client (suds.client.Client): The soap client of the call.
+            records (dict): The validated SchemaRecord, by Letter field name,
+                as returned by _validate_letter.
+            built (dict, optional): Instances already built with _build_parts,
+                by Letter field name, used instead of their record.
+        """
+        letter = SOAP_CLIENT.type_prototypes.create('Letter',
+                                                    LETTER_CONSTANTS)
         letter.password = self.password
         letter.contractNumber = self.contract_number
-        letter.coordinate = None
 
-        service_schema = ServiceCallContext(service_call_context)
-        letter.service = service_schema.build_instance()
+        for field, record in records.items():
+            if built and field in built:
+                setattr(letter, field, built[field])
+            else:
+                setattr(letter, field, record.build_instance())
+        return letter
 
-        parcel_schema = Parcel(parcel)
-        letter.parcel = parcel_schema.build_instance()
+    def _build_letter_data(self, records, built=None):
+        """Build the plain Letter data from the validated labelling data.
 
-        recipient_schema = ParcelRecipient(recipient)
-        letter.dest = recipient_schema.build_instance()
+        Args:
+            records (dict): The validated SchemaRecord, by Letter field name,
+                as returned by _validate_letter.
+            built (dict, optional): Data already built with _build_parts, by
+                Letter field name, used instead of their record.
+        """
+        from socolissimo.schema import SchemaData  # pylint: disable=C0415
+        letter = SchemaData(password=self.password,
+                            contractNumber=self.contract_number)
+        for field, record in records.items():
+            if built and field in built:
+                letter[field] = built[field]
+            else:
+                letter[field] = record.build_data()
+        return letter
+
+    def _build_parts(self, records):
+        """Build parts of letters once, for the engine of the client, so
+        that letters sharing them don't build them again.
+
+        The built parts are only read when marshalling the letters, so they
+        can be shared by concurrent calls.
 
-        sender_schema = ParcelSender(sender)
-        letter.exp = sender_schema.build_instance()
+        Args:
+            records (dict): The validated SchemaRecord of the parts, by
+                Letter field name.
 
-        try:
-            # soap_client.set_options(nosend=True)
-            response = soap_client.service.getLetterColissimo(letter)
-        except WebFault as exc:
-            msg = 'Exception in the SOAP client : {}'.format(exc)
-            raise SoColissimoException(msg)
+        Returns:
+            A dict of the suds instances, or of the plain data with
+            ENGINE_TEMPLATE, by Letter field name.
+        """
+        with metrics.time_phase(metrics.PHASE_BUILD, self.engine):
+            if self.engine == ENGINE_TEMPLATE:
+                return dict((field, record.build_data())
+                            for field, record in records.items())
+            return dict((field, record.build_instance())
+                        for field, record in records.items())
 
+    @staticmethod
+    def _validate_letter(service_call_context, parcel, recipient, sender):
+        """Validate the labelling data with the compiled schemas.
+
+        Returns:
+            A dict of the validated SchemaRecord, by Letter field name.
+
+        Raises:
+            SchemaValidationError: The labelling data do not validate.
+        """
+        # pylint: disable=C0415
+        from socolissimo.schema import (ServiceCallContext, Parcel,
+                                        ParcelRecipient, ParcelSender)
+        return {
+            'service': ServiceCallContext.compiled().validate(
+                service_call_context),
+            'parcel': Parcel.compiled().validate(parcel),
+            'dest': ParcelRecipient.compiled().validate(recipient),
+            'exp': ParcelSender.compiled().validate(sender),
+        }
+
+    def _wait_rate_limit(self):
+        """Wait for the rate limiter, if any, to allow a call."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    @staticmethod
+    def _send_envelope(envelope):
+        """Post a rendered envelope to the webservice and parse the response.
+
+        The request goes through the transport of the soap client, to the
+        endpoint chosen by the router.
+
+        Raises:
+            SoColissimoException: The webservice answered with a SOAP fault.
+            TransientServiceError: The webservice answered with a server
+                error.
+        """
+        # pylint: disable=C0415
+        from suds.transport import Request, TransportError
+        from socolissimo.routing import get_router
+        template = SOAP_CLIENT.envelope_template
+        with get_router().route() as endpoint:
+            request = Request(endpoint.url or template.location, envelope)
+            request.headers = {
+                'Content-Type': 'text/xml; charset=utf-8',
+                'SOAPAction': template.soap_action,
+            }
+            try:
+                with SOAP_CLIENT.checkout() as soap_client, \
+                        metrics.time_phase(metrics.PHASE_NETWORK,
+                                           ENGINE_TEMPLATE):
+                    reply = soap_client.options.transport.send(request).message
+            except TransportError as exc:
+                status = exc.httpcode
+                reply = exc.fp.read() if exc.fp else b''
+            else:
+                status = 200
+
+            try:
+                with metrics.time_phase(metrics.PHASE_PARSE, ENGINE_TEMPLATE):
+                    return parse_letter_response(reply)
+            except SoapFault as exc:
+                raise classify_fault(status, exc.faultcode)(
+                    'Exception in the SOAP client : {}'.format(exc))
+
+    @staticmethod
+    def _read_response(response):
+        """Extract the (parcel_number, pdf_url) tuple from a service response.
+
+        Raises:
+            SoColissimoException: The webservice returned an error.
+            TransientServiceError: The errorID is one of the
+                SOCOLISSIMO_TRANSIENT_ERROR_IDS setting.
+        """
         if response.errorID != 0:
+            metrics.increment(metrics.ERRORS_METRIC, error_id=response.errorID)
             msg = "Error {} : {}".format(response.errorID, response.error)
+            if response.errorID in getattr(
+                    settings, 'SOCOLISSIMO_TRANSIENT_ERROR_IDS', ()):
+                raise TransientServiceError(msg)
             raise SoColissimoException(msg)
 
         return response.parcelNumber, response.PdfUrl
+
+
+# Circuit breaker shared by all the clients of the process.
+CIRCUIT_BREAKER = CircuitBreaker(SoColissimoClient.check_service_health)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Template based SOAP envelopes, bypassing the suds marshalling."""
+import collections
+import datetime
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+ENVELOPE_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="{soap_env}" xmlns:xsi="{xsi}" '
+    'xmlns:ns0="{namespace}"><SOAP-ENV:Header/><SOAP-ENV:Body>')
+ENVELOPE_TAIL = '</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+
+# Response of the getLetterColissimo operation.
+LetterResponse = collections.namedtuple(
+    'LetterResponse', ['errorID', 'error', 'parcelNumber', 'PdfUrl'])
+
+
+class SoapFault(Exception):
+    """The webservice answered with a SOAP fault, or an invalid response.
+
+    Attributes:
+        faultcode: The code of the SOAP fault, None for invalid responses.
+    """
+
+    def __init__(self, message, faultcode=None):
+        super(SoapFault, self).__init__(message)
+        self.faultcode = faultcode
+
+
+def format_value(value):
+    """Format a python value as the text of an XML element, like suds."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return escape(str(value))
+
+
+class EnvelopeTemplate(object):
+    """
+    Request envelope of a webservice operation, precompiled from the WSDL.
+
+    The elements order, qualification and nillability are read once from the
+    schema parsed by suds. The envelope is then rendered directly from plain
+    dicts, as built by SoColissimoSchema.build_data, without going through
+    the suds object graph and marshaller.
+
+    Only document/literal operations are supported, which is the binding of
+    the SoColissimo webservice.
+
+    Args:
+        soap_client (suds.client.Client): Soap client holding the parsed WSDL.
+        method_name (str, optional): The webservice operation.
+
+    Attributes:
+        location: URL of the webservice endpoint.
+        soap_action: SOAPAction header of the operation.
+    """
+
+    def __init__(self, soap_client, method_name='getLetterColissimo'):
+        self.soap_client = soap_client
+        method = getattr(soap_client.service, method_name).method
+        self.location = method.location
+        self.soap_action = method.soap.action
+
+        part = method.soap.input.body.parts[0]
+        wrapper = soap_client.wsdl.schema.elements[part.element]
+        self.namespace = wrapper.namespace()[1]
+        self._head = ENVELOPE_HEAD.format(soap_env=SOAP_ENV_NS, xsi=XSI_NS,
+                                          namespace=self.namespace)
+        self._render_wrapper = self._compile(wrapper, qualified=True)
+
+    def _compile(self, element, qualified=None):
+        """Compile an element of the schema into a render function."""
+        if qualified is None:
+            qualified = element.form_qualified
+        tag = 'ns0:{}'.format(element.name) if qualified else element.name
+        open_tag = '<{}>'.format(tag)
+        close_tag = '</{}>'.format(tag)
+        if element.nillable:
+            empty_tag = '<{} xsi:nil="true"/>'.format(tag)
+        elif element.optional():
+            empty_tag = ''
+        else:
+            empty_tag = '<{}/>'.format(tag)
+
+        resolved = element.resolve()
+        if resolved.builtin():
+            def render_value(value, out):
+                """Render a simple element."""
+                if value is None:
+                    out.append(empty_tag)
+                else:
+                    out.append(open_tag + format_value(value) + close_tag)
+            return render_value
+
+        children = [(child.name, self._compile(child))
+                    for child, _ in resolved.children()]
+
+        def render_complex(value, out):
+            """Render a complex element and its children."""
+            if value is None:
+                out.append(empty_tag)
+                return
+            out.append(open_tag)
+            for name, render_child in children:
+                render_child(value.get(name), out)
+            out.append(close_tag)
+        return render_complex
+
+    def render(self, **parts):
+        """Render the request envelope.
+
+        Args:
+            **parts: The operation parameters, as nested dicts of values.
+
+        Returns:
+            The envelope, as UTF-8 encoded bytes.
+        """
+        out = [self._head]
+        self._render_wrapper(parts, out)
+        out.append(ENVELOPE_TAIL)
+        return ''.join(out).encode('utf-8')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_letter_response(reply):
+    """Read the result of a getLetterColissimo call from the response XML.
+
+    Args:
+        reply (bytes): The SOAP response envelope.
+
+    Returns:
+        A LetterResponse.
+
+    Raises:
+        SoapFault: The response is a SOAP fault, or is not a valid response.
+    """
+    try:
+        root = ElementTree.fromstring(reply)
+    except ElementTree.ParseError as exc:
+        raise SoapFault('Invalid response : {}'.format(exc))
+
+    values = {}
+    for node in root.iter():
+        name = _local_name(node.tag)
+        if name == 'Fault':
+            fault = dict((_local_name(child.tag), child.text)
+                         for child in node)
+            raise SoapFault('Server raised fault: {}'.format(
+                fault.get('faultstring')), fault.get('faultcode'))
+        if name in LetterResponse._fields:
+            values[name] = node.text
+
+    if 'errorID' not in values:
+        raise SoapFault('Invalid response : no errorID')
+    try:
+        values['errorID'] = int(values['errorID'])
+    except (TypeError, ValueError):
+        raise SoapFault('Invalid response : errorID {!r}'.format(
+            values['errorID']))
+    return LetterResponse(values['errorID'], values.get('error'),
+                          values.get('parcelNumber'), values.get('PdfUrl'))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Exceptions of the SoColissimo client."""
+
+
+class SoColissimoException(Exception):
+    """Exception happening in the SoColissimo scope"""
+    pass
+
+
+class TransientServiceError(SoColissimoException):
+    """The webservice failed in a way a later call may not, such as a network
+    error, a server error or a transient errorID."""
+    pass
+
+
+class ServiceTimeout(TransientServiceError):
+    """The webservice did not answer in time. The request may still have been
+    processed, so the label may have been generated."""
+    pass
+
+
+class LocalError(SoColissimoException):
+    """The call failed in the client, without an answer of the webservice,
+    such as on a limit of the client."""
+    pass
+
+
+class ServiceUnavailable(LocalError):
+    """The webservice is known to be down, the call was not issued."""
+    pass
+
+
+class DeadlineExceeded(LocalError):
+    """The call could not succeed within its deadline."""
+    pass
+
+
+class RateLimitExceeded(LocalError):
+    """The call would have waited too long for the rate limiter."""
+    pass
+
+
+class UnknownAccount(SoColissimoException):
+    """No account of this name is configured."""
+    pass
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Health of the web service SoColissimo, polled in the background."""
+import collections
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from socolissimo.client import SoColissimoClient
+
+
+# Default time between two polls of the supervision page, in seconds.
+DEFAULT_HEALTH_INTERVAL = 30
+# Default number of polls kept in the history.
+DEFAULT_HEALTH_HISTORY = 100
+# Keys of the shared status and polling lock in the django cache.
+STATUS_KEY = 'socolissimo:health:status'
+LOCK_KEY = 'socolissimo:health:lock'
+
+# Outcome of a poll of the supervision page. checked_at is a time.time()
+# timestamp, latency is in seconds.
+HealthStatus = collections.namedtuple('HealthStatus',
+                                      ['healthy', 'checked_at', 'latency'])
+
+
+class HealthMonitor(object):
+    """
+    Health of the webservice, polled from the supervision page in the
+    background.
+
+    Reading the status never blocks on the network: it is the outcome of the
+    latest poll. When a django cache is given, the polls are shared by every
+    process using it: on each tick, a single process polls the service and
+    stores the outcome, the others read it from the cache.
+
+    Args:
+        interval (float, optional): Seconds between two polls. Defaults to
+            the SOCOLISSIMO_HEALTH_INTERVAL setting.
+        cache_alias (str, optional): Name of the django cache sharing the
+            polls. Defaults to the SOCOLISSIMO_HEALTH_CACHE setting; None
+            keeps them local to the process.
+        history_size (int, optional): Number of polls kept in the history.
+            Defaults to the SOCOLISSIMO_HEALTH_HISTORY setting.
+        probe (callable, optional): Tell if the service is up. Defaults to
+            SoColissimoClient.check_service_health.
+    """
+
+    def __init__(self, interval=None, cache_alias=None, history_size=None,
+                 probe=None):
+        if interval is None:
+            interval = getattr(settings, 'SOCOLISSIMO_HEALTH_INTERVAL',
+                               DEFAULT_HEALTH_INTERVAL)
+        if cache_alias is None:
+            cache_alias = getattr(settings, 'SOCOLISSIMO_HEALTH_CACHE', None)
+        if history_size is None:
+            history_size = getattr(settings, 'SOCOLISSIMO_HEALTH_HISTORY',
+                                   DEFAULT_HEALTH_HISTORY)
+        self.interval = interval
+        self.cache_alias = cache_alias
+        self.history_size = history_size
+        self.probe = probe or SoColissimoClient.check_service_health
+        self._history = collections.deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def status(self):
+        """The HealthStatus of the latest poll, None before the first one."""
+        with self._lock:
+            return self._history[-1] if self._history else None
+
+    @property
+    def age(self):
+        """Seconds since the latest poll, None before the first one."""
+        status = self.status
+        if status is None:
+            return None
+        return max(time.time() - status.checked_at, 0)
+
+    @property
+    def history(self):
+        """The HealthStatus of the latest polls, oldest first."""
+        with self._lock:
+            return list(self._history)
+
+    def is_healthy(self, max_age=None):
+        """Tell if the latest poll found the service up.
+
+        Args:
+            max_age (float, optional): Seconds after which the latest poll is
+                too old to be trusted. Defaults to three intervals.
+
+        Returns:
+            False when the service is down, or its status unknown or too old.
+        """
+        if max_age is None:
+            max_age = 3 * self.interval
+        status = self.status
+        return status is not None and status.healthy and self.age <= max_age
+
+    def check(self):
+        """Poll the supervision page, whatever the other processes do.
+
+        Returns:
+            The HealthStatus of the poll.
+        """
+        start = time.monotonic()
+        try:
+            healthy = bool(self.probe())
+        except Exception:  # pylint: disable=W0703
+            healthy = False
+        status = HealthStatus(healthy, time.time(), time.monotonic() - start)
+
+        with self._lock:
+            self._history.append(status)
+            history = list(self._history)
+        if self.cache_alias is not None:
+            caches[self.cache_alias].set(STATUS_KEY, history, None)
+        return status
+
+    def poll(self):
+        """Poll the supervision page, unless another process is on it.
+
+        Without a shared cache, always polls. Otherwise, the process which
+        takes the polling lock polls, the others read the latest polls from
+        the cache.
+
+        Returns:
+            The latest HealthStatus, or None if no process polled yet.
+        """
+        if self.cache_alias is None:
+            return self.check()
+        cache = caches[self.cache_alias]
+        if cache.add(LOCK_KEY, True, max(int(self.interval * 0.9), 1)):
+            return self.check()
+
+        history = cache.get(STATUS_KEY)
+        if history:
+            with self._lock:
+                self._history.clear()
+                self._history.extend(HealthStatus(*status)
+                                     for status in history)
+        return self.status
+
+    def start(self):
+        """Start polling in a background thread."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='socolissimo-health')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.poll()
+            self._stopped.wait(self.interval)
+
+
+_HEALTH_MONITOR = None
+_HEALTH_MONITOR_LOCK = threading.Lock()
+
+
+def get_health_monitor():
+    """Return the health monitor of the process, polling in the background.
+
+    It is configured by the SOCOLISSIMO_HEALTH_INTERVAL,
+    SOCOLISSIMO_HEALTH_CACHE and SOCOLISSIMO_HEALTH_HISTORY settings, and
+    started at first use.
+    """
+    global _HEALTH_MONITOR  # pylint: disable=W0603
+    if _HEALTH_MONITOR is None:
+        with _HEALTH_MONITOR_LOCK:
+            if _HEALTH_MONITOR is None:
+                monitor = HealthMonitor()
+                monitor.start()
+                _HEALTH_MONITOR = monitor
+    return _HEALTH_MONITOR
+
+
+def _forget_health_monitor():
+    """Drop the health monitor in a forked child, where its polling thread
+    does not run, so the child starts its own at first use."""
+    global _HEALTH_MONITOR, _HEALTH_MONITOR_LOCK  # pylint: disable=W0603
+    _HEALTH_MONITOR = None
+    _HEALTH_MONITOR_LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_health_monitor)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Idempotent results of the webservice SoColissimo.
+
+Every label generated by the webservice is a paid parcel. A retried call, or
+a duplicated queue message, must not generate a second label for the same
+letter: the results are stored in the django cache, keyed by the letter, and
+concurrent identical calls within a process are coalesced into a single one.
+"""
+import asyncio
+import datetime
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# Default time to live of the stored results, in seconds.
+DEFAULT_RESULT_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+# Prefix of the keys of the stored results.
+KEY_PREFIX = 'socolissimo:letter'
+
+
+def _plain(value):
+    """Convert validated data to plain values, for a canonical dump."""
+    # Imported here not to load the django forms with the client.
+    from socolissimo.schema import SchemaRecord  # pylint: disable=C0415
+    if isinstance(value, SchemaRecord):
+        return dict((field, _plain(item)) for field, item in value.items())
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return value
+
+
+class LetterResultCache(object):
+    """
+    Results of the getLetterColissimo calls, stored in a django cache.
+
+    A letter is identified by the commandNumber of its service call context
+    when there is one, or by a hash of its validated data otherwise, within
+    the scope of a contract number.
+
+    Args:
+        alias (str, optional): Name of the django cache the results are
+            stored in.
+        timeout (int, optional): Time to live of the results, in seconds.
+    """
+
+    def __init__(self, alias='default', timeout=DEFAULT_RESULT_CACHE_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+        self._in_flight = {}
+        self._in_flight_async = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        """The django cache, whose connections are per thread."""
+        return caches[self.alias]
+
+    @staticmethod
+    def make_key(contract_number, records):
+        """Return the key of a letter.
+
+        Args:
+            contract_number (int): The contract the letter is issued for.
+            records (dict): The validated SchemaRecord, by Letter field name.
+        """
+        command_number = records['service'].commandNumber
+        if command_number:
+            kind, identity = 'command', command_number
+        else:
+            kind = 'data'
+            identity = json.dumps(_plain(records), sort_keys=True, default=str)
+        digest = hashlib.sha256(identity.encode('utf-8')).hexdigest()
+        return '{}:{}:{}:{}'.format(KEY_PREFIX, contract_number, kind, digest)
+
+    def get(self, key):
+        """Return the stored (parcel_number, pdf_url) of a letter, or None."""
+        result = self.cache.get(key)
+        return tuple(result) if result is not None else None
+
+    def set(self, key, result):
+        """Store the (parcel_number, pdf_url) of a letter."""
+        self.cache.set(key, list(result), self.timeout)
+
+    def get_or_call(self, key, func):
+        """Return the stored result of a letter, or call func to get it.
+
+        When several threads ask for the same letter at once, func is only
+        called by the first one, the others wait for its outcome. Only
+        successful results are stored.
+
+        Args:
+            key (str): The key of the letter, see make_key.
+            func (callable): Issues the letter, returning a tuple
+                (parcel_number, pdf_url).
+
+        Returns:
+            A tuple (parcel_number, pdf_url)
+
+        Raises:
+            Whatever func raises, to every thread waiting for it.
+        """
+        result = self.get(key)
+        if result is not None:
+            return result
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            # Another process may have stored the result in the meantime.
+            result = self.get(key)
+            if result is None:
+                result = func()
+                self.set(key, result)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    async def get_or_call_async(self, key, func):
+        """Coroutine variant of get_or_call, for the async client.
+
+        The django cache is read and written in the default executor, not to
+        block the event loop. When several tasks of an event loop ask for the
+        same letter at once, func is only called by the first one, the others
+        await its outcome.
+
+        Args:
+            key (str): The key of the letter, see make_key.
+            func (callable): Returns an awaitable issuing the letter, and
+                returning a tuple (parcel_number, pdf_url).
+
+        Returns:
+            A tuple (parcel_number, pdf_url)
+
+        Raises:
+            Whatever func raises, to every task waiting for it.
+        """
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, self.get, key)
+        if result is not None:
+            return result
+
+        in_flight_key = (loop, key)
+        with self._lock:
+            future = self._in_flight_async.get(in_flight_key)
+            leader = future is None
+            if leader:
+                future = loop.create_future()
+                self._in_flight_async[in_flight_key] = future
+        if not leader:
+            # Shielded, so that a cancelled waiter does not cancel the call.
+            return await asyncio.shield(future)
+
+        try:
+            # Another process may have stored the result in the meantime.
+            result = await loop.run_in_executor(None, self.get, key)
+            if result is None:
+                result = await func()
+                await loop.run_in_executor(None, self.set, key, result)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Retrieved, not to be logged when no other task waits for it.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight_async[in_flight_key]
+
+
+_RESULT_CACHE = None
+
+
+def get_result_cache():
+    """Return the result cache configured in the settings.
+
+    Results are stored in the django cache named by the
+    SOCOLISSIMO_RESULT_CACHE setting, for SOCOLISSIMO_RESULT_CACHE_TIMEOUT
+    seconds. Returns None when no cache is configured.
+    """
+    global _RESULT_CACHE  # pylint: disable=W0603
+    alias = getattr(settings, 'SOCOLISSIMO_RESULT_CACHE', None)
+    if alias is None:
+        return None
+    timeout = getattr(settings, 'SOCOLISSIMO_RESULT_CACHE_TIMEOUT',
+                      DEFAULT_RESULT_CACHE_TIMEOUT)
+    if _RESULT_CACHE is None or _RESULT_CACHE.alias != alias \
+            or _RESULT_CACHE.timeout != timeout:
+        _RESULT_CACHE = LetterResultCache(alias, timeout)
+    return _RESULT_CACHE
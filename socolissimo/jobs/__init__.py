@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""Database backed queue of SoColissimo labels, processed by workers.
+
+Add "socolissimo.jobs" to the INSTALLED_APPS to use it.
+"""
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""Configuration of the label job queue application."""
+from django.apps import AppConfig
+
+
+class JobsConfig(AppConfig):
+    """The label job queue application."""
+
+    name = 'socolissimo.jobs'
+    label = 'socolissimo_jobs'
+    verbose_name = 'SoColissimo label jobs'
+    default_auto_field = 'django.db.models.AutoField'
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Process the SoColissimo label job queue."""
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from socolissimo.jobs.worker import DEFAULT_POLL_INTERVAL, LabelWorker
+
+
+class Command(BaseCommand):
+    """Generate the labels of the queued LabelJob."""
+
+    help = ('Claim the queued label jobs in batches and generate their '
+            'labels. Run several workers to scale the throughput.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            help='Number of jobs claimed at once.')
+        parser.add_argument('--max-workers', type=int,
+                            help='Number of concurrent calls to the '
+                                 'webservice.')
+        parser.add_argument('--poll-interval', type=float,
+                            default=DEFAULT_POLL_INTERVAL,
+                            help='Seconds between two polls of an empty '
+                                 'queue.')
+        parser.add_argument('--once', action='store_true',
+                            help='Process the queued jobs, then exit.')
+
+    def handle(self, *args, **options):
+        worker = LabelWorker(batch_size=options['batch_size'],
+                             max_workers=options['max_workers'])
+        if options['once']:
+            total = 0
+            processed = worker.run_once()
+            while processed:
+                total += processed
+                processed = worker.run_once()
+            self.stdout.write('{} label jobs processed'.format(total))
+            return
+
+        stop_event = threading.Event()
+
+        def stop(signum, frame):  # pylint: disable=W0613
+            """Finish the current batch, then exit."""
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        self.stdout.write('Processing the label jobs...')
+        worker.run(options['poll_interval'], stop_event)
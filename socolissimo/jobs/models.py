@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Models of the label job queue."""
+import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from django.utils import timezone
+
+from socolissimo.client import SoColissimoClient
+
+
+class LabelJobQuerySet(models.QuerySet):
+    """Queries of the label jobs."""
+
+    def claimable(self, lease):
+        """Jobs a worker can claim: pending jobs due now, and running jobs
+        whose worker did not report back within the lease.
+
+        The letter of a running job may have been issued before its worker
+        stopped, so the worker claiming it fails it rather than issuing it
+        again, see LabelWorker.claim. Keep the lease well above the time a
+        batch takes.
+
+        Args:
+            lease (float): Seconds a worker has to process a claimed job.
+        """
+        now = timezone.now()
+        return self.filter(
+            models.Q(status=LabelJob.PENDING, run_after__lte=now)
+            | models.Q(status=LabelJob.RUNNING,
+                       claimed_at__lt=now - datetime.timedelta(
+                           seconds=lease)))
+
+
+class LabelJob(models.Model):
+    """
+    A label to generate, with the keyword arguments of get_letter.
+
+    Jobs are created PENDING by enqueue, claimed RUNNING by a worker, and end
+    DONE with the parcel number and PDF URL of the label, or FAILED with the
+    error. Jobs failing on a transient error go back to PENDING until their
+    attempts run out.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=STATUSES,
+                              default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    parcel_number = models.CharField(max_length=50, blank=True)
+    pdf_url = models.URLField(max_length=500, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = LabelJobQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('id',)
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
+    def __str__(self):
+        return 'Label job {} ({})'.format(self.pk, self.status)
+
+    @classmethod
+    def enqueue(cls, service_call_context, parcel, recipient, sender):
+        """Validate the labelling data and queue a label job.
+
+        See SoColissimoClient.get_letter for the expected arguments.
+
+        Returns:
+            The LabelJob created.
+
+        Raises:
+            SchemaValidationError: The labelling data do not validate.
+        """
+        # Invalid data would never succeed, refuse them up front.
+        SoColissimoClient._validate_letter(  # pylint: disable=W0212
+            service_call_context, parcel, recipient, sender)
+        return cls.objects.create(payload={
+            'service_call_context': service_call_context,
+            'parcel': parcel,
+            'recipient': recipient,
+            'sender': sender,
+        })
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Worker processing the label job queue."""
+import datetime
+import random
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from socolissimo.client import DEFAULT_MAX_WORKERS, SoColissimoClient
+from socolissimo.exceptions import (DeadlineExceeded, ServiceTimeout,
+                                    ServiceUnavailable, TransientServiceError)
+from socolissimo.jobs.models import LabelJob
+
+
+# Default number of jobs claimed at once.
+DEFAULT_BATCH_SIZE = 50
+# Default number of attempts of a job.
+DEFAULT_MAX_ATTEMPTS = 5
+# Default delay before the first retry of a job, doubled at each attempt, in
+# seconds.
+DEFAULT_RETRY_DELAY = 30
+# Default seconds a worker has to process the jobs it claimed.
+DEFAULT_LEASE = 10 * 60
+# Default seconds between two polls of an empty queue.
+DEFAULT_POLL_INTERVAL = 5
+
+# Error of the jobs whose worker did not report back within the lease.
+EXPIRED_LEASE_ERROR = ('The worker did not report back, the label may have '
+                       'been generated, check before enqueueing it again')
+
+# Errors after which a job is retried later.
+TRANSIENT_ERRORS = (TransientServiceError, ServiceUnavailable,
+                    DeadlineExceeded)
+
+
+def _get_setting(value, name, default):
+    if value is not None:
+        return value
+    return getattr(settings, name, default)
+
+
+class LabelWorker(object):
+    """
+    Claim label jobs in batches and generate their labels concurrently.
+
+    Jobs are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+    workers can share the queue without claiming the same jobs. On backends
+    without row locks, such as SQLite, run a single worker.
+
+    A job which timed out is not retried, as its label may have been
+    generated: it fails, unless the retry policy of the client retries
+    timeouts. For the same reason, a job still running once its lease
+    expired, its worker having died or stalled, fails when claimed again
+    instead of being issued a second time. The result cache does not help
+    there, as it only stores the labels of the calls which succeeded.
+
+    Args:
+        client (SoColissimoClient, optional): Defaults to a client configured
+            by the settings.
+        batch_size (int, optional): Defaults to the
+            SOCOLISSIMO_WORKER_BATCH_SIZE setting.
+        max_workers (int, optional): Number of concurrent calls to the
+            webservice. Defaults to the SOCOLISSIMO_WORKER_MAX_WORKERS
+            setting.
+        max_attempts (int, optional): Defaults to the
+            SOCOLISSIMO_WORKER_MAX_ATTEMPTS setting.
+        retry_delay (float, optional): Defaults to the
+            SOCOLISSIMO_WORKER_RETRY_DELAY setting.
+        lease (float, optional): Defaults to the SOCOLISSIMO_WORKER_LEASE
+            setting.
+    """
+
+    def __init__(self, client=None, batch_size=None, max_workers=None,
+                 max_attempts=None, retry_delay=None, lease=None):
+        self.client = client or SoColissimoClient()
+        self.batch_size = _get_setting(batch_size,
+                                       'SOCOLISSIMO_WORKER_BATCH_SIZE',
+                                       DEFAULT_BATCH_SIZE)
+        self.max_workers = _get_setting(max_workers,
+                                        'SOCOLISSIMO_WORKER_MAX_WORKERS',
+                                        DEFAULT_MAX_WORKERS)
+        self.max_attempts = _get_setting(max_attempts,
+                                         'SOCOLISSIMO_WORKER_MAX_ATTEMPTS',
+                                         DEFAULT_MAX_ATTEMPTS)
+        self.retry_delay = _get_setting(retry_delay,
+                                        'SOCOLISSIMO_WORKER_RETRY_DELAY',
+                                        DEFAULT_RETRY_DELAY)
+        self.lease = _get_setting(lease, 'SOCOLISSIMO_WORKER_LEASE',
+                                  DEFAULT_LEASE)
+
+    def claim(self):
+        """Claim a batch of jobs, marking them RUNNING.
+
+        The claimable jobs still RUNNING, whose lease expired, are marked
+        FAILED instead, as their letter may have been issued.
+
+        Returns:
+            The list of LabelJob claimed, possibly empty.
+        """
+        with transaction.atomic():
+            claimable = list(LabelJob.objects.claimable(self.lease)
+                             .select_for_update(skip_locked=True)
+                             .order_by('run_after', 'id')[:self.batch_size])
+            if not claimable:
+                return []
+            now = timezone.now()
+            jobs = [job for job in claimable
+                    if job.status != LabelJob.RUNNING]
+            LabelJob.objects.filter(
+                pk__in=[job.pk for job in claimable
+                        if job.status == LabelJob.RUNNING]).update(
+                status=LabelJob.FAILED, error=EXPIRED_LEASE_ERROR,
+                updated_at=now)
+            LabelJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+                status=LabelJob.RUNNING, claimed_at=now,
+                attempts=F('attempts') + 1, updated_at=now)
+        for job in jobs:
+            job.status = LabelJob.RUNNING
+            job.claimed_at = now
+            job.attempts += 1
+        return jobs
+
+    def process(self, jobs):
+        """Generate the labels of claimed jobs and record the outcomes."""
+        outcomes = self.client.get_letters([job.payload for job in jobs],
+                                           max_workers=self.max_workers)
+        for job, outcome in zip(jobs, outcomes):
+            self.record(job, outcome)
+
+    def record(self, job, outcome):
+        """Record the outcome of a job: its label, or the error raised."""
+        if not isinstance(outcome, Exception):
+            job.status = LabelJob.DONE
+            job.parcel_number, job.pdf_url = outcome
+            job.error = ''
+        elif isinstance(outcome, ServiceTimeout) \
+                and not self.client.retry_policy.retry_timeouts:
+            # The label may exist, retrying could pay for a second parcel.
+            job.status = LabelJob.FAILED
+            job.error = ('Timed out, the label may have been generated, '
+                         'check before enqueueing it again : {}'.format(
+                             outcome))
+        elif isinstance(outcome, TRANSIENT_ERRORS) \
+                and job.attempts < self.max_attempts:
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            job.status = LabelJob.PENDING
+            job.run_after = timezone.now() + datetime.timedelta(
+                seconds=random.uniform(delay / 2, delay))
+            job.error = str(outcome)
+        else:
+            job.status = LabelJob.FAILED
+            job.error = str(outcome)
+        job.save(update_fields=['status', 'parcel_number', 'pdf_url',
+                                'error', 'run_after', 'updated_at'])
+
+    def run_once(self):
+        """Claim and process a batch of jobs.
+
+        Returns:
+            The number of jobs processed.
+        """
+        jobs = self.claim()
+        if jobs:
+            self.process(jobs)
+        return len(jobs)
+
+    def run(self, poll_interval=DEFAULT_POLL_INTERVAL, stop_event=None):
+        """Process the jobs until stopped, polling the queue when empty.
+
+        Args:
+            poll_interval (float, optional): Seconds between two polls of an
+                empty queue.
+            stop_event (threading.Event, optional): Stop when set.
+        """
+        if stop_event is None:
+            stop_event = threading.Event()
+        while not stop_event.is_set():
+            if not self.run_once():
+                stop_event.wait(poll_interval)
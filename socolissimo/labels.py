@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""Download of the PDF labels generated by the web service SoColissimo."""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from django.conf import settings
+from django.core.files import File
+
+from socolissimo.transport import get_session, get_timeout
+
+
+# Size of the chunks the labels are streamed by, in bytes.
+CHUNK_SIZE = 64 * 1024
+# Default maximum size of the label cache, in bytes.
+DEFAULT_LABEL_CACHE_MAX_SIZE = 500 * 1024 * 1024
+# Seconds after which the label cache directory is scanned again, to account
+# for the labels added or removed by other processes.
+LABEL_CACHE_SCAN_INTERVAL = 60
+# Share of the maximum size the label cache is trimmed down to by an eviction,
+# so that the next downloads do not scan the directory again at once.
+LABEL_CACHE_LOW_WATER = 0.9
+# Default number of concurrent downloads.
+DEFAULT_MAX_WORKERS = 10
+
+
+def download_label(pdf_url, path):
+    """Stream a PDF label to a file, by chunks.
+
+    The file is written under a temporary name first, so a partial download
+    never shows up at path.
+
+    Raises:
+        requests.RequestException: The download failed.
+    """
+    response = get_session().get(pdf_url, stream=True, timeout=get_timeout())
+    try:
+        response.raise_for_status()
+        descriptor, temp_path = tempfile.mkstemp(
+            suffix='.part', dir=os.path.dirname(path) or None)
+        try:
+            with os.fdopen(descriptor, 'wb') as label_file:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    label_file.write(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    finally:
+        response.close()
+    os.replace(temp_path, path)
+    return path
+
+
+class LabelCache(object):
+    """
+    Local cache of the PDF labels, keyed by parcel number.
+
+    A label never changes once generated, so reprints are served from the
+    cache without network access. Once the cache grows over max_size, the
+    least recently used labels are evicted down to LABEL_CACHE_LOW_WATER of
+    max_size.
+
+    The size of the cache is tracked as labels are downloaded, so the
+    directory is only scanned when the size crosses max_size, or every
+    LABEL_CACHE_SCAN_INTERVAL seconds, when other processes may share the
+    directory. Trimming below max_size spreads the scans of a full cache
+    over many downloads.
+
+    Args:
+        location (str): The cache directory.
+        max_size (int, optional): Maximum size of the cache, in bytes.
+    """
+
+    def __init__(self, location, max_size=DEFAULT_LABEL_CACHE_MAX_SIZE):
+        self.location = location
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = None
+        self._scanned_at = None
+        if not os.path.isdir(location):
+            os.makedirs(location)
+
+    def path(self, key):
+        """Return the path of a cached label."""
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.location, '{}.pdf'.format(name))
+
+    def get(self, key):
+        """Return the path of a cached label, or None if not cached."""
+        path = self.path(key)
+        try:
+            # The modification time tracks the last use, for eviction.
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def fetch(self, key, pdf_url):
+        """Return the path of a label, downloading it if not cached.
+
+        Raises:
+            requests.RequestException: The download failed.
+        """
+        path = self.get(key)
+        if path is None:
+            path = download_label(pdf_url, self.path(key))
+            self._add(path)
+        return path
+
+    def _add(self, path):
+        """Count a downloaded label in the size of the cache, evicting labels
+        when the size crosses max_size or the last scan is too old."""
+        size = os.path.getsize(path)
+        with self._lock:
+            if self._size is not None \
+                    and self._size + size <= self.max_size \
+                    and time.monotonic() - self._scanned_at \
+                    < LABEL_CACHE_SCAN_INTERVAL:
+                self._size += size
+                return
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Remove the least recently used labels, down to the low-water mark,
+        when the cache is over its maximum size.
+
+        Args:
+            keep (str, optional): The path of a label not to evict.
+        """
+        with self._lock:
+            entries = []
+            total_size = 0
+            for name in os.listdir(self.location):
+                if not name.endswith('.pdf'):
+                    continue
+                path = os.path.join(self.location, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+            entries.sort()
+            target_size = total_size
+            if total_size > self.max_size:
+                target_size = self.max_size * LABEL_CACHE_LOW_WATER
+            for _, size, path in entries:
+                if total_size <= target_size:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total_size -= size
+            self._size = total_size
+            self._scanned_at = time.monotonic()
+
+
+_LABEL_CACHE = None
+
+
+def get_label_cache():
+    """Return the label cache configured in the settings.
+
+    The cache lives in the SOCOLISSIMO_LABEL_CACHE_DIR directory, bounded to
+    SOCOLISSIMO_LABEL_CACHE_MAX_SIZE bytes. Returns None when no directory
+    is configured.
+    """
+    global _LABEL_CACHE  # pylint: disable=W0603
+    location = getattr(settings, 'SOCOLISSIMO_LABEL_CACHE_DIR', None)
+    if location is None:
+        return None
+    max_size = getattr(settings, 'SOCOLISSIMO_LABEL_CACHE_MAX_SIZE',
+                       DEFAULT_LABEL_CACHE_MAX_SIZE)
+    if _LABEL_CACHE is None or _LABEL_CACHE.location != location \
+            or _LABEL_CACHE.max_size != max_size:
+        _LABEL_CACHE = LabelCache(location, max_size)
+    return _LABEL_CACHE
+
+
+def _copy(source, dest, storage):
+    if storage is not None:
+        with open(source, 'rb') as label_file:
+            return storage.save(dest, File(label_file))
+    shutil.copyfile(source, dest)
+    return dest
+
+
+def fetch_label(pdf_url, dest, parcel_number=None, storage=None,
+                use_cache=True):
+    """Download a PDF label, streaming it by chunks.
+
+    Labels go through the label cache, when configured, so the same label is
+    only downloaded once.
+
+    Args:
+        pdf_url (str): The PDF URL returned by get_letter.
+        dest (str): The destination path, or the destination name in the
+            storage.
+        parcel_number (str, optional): The parcel number of the label, used
+            as cache key. Defaults to pdf_url.
+        storage (django Storage, optional): Storage to save the label into,
+            instead of the local disk.
+        use_cache (bool, optional): Whether to go through the label cache.
+
+    Returns:
+        The destination path, or the name the label was saved as in the
+        storage.
+
+    Raises:
+        requests.RequestException: The download failed.
+    """
+    cache = get_label_cache() if use_cache else None
+    if cache is not None:
+        source = cache.fetch(parcel_number or pdf_url, pdf_url)
+        return _copy(source, dest, storage)
+
+    if storage is None:
+        return download_label(pdf_url, dest)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        source = download_label(pdf_url, os.path.join(temp_dir, 'label.pdf'))
+        return _copy(source, dest, storage)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def fetch_labels(labels, directory, storage=None,
+                 max_workers=DEFAULT_MAX_WORKERS, use_cache=True):
+    """Download several PDF labels concurrently.
+
+    Each label is saved as <parcel_number>.pdf in the directory.
+
+    Args:
+        labels (iterable): (parcel_number, pdf_url) tuples, as returned by
+            get_letter.
+        directory (str): The destination directory, or the destination
+            directory in the storage.
+        storage (django Storage, optional): Storage to save the labels into,
+            instead of the local disk.
+        max_workers (int, optional): Maximum number of concurrent downloads.
+        use_cache (bool, optional): Whether to go through the label cache.
+
+    Returns:
+        A list with one outcome per label, in input order. Each outcome is
+        either the destination of the label, as returned by fetch_label, or
+        the exception raised while downloading it.
+    """
+    def fetch_label_outcome(label):
+        parcel_number, pdf_url = label
+        dest = os.path.join(directory, '{}.pdf'.format(parcel_number))
+        try:
+            return fetch_label(pdf_url, dest, parcel_number, storage,
+                               use_cache)
+        except (requests.RequestException, OSError) as exc:
+            return exc
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_label_outcome, label)
+                   for label in labels]
+    return [future.result() for future in futures]
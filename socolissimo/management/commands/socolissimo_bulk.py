@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Generate the labels of a CSV or JSONL file of shipments."""
+import io
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from socolissimo.accounts import get_account_registry
+from socolissimo.bulk import (FORMATS, Checkpoint, guess_format, read_records,
+                              run_bulk)
+from socolissimo.client import DEFAULT_MAX_WORKERS, SoColissimoClient
+from socolissimo.exceptions import UnknownAccount
+
+
+class Command(BaseCommand):
+    """Generate the labels of a file of shipments, resuming interrupted runs.
+    """
+
+    help = ('Generate the labels of a CSV or JSONL file of shipments, '
+            'writing the outcomes as JSON lines as they complete. Records '
+            'which got a label are saved to a checkpoint, so running the '
+            'command again resumes an interrupted run. Records whose call '
+            'timed out are skipped too, unless --retry-unknown.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='The shipments, as CSV or JSONL.')
+        parser.add_argument(
+            '--format', choices=FORMATS,
+            help='Format of the file. Defaults to its extension.')
+        parser.add_argument(
+            '--output',
+            help='Where the outcomes are appended. Defaults to the file name '
+                 'followed by .results.jsonl.')
+        parser.add_argument(
+            '--checkpoint',
+            help='Where the records which got a label are saved. Defaults to '
+                 'the output name followed by .checkpoint.')
+        parser.add_argument(
+            '--mapping',
+            help='JSON file of the paths of the columns in the letter, such '
+                 'as {"City": "recipient.addressVO.city"}. Defaults to '
+                 'columns named by their path.')
+        parser.add_argument(
+            '--id-column',
+            help='Column identifying the records. Defaults to their position '
+                 'in the file.')
+        parser.add_argument('--delimiter', default=',',
+                            help='Delimiter of the CSV columns.')
+        parser.add_argument('--max-workers', type=int,
+                            default=DEFAULT_MAX_WORKERS,
+                            help='Maximum number of concurrent calls.')
+        parser.add_argument(
+            '--retry-unknown', action='store_true',
+            help='Issue again the records whose call timed out, which may '
+                 'have got a label. Check they did not before.')
+        parser.add_argument(
+            '--account',
+            help='Account of the SOCOLISSIMO_ACCOUNTS setting issuing the '
+                 'labels. Defaults to the SOCOLISSIMO_CONTRACT_NUMBER and '
+                 'SOCOLISSIMO_PASSWORD settings.')
+
+    def handle(self, *args, **options):
+        path = options['file']
+        output_path = options['output'] or '{}.results.jsonl'.format(path)
+        checkpoint_path = options['checkpoint'] \
+            or '{}.checkpoint'.format(output_path)
+        try:
+            file_format = options['format'] or guess_format(path)
+            mapping = None
+            if options['mapping']:
+                with io.open(options['mapping'],
+                             encoding='utf-8') as mapping_file:
+                    mapping = json.load(mapping_file)
+            if options['account']:
+                client = get_account_registry().get(options['account'])
+            else:
+                client = SoColissimoClient()
+        except (OSError, ValueError, UnknownAccount) as exc:
+            raise CommandError(str(exc))
+
+        checkpoint = Checkpoint(checkpoint_path)
+        if checkpoint.done:
+            self.stdout.write('Resuming, {} records already have a '
+                              'label'.format(len(checkpoint.done)))
+        if checkpoint.unknown:
+            self.stdout.write(
+                '{} records timed out and may have a label, {}'.format(
+                    len(checkpoint.unknown),
+                    'retrying them' if options['retry_unknown']
+                    else 'skipping them'))
+        try:
+            with io.open(path, encoding='utf-8-sig', newline='') as source, \
+                    io.open(output_path, 'a', encoding='utf-8') as output:
+                records = read_records(source, file_format, mapping,
+                                       options['id_column'],
+                                       options['delimiter'])
+                counts = run_bulk(client, records, output, checkpoint,
+                                  max_workers=options['max_workers'],
+                                  retry_unknown=options['retry_unknown'])
+        except (OSError, ValueError, KeyError) as exc:
+            raise CommandError('Could not read {} : {}'.format(path, exc))
+        finally:
+            checkpoint.close()
+
+        self.stdout.write(
+            '{ok} labels generated, {failed} failed, {unknown} timed out, '
+            '{skipped} skipped as already done or unknown. Outcomes written '
+            'to {output}'.format(
+                output=output_path, **counts))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Compile the postal index from the La Poste postal codes dataset."""
+import io
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from socolissimo.postal import (PACKAGED_POSTAL_INDEX, read_laposte_dataset,
+                                write_index)
+from socolissimo.schema import Address
+
+
+class Command(BaseCommand):
+    """Compile the postal index checking the addresses."""
+
+    help = ('Compile the index of the postal codes and cities checking the '
+            'addresses, from the La Poste postal codes dataset (base '
+            'officielle des codes postaux), as CSV.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='The La Poste dataset, as CSV.')
+        parser.add_argument(
+            '--output', default=PACKAGED_POSTAL_INDEX,
+            help='The index file, gzipped if its name ends with .gz, to set '
+                 'as the SOCOLISSIMO_POSTAL_INDEX setting. Defaults to the '
+                 'index shipped within the package.')
+
+    def handle(self, *args, **options):
+        countries = [country for country, _ in Address.COUNTRIES]
+        directory = os.path.dirname(options['output'])
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with io.open(options['source'], encoding='utf-8-sig',
+                         newline='') as source:
+                count = write_index(read_laposte_dataset(source, countries),
+                                    options['output'])
+        except (OSError, KeyError, ValueError) as exc:
+            raise CommandError('Could not compile {} : {}'.format(
+                options['source'], exc))
+        self.stdout.write('{} cities written to {}'.format(
+            count, options['output']))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Refresh the persistent cache of the SoColissimo WSDL."""
+import os
+import re
+from urllib.parse import urljoin
+from xml.sax.saxutils import escape, unescape
+
+import requests
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from socolissimo.client import (WSDL_URL, create_soap_client,
+                                get_wsdl_cache, get_wsdl_snapshot_path)
+
+
+# Timeout of the WSDL download, in seconds.
+DOWNLOAD_TIMEOUT = 60
+
+# Elements of the WSDL and the schemas importing other documents.
+IMPORT_ELEMENT = re.compile(br'<(?:[\w.-]+:)?(?:import|include)\b[^>]*>')
+# Attribute of these elements locating the imported document.
+LOCATION_ATTRIBUTE = re.compile(
+    br'''(\b(?:schemaLocation|location)\s*=\s*)(["'])(.*?)\2''')
+
+
+def download(url):
+    """Return the content of a document of the webservice.
+
+    Raises:
+        CommandError: The document could not be downloaded.
+    """
+    try:
+        response = requests.get(url, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as exc:
+        raise CommandError('Could not download {} : {}'.format(url, exc))
+    return response.content
+
+
+def snapshot_documents(url, name):
+    """Download the WSDL and the schemas it imports, recursively.
+
+    The imports are rewritten to locate the schemas next to the WSDL, so the
+    snapshot is parsed without any network access.
+
+    Args:
+        url (str): The URL of the WSDL.
+        name (str): The file name of the WSDL in the snapshot.
+
+    Returns:
+        A dict of the contents of the documents, by file name.
+    """
+    names = {url: name}
+    documents = {}
+
+    def add(document_url):
+        content = download(document_url)
+
+        def localize(match):
+            location = urljoin(document_url,
+                               unescape(match.group(3).decode('utf-8')))
+            if location not in names:
+                names[location] = 'schema{}.xsd'.format(len(names))
+                add(location)
+            return b''.join((match.group(1), match.group(2),
+                             escape(names[location]).encode('utf-8'),
+                             match.group(2)))
+
+        documents[names[document_url]] = IMPORT_ELEMENT.sub(
+            lambda element: LOCATION_ATTRIBUTE.sub(localize, element.group(0)),
+            content)
+
+    add(url)
+    return documents
+
+
+class Command(BaseCommand):
+    """Refresh the parsed WSDL cache, and optionally the WSDL snapshot."""
+
+    help = ('Download and parse the SoColissimo WSDL into the persistent '
+            'cache, so workers can build the soap client from local disk.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--snapshot', action='store_true',
+            help='Also download the WSDL and its schemas into the directory '
+                 'of the SOCOLISSIMO_WSDL_SNAPSHOT_DIR setting, used when '
+                 'SOCOLISSIMO_USE_BUNDLED_WSDL is set.')
+
+    def handle(self, *args, **options):
+        if options['snapshot']:
+            self.write_snapshot()
+
+        cache = get_wsdl_cache()
+        cache.clear()
+        create_soap_client()
+        self.stdout.write('WSDL cache refreshed in {}'.format(cache.location))
+
+    def write_snapshot(self):
+        """Download the WSDL of the webservice and its schemas into the
+        snapshot directory."""
+        url = getattr(settings, 'SOCOLISSIMO_WSDL_URL', WSDL_URL)
+        path = get_wsdl_snapshot_path()
+        directory, wsdl_name = os.path.split(path)
+        documents = snapshot_documents(url, wsdl_name)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # The WSDL last, so it never imports a missing schema.
+        for name in sorted(documents, key=lambda name: name == wsdl_name):
+            document_path = os.path.join(directory, name)
+            temp_path = '{}.tmp'.format(document_path)
+            with open(temp_path, 'wb') as snapshot:
+                snapshot.write(documents[name])
+            os.rename(temp_path, document_path)
+        self.stdout.write('WSDL snapshot written to {}, with {} schemas'.format(
+            path, len(documents) - 1))
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""Timings and counters of the calls to the web service SoColissimo.
+
+Metrics are handed to the sinks added with add_sink. Without any sink,
+instrumented code only pays for a check of the sinks list.
+"""
+import bisect
+import threading
+import time
+
+
+# Duration of each phase of a call, in seconds, by phase and engine.
+PHASE_METRIC = 'socolissimo_phase_seconds'
+# Calls to the webservice, by outcome: ok, error or transient.
+CALLS_METRIC = 'socolissimo_calls_total'
+# Errors returned by the webservice, by errorID.
+ERRORS_METRIC = 'socolissimo_errors_total'
+
+# Phases of a call.
+PHASE_VALIDATE = 'validate'
+PHASE_BUILD = 'build'
+PHASE_MARSHAL = 'marshal'
+PHASE_NETWORK = 'network'
+PHASE_PARSE = 'parse'
+
+# Default upper bounds of the histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30)
+
+_SINKS = ()
+_SINKS_LOCK = threading.Lock()
+_MARKS = threading.local()
+
+
+class MetricsSink(object):
+    """Receiver of the metrics, to subclass.
+
+    Metrics are identified by a name and labels, passed as keyword
+    arguments. The methods are called from the threads making the calls, so
+    they must be thread safe and fast.
+    """
+
+    def observe(self, name, value, **labels):
+        """Record a value of a histogram, such as a duration."""
+        pass
+
+    def increment(self, name, value=1, **labels):
+        """Increment a counter."""
+        pass
+
+
+def add_sink(sink):
+    """Start sending the metrics to a MetricsSink."""
+    global _SINKS  # pylint: disable=W0603
+    with _SINKS_LOCK:
+        if sink not in _SINKS:
+            _SINKS = _SINKS + (sink,)
+
+
+def remove_sink(sink):
+    """Stop sending the metrics to a MetricsSink."""
+    global _SINKS  # pylint: disable=W0603
+    with _SINKS_LOCK:
+        _SINKS = tuple(item for item in _SINKS if item is not sink)
+
+
+def is_enabled():
+    """Tell if any sink receives the metrics."""
+    return bool(_SINKS)
+
+
+def observe(name, value, **labels):
+    """Record a value of a histogram in every sink."""
+    for sink in _SINKS:
+        sink.observe(name, value, **labels)
+
+
+def increment(name, value=1, **labels):
+    """Increment a counter in every sink."""
+    for sink in _SINKS:
+        sink.increment(name, value, **labels)
+
+
+class _NullTimer(object):
+    """Timer doing nothing, when no sink is added."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _PhaseTimer(object):
+    """Time a phase of a call."""
+
+    __slots__ = ('phase', 'engine', 'start')
+
+    def __init__(self, phase, engine):
+        self.phase = phase
+        self.engine = engine
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(PHASE_METRIC, time.monotonic() - self.start,
+                phase=self.phase, engine=self.engine)
+        return False
+
+
+def time_phase(phase, engine):
+    """Return a context manager timing a phase of a call.
+
+    Args:
+        phase (str): One of the PHASE_* constants.
+        engine (str): The engine of the client making the call.
+    """
+    if not _SINKS:
+        return _NULL_TIMER
+    return _PhaseTimer(phase, engine)
+
+
+def mark_sending():
+    """Mark the end of the marshalling of the current suds call."""
+    _MARKS.sending = time.monotonic()
+
+
+def mark_received():
+    """Mark the end of the network round trip of the current suds call."""
+    _MARKS.received = time.monotonic()
+
+
+class _SoapCallTimer(object):
+    """Time the phases of a call through suds, with the marks of the
+    transport.TimingPlugin."""
+
+    __slots__ = ('engine', 'start')
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.start = None
+
+    def __enter__(self):
+        _MARKS.sending = _MARKS.received = None
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.monotonic()
+        sending = _MARKS.sending
+        received = _MARKS.received
+        if sending is None:
+            observe(PHASE_METRIC, end - self.start, phase=PHASE_MARSHAL,
+                    engine=self.engine)
+            return False
+        observe(PHASE_METRIC, sending - self.start, phase=PHASE_MARSHAL,
+                engine=self.engine)
+        if received is None:
+            observe(PHASE_METRIC, end - sending, phase=PHASE_NETWORK,
+                    engine=self.engine)
+            return False
+        observe(PHASE_METRIC, received - sending, phase=PHASE_NETWORK,
+                engine=self.engine)
+        observe(PHASE_METRIC, end - received, phase=PHASE_PARSE,
+                engine=self.engine)
+        return False
+
+
+def time_soap_call(engine):
+    """Return a context manager timing a call through a suds client.
+
+    The suds client must have the transport.TimingPlugin installed.
+    """
+    if not _SINKS:
+        return _NULL_TIMER
+    return _SoapCallTimer(engine)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels))
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class HistogramSink(MetricsSink):
+    """
+    Aggregate the metrics in memory, as cumulative histograms and counters.
+
+    Args:
+        buckets (tuple, optional): Upper bounds of the histogram buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, value, **labels):
+        """Record a value of a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'sum': 0,
+                    'count': 0,
+                }
+            histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def increment(self, name, value=1, **labels):
+        """Increment a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def histogram(self, name, **labels):
+        """Return the count, sum and cumulative buckets of a histogram.
+
+        Returns:
+            A dict with the count and sum of the values, and the buckets as a
+            list of (upper bound, count) tuples, None if nothing was recorded.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                return None
+            counts = list(histogram['buckets'])
+            result = {'count': histogram['count'], 'sum': histogram['sum']}
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        result['buckets'] = buckets
+        return result
+
+    def counter(self, name, **labels):
+        """Return the value of a counter."""
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))),
+                                      0)
+
+    def reset(self):
+        """Forget every metric recorded."""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render_prometheus(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = sorted(
+                (key, list(value['buckets']), value['sum'], value['count'])
+                for key, value in self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        lines = []
+        last_name = None
+        for (name, labels), counts, total, count in histograms:
+            if name != last_name:
+                lines.append('# TYPE {} histogram'.format(name))
+                last_name = name
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels),
+                                              _format_value(total)))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels),
+                                                count))
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append('# TYPE {} counter'.format(name))
+                last_name = name
+            lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                          _format_value(value)))
+        return ''.join('{}\n'.format(line) for line in lines)
+
+
+# Histogram sink of the process, added by enable_histogram.
+HISTOGRAM = HistogramSink()
+
+
+def enable_histogram():
+    """Aggregate the metrics in the HISTOGRAM sink of the process.
+
+    Returns:
+        The HISTOGRAM sink.
+    """
+    add_sink(HISTOGRAM)
+    return HISTOGRAM
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Batches of letters prepared in a process pool and sent in a thread pool.
+
+Validating and marshalling a letter is CPU work, bound by the GIL when done
+in threads, while sending it is mostly waiting on the network. The pipeline
+runs the first stage, SoColissimoClient.prepare_letter, in a pool of
+processes, and the second one, SoColissimoClient.send_prepared, in a pool of
+threads.
+
+The processes run with the settings of the parent process: with the spawn
+or forkserver start methods, the settings must come from the
+DJANGO_SETTINGS_MODULE environment variable. Their metrics go to the sinks
+of the processes, not of the parent.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import django
+from django.apps import apps
+
+from socolissimo.client import DEFAULT_MAX_WORKERS, SoColissimoClient
+from socolissimo.exceptions import SoColissimoException
+from socolissimo.schema import SchemaValidationError
+
+
+# Expected errors, returned as the outcome of their letter.
+LETTER_ERRORS = (SoColissimoException, SchemaValidationError)
+
+# Clients preparing the letters in a process, by credentials and engine.
+_PROCESS_CLIENTS = {}
+
+
+def _init_process():
+    """Set django up in a started process, unless inherited by fork."""
+    if not apps.ready:
+        django.setup()
+
+
+def _prepare_letter(client_options, letter):
+    """Prepare a letter in a process of the pool."""
+    client = _PROCESS_CLIENTS.get(client_options)
+    if client is None:
+        contract_number, password, engine = client_options
+        client = SoColissimoClient(contract_number, password, engine,
+                                   use_result_cache=False)
+        _PROCESS_CLIENTS[client_options] = client
+    return client.prepare_letter(**letter)
+
+
+class LetterPipeline(object):
+    """
+    Generate labels, preparing the letters in processes and sending them in
+    threads.
+
+    The letters move through the two stages with backpressure: at most
+    max_pending letters are read and not yet sent, so a slow webservice
+    holds the preparation back instead of queueing prepared letters in
+    memory.
+
+    Args:
+        client (SoColissimoClient): The client sending the letters. Its
+            credentials and engine prepare them.
+        processes (int, optional): Number of processes preparing the letters.
+            Defaults to the number of CPUs.
+        max_workers (int, optional): Maximum number of concurrent calls to
+            the webservice.
+        max_pending (int, optional): Maximum number of letters read and not
+            yet sent. Defaults to twice the number of processes and workers.
+    """
+
+    def __init__(self, client, processes=None, max_workers=DEFAULT_MAX_WORKERS,
+                 max_pending=None):
+        self.client = client
+        self.processes = processes or os.cpu_count() or 1
+        self.max_workers = max_workers
+        if max_pending is None:
+            max_pending = 2 * (self.processes + max_workers)
+        self.max_pending = max_pending
+
+    def get_letters(self, letters):
+        """Generate several labels, see SoColissimoClient.get_letters.
+
+        Returns:
+            A list with one outcome per letter, in input order. Each outcome
+            is either a tuple (parcel_number, pdf_url), or the
+            SoColissimoException or SchemaValidationError raised for this
+            letter.
+        """
+        client_options = (self.client.contract_number, self.client.password,
+                          self.client.engine)
+        slots = threading.BoundedSemaphore(self.max_pending)
+        outcomes = []
+
+        # The process pool shuts down first, once every prepared letter is
+        # handed to the thread pool.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as threads, \
+                ProcessPoolExecutor(max_workers=self.processes,
+                                    initializer=_init_process) as processes:
+            for index, letter in enumerate(letters):
+                slots.acquire()
+                outcomes.append(None)
+                future = processes.submit(_prepare_letter, client_options,
+                                          letter)
+                future.add_done_callback(partial(
+                    self._prepared, threads, slots, outcomes, index))
+
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException) \
+                    and not isinstance(outcome, LETTER_ERRORS):
+                raise outcome
+        return outcomes
+
+    def _prepared(self, threads, slots, outcomes, index, future):
+        """Hand a prepared letter to the thread pool."""
+        try:
+            prepared = future.result()
+            threads.submit(self._send, slots, outcomes, index, prepared)
+        except BaseException as exc:  # pylint: disable=W0703
+            outcomes[index] = exc
+            slots.release()
+
+    def _send(self, slots, outcomes, index, prepared):
+        """Send a prepared letter, in the thread pool."""
+        try:
+            outcomes[index] = self.client.send_prepared(prepared)
+        except BaseException as exc:  # pylint: disable=W0703
+            outcomes[index] = exc
+        finally:
+            slots.release()
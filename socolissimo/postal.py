@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Index of the postal codes and cities, to check addresses before calling
+the web service SoColissimo.
+
+The index is compiled from the La Poste postal codes dataset, see the
+socolissimo_compile_postal_index command, and shipped within the package as
+PACKAGED_POSTAL_INDEX. The SOCOLISSIMO_POSTAL_INDEX setting gives another
+index, such as one compiled from a newer dataset. Its file holds one line per
+city:
+
+    country<TAB>postal code<TAB>city[<TAB>other name...]
+
+where the city is the spelling expected on the labels, and the other names
+are also accepted, such as the name of the municipality.
+"""
+import csv
+import difflib
+import gzip
+import io
+import os
+import re
+import threading
+import unicodedata
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+# Columns of the La Poste dataset.
+LAPOSTE_POSTAL_CODE = 'Code_postal'
+LAPOSTE_ROUTING_LABEL = 'Libellé_d_acheminement'
+LAPOSTE_CITY_NAMES = ('Nom_de_la_commune', 'Nom_commune', 'Ligne_5')
+# Postal codes of Monaco, within the La Poste dataset.
+MONACO_POSTAL_CODE_PREFIX = '980'
+# Index compiled at release time and shipped as package data.
+PACKAGED_POSTAL_INDEX = os.path.join(os.path.dirname(__file__), 'data',
+                                     'postal_codes.tsv.gz')
+
+_SEPARATORS = re.compile(r"[\s\-'’]+")
+_ABBREVIATIONS = ((re.compile(r'\bSAINTE\b'), 'STE'),
+                  (re.compile(r'\bSAINT\b'), 'ST'))
+
+
+def normalize_city(name):
+    """Return the comparable form of a city name: upper case, without
+    accents and punctuation, with the usual abbreviations."""
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    name = _SEPARATORS.sub(' ', name.upper()).strip()
+    for pattern, abbreviation in _ABBREVIATIONS:
+        name = pattern.sub(abbreviation, name)
+    return name
+
+
+def _open(path, mode, gzipped=None):
+    if gzipped is None:
+        gzipped = path.endswith('.gz')
+    if gzipped:
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return io.open(path, mode, encoding='utf-8')
+
+
+class PostalIndex(object):
+    """
+    Cities of each postal code, by country.
+
+    Args:
+        cities (iterable): The (country, postal code, city, other names)
+            tuples of the index.
+    """
+
+    def __init__(self, cities):
+        self._index = {}
+        for country, postal_code, city, other_names in cities:
+            names = self._index.setdefault((country, postal_code), {})
+            for name in (city,) + tuple(other_names):
+                names.setdefault(normalize_city(name), city)
+        self.countries = frozenset(country for country, _ in self._index)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index file, gzipped if its name ends with .gz."""
+        with _open(path, 'r') as index_file:
+            return cls(
+                (fields[0], fields[1], fields[2], tuple(fields[3:]))
+                for fields in (line.rstrip('\n').split('\t')
+                               for line in index_file)
+                if len(fields) >= 3)
+
+    def __len__(self):
+        return len(self._index)
+
+    def cities(self, country, postal_code):
+        """Return the sorted cities of a postal code, empty if unknown."""
+        return sorted(set(self._index.get((country, postal_code), {})
+                          .values()))
+
+    def canonical_city(self, country, postal_code, city):
+        """Return the spelling expected on the labels of a city, or None if
+        the city does not match the postal code."""
+        names = self._index.get((country, postal_code))
+        if names is None:
+            return None
+        return names.get(normalize_city(city))
+
+    def suggest(self, country, postal_code, city):
+        """Return the cities of a postal code closest to a misspelled city,
+        the closest first."""
+        names = self._index.get((country, postal_code), {})
+        matches = difflib.get_close_matches(normalize_city(city), names)
+        suggestions = []
+        for match in matches:
+            if names[match] not in suggestions:
+                suggestions.append(names[match])
+        return suggestions
+
+
+def read_laposte_dataset(source, countries):
+    """Read the cities of the La Poste postal codes dataset.
+
+    Args:
+        source (file): The dataset, as CSV with a header, separated by
+            semicolons.
+        countries (iterable): The country codes to keep, among FR and MC.
+
+    Yields:
+        The (country, postal code, city, other names) tuples, one per line of
+        the dataset.
+    """
+    countries = set(countries)
+    for row in csv.DictReader(source, delimiter=';'):
+        postal_code = row[LAPOSTE_POSTAL_CODE].strip().zfill(5)
+        country = 'MC' if postal_code.startswith(MONACO_POSTAL_CODE_PREFIX) \
+            else 'FR'
+        if country not in countries:
+            continue
+        city = row[LAPOSTE_ROUTING_LABEL].strip()
+        other_names = tuple(row[column].strip()
+                            for column in LAPOSTE_CITY_NAMES
+                            if row.get(column, '').strip())
+        yield country, postal_code, city, other_names
+
+
+def write_index(cities, path):
+    """Write an index file, merging the lines of the same city.
+
+    Only the other names which do not normalize like the city are kept, so
+    the index stays compact.
+
+    Returns:
+        The number of cities written.
+    """
+    merged = {}
+    for country, postal_code, city, other_names in cities:
+        names = merged.setdefault((country, postal_code, city), set())
+        names.update(name for name in other_names
+                     if normalize_city(name) != normalize_city(city))
+
+    temp_path = '{}.tmp'.format(path)
+    with _open(temp_path, 'w', path.endswith('.gz')) as index_file:
+        for key in sorted(merged):
+            other_names = sorted(set(normalize_city(name)
+                                     for name in merged[key]))
+            index_file.write('\t'.join(key + tuple(other_names)) + '\n')
+    os.rename(temp_path, path)
+    return len(merged)
+
+
+_POSTAL_INDEX = None
+_POSTAL_INDEX_PATH = None
+_POSTAL_INDEX_LOCK = threading.Lock()
+
+
+def get_postal_index():
+    """Return the index of the SOCOLISSIMO_POSTAL_INDEX setting, a path
+    loaded at first use, defaulting to the index shipped within the package.
+
+    Raises:
+        ImproperlyConfigured: The SOCOLISSIMO_POSTAL_INDEX setting is
+            missing and the package ships no index, such as a source
+            checkout.
+    """
+    global _POSTAL_INDEX, _POSTAL_INDEX_PATH  # pylint: disable=W0603
+    path = getattr(settings, 'SOCOLISSIMO_POSTAL_INDEX', None)
+    if not path:
+        if not os.path.exists(PACKAGED_POSTAL_INDEX):
+            raise ImproperlyConfigured(
+                'No postal index is shipped within the package, please set '
+                'SOCOLISSIMO_POSTAL_INDEX to the postal index compiled by '
+                '"manage.py socolissimo_compile_postal_index" to check the '
+                'addresses')
+        path = PACKAGED_POSTAL_INDEX
+    if _POSTAL_INDEX_PATH != path:
+        with _POSTAL_INDEX_LOCK:
+            if _POSTAL_INDEX_PATH != path:
+                _POSTAL_INDEX = PostalIndex.load(path)
+                _POSTAL_INDEX_PATH = path
+    return _POSTAL_INDEX
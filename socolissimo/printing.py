@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Assembly of print jobs merging many SoColissimo labels.
+
+Requires the pypdf library, installed with the "printing" extra.
+"""
+import itertools
+import os
+import shutil
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+
+from socolissimo.labels import DEFAULT_MAX_WORKERS, fetch_labels
+
+
+# Default number of labels merged in each print file.
+DEFAULT_LABELS_PER_FILE = 100
+# Size of an A4 sheet, in PDF points.
+A4_SIZE = (595.28, 841.89)
+# Name of the print files, numbered from 1.
+PRINT_FILE_NAME = 'print-job-{:04d}.pdf'
+
+
+def _import_pypdf():
+    try:
+        import pypdf
+    except ImportError:
+        raise ImproperlyConfigured(
+            'The pypdf library is required to merge labels, install it with '
+            '"pip install django-socolissimo[printing]"')
+    return pypdf
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def merge_labels(paths, dest, grid=(1, 1), sheet_size=A4_SIZE):
+    """Merge label PDFs into a single print file.
+
+    Args:
+        paths (list of str): The label PDFs, in print order.
+        dest (str): Path of the print file.
+        grid (tuple, optional): (columns, rows) of labels on each sheet. With
+            the default (1, 1), the label pages are kept as they are.
+            Otherwise each label is scaled to fit its cell on the sheet.
+        sheet_size (tuple, optional): (width, height) of the sheets, in PDF
+            points, when labels are laid out on a grid.
+
+    Raises:
+        ImproperlyConfigured: pypdf is not installed.
+    """
+    pypdf = _import_pypdf()
+    writer = pypdf.PdfWriter()
+    pages = (page for path in paths for page in pypdf.PdfReader(path).pages)
+
+    columns, rows = grid
+    labels_per_sheet = columns * rows
+    if labels_per_sheet == 1:
+        for page in pages:
+            writer.add_page(page)
+    else:
+        width, height = sheet_size
+        cell_width = width / columns
+        cell_height = height / rows
+        for index, page in enumerate(pages):
+            position = index % labels_per_sheet
+            if position == 0:
+                sheet = writer.add_blank_page(width, height)
+            box = page.mediabox
+            scale = min(cell_width / float(box.width),
+                        cell_height / float(box.height))
+            left = (position % columns) * cell_width \
+                + (cell_width - float(box.width) * scale) / 2 \
+                - float(box.left) * scale
+            bottom = height - (position // columns + 1) * cell_height \
+                + (cell_height - float(box.height) * scale) / 2 \
+                - float(box.bottom) * scale
+            sheet.merge_transformed_page(
+                page, pypdf.Transformation().scale(scale).translate(left,
+                                                                    bottom))
+
+    temp_path = '{}.part'.format(dest)
+    with open(temp_path, 'wb') as print_file:
+        writer.write(print_file)
+    os.replace(temp_path, dest)
+
+
+def iter_print_files(labels, directory,
+                     labels_per_file=DEFAULT_LABELS_PER_FILE, grid=(1, 1),
+                     sheet_size=A4_SIZE, max_workers=DEFAULT_MAX_WORKERS):
+    """Build print files merging a batch of labels, one file at a time.
+
+    The labels are downloaded and merged labels_per_file at a time, so the
+    memory used does not depend on the size of the batch. Each print file is
+    yielded as soon as it is written, so printing can start while the next
+    ones are being built.
+
+    Args:
+        labels (iterable): Results of get_letter, i.e. (parcel_number,
+            pdf_url) tuples. Exceptions, as found in the results of
+            get_letters, are skipped.
+        directory (str): Directory to write the print files into.
+        labels_per_file (int, optional): Maximum number of labels per file.
+        grid (tuple, optional): (columns, rows) of labels on each sheet, see
+            merge_labels.
+        sheet_size (tuple, optional): (width, height) of the sheets, in PDF
+            points, see merge_labels.
+        max_workers (int, optional): Maximum number of concurrent downloads.
+
+    Yields:
+        The paths of the print files, with the labels in input order.
+
+    Raises:
+        ImproperlyConfigured: pypdf is not installed.
+        requests.RequestException: A label could not be downloaded.
+    """
+    _import_pypdf()
+    labels = (label for label in labels if not isinstance(label, Exception))
+    for file_number, chunk in enumerate(_chunks(labels, labels_per_file), 1):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            paths = fetch_labels(chunk, temp_dir, max_workers=max_workers)
+            for path in paths:
+                if isinstance(path, Exception):
+                    raise path
+            dest = os.path.join(directory, PRINT_FILE_NAME.format(file_number))
+            merge_labels(paths, dest, grid, sheet_size)
+        finally:
+            shutil.rmtree(temp_dir)
+        yield dest
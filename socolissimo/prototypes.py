@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Prototypes of the suds type instances of the web service SoColissimo."""
+from suds.sudsobject import Object
+
+
+def clone_instance(value):
+    """Copy a suds object instance, and the instances and lists it holds.
+
+    The metadata of the instances, read only once built, are shared with the
+    copy.
+
+    Args:
+        value: A suds object, a list, or a plain value returned as is.
+    """
+    if isinstance(value, Object):
+        clone = value.__class__.__new__(value.__class__)
+        attributes = clone.__dict__
+        attributes.update(value.__dict__)
+        attributes['__keylist__'] = list(value.__keylist__)
+        for name in value.__keylist__:
+            attributes[name] = clone_instance(attributes[name])
+        return clone
+    if isinstance(value, list):
+        return [clone_instance(item) for item in value]
+    return value
+
+
+class TypePrototypes(object):
+    """
+    Instances of the WSDL complexTypes, created by cloning prototypes.
+
+    suds' factory.create walks the schema tree of the type on every call.
+    Each prototype is built with it once instead, with the constants of the
+    type applied, then cloned for each instance.
+
+    Args:
+        soap_client (suds.client.Client): Soap client holding the parsed WSDL.
+    """
+
+    def __init__(self, soap_client):
+        self.soap_client = soap_client
+        self._prototypes = {}
+
+    def create(self, type_name, constants=()):
+        """Create an instance of a complexType.
+
+        Args:
+            type_name (str): The name of the complexType, as in the WSDL.
+            constants (tuple, optional): The (name, value) pairs of the
+                constants of the instance, such as the ones enforced by the
+                SoColissimo specification.
+
+        Returns:
+            A new suds object instance.
+        """
+        key = (type_name, constants)
+        prototype = self._prototypes.get(key)
+        if prototype is None:
+            prototype = self.soap_client.factory.create(type_name)
+            for name, value in constants:
+                setattr(prototype, name, value)
+            # Concurrent builds are identical, keep the first one.
+            prototype = self._prototypes.setdefault(key, prototype)
+        return clone_instance(prototype)
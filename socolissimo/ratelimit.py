@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Rate limiting of the calls to the web service SoColissimo, shared by every
+process through the django cache."""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from socolissimo.exceptions import DeadlineExceeded, RateLimitExceeded
+from socolissimo.resilience import get_deadline
+
+
+# Prefix of the keys of the limiter state in the django cache.
+KEY_PREFIX = 'socolissimo:ratelimit'
+# Seconds a crashed process may hold the limiter lock.
+LOCK_TIMEOUT = 1
+# Seconds between two attempts to take the limiter lock.
+LOCK_RETRY_DELAY = 0.001
+# Seconds a call without max_wait nor deadline waits for the limiter lock.
+LOCK_MAX_WAIT = 5
+# Seconds the limiter state is kept once unused.
+STATE_TIMEOUT = 60 * 60
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the rate of the calls to the webservice.
+
+    The bucket holds up to burst tokens and refills at rate tokens per
+    second; each call takes a token. The bucket lives in a django cache, so
+    every process and host using the same cache shares it. Its updates are
+    serialized by a short lock taken with cache.add, waited for within the
+    max_wait or the deadline of the call, or LOCK_MAX_WAIT seconds without
+    them.
+
+    A call finding the bucket empty reserves the next token and sleeps until
+    it is due, so the waiting calls go out in order at the sustained rate.
+    As the bucket is shared across hosts, their clocks must be synchronized.
+
+    Args:
+        rate (float): Sustained rate, in calls per second.
+        burst (int, optional): Size of the bucket, the number of calls which
+            can go out at once. Defaults to rate, and at least 1.
+        cache_alias (str, optional): Name of the django cache holding the
+            bucket.
+        key (str, optional): Name of the bucket, for separate limits.
+        max_wait (float, optional): Seconds a call may wait for its token.
+            Defaults to waiting as long as the call deadline allows.
+    """
+
+    def __init__(self, rate, burst=None, cache_alias='default', key='default',
+                 max_wait=None):
+        if rate <= 0:
+            raise ValueError('The rate limit must be positive')
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(int(rate), 1)
+        self.cache_alias = cache_alias
+        self.max_wait = max_wait
+        self.state_key = '{}:{}'.format(KEY_PREFIX, key)
+        self.lock_key = '{}:lock'.format(self.state_key)
+
+    @property
+    def cache(self):
+        """The django cache, whose connections are per thread."""
+        return caches[self.cache_alias]
+
+    def acquire(self):
+        """Wait for a token.
+
+        Raises:
+            RateLimitExceeded: The token would come after max_wait.
+            DeadlineExceeded: The token would come after the deadline of the
+                current call.
+        """
+        wait = self.reserve(get_deadline(), self.max_wait)
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, deadline=None, max_wait=None):
+        """Reserve a token without waiting for it, such as to wait without
+        blocking an event loop.
+
+        The deadline of the current thread is not read, so the token can be
+        reserved from another thread, such as an executor of the event loop.
+
+        Args:
+            deadline (float, optional): The deadline of the call, as a
+                time.monotonic() value.
+            max_wait (float, optional): Seconds the call may wait for its
+                token. Defaults to no limit, but the deadline.
+
+        Returns:
+            The seconds to wait before the call.
+
+        Raises:
+            RateLimitExceeded: The token would come after max_wait.
+            DeadlineExceeded: The token would come after the deadline.
+        """
+        bounded_by_deadline = False
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+            if max_wait is None or remaining < max_wait:
+                max_wait = remaining
+                bounded_by_deadline = True
+
+        wait = self._reserve(max_wait)
+        if wait is None:
+            if bounded_by_deadline:
+                raise DeadlineExceeded(
+                    'The rate limit leaves no time for the call')
+            raise RateLimitExceeded('No call allowed within {}s'.format(
+                LOCK_MAX_WAIT if max_wait is None else max_wait))
+        return wait
+
+    def _reserve(self, max_wait=None):
+        """Take the next token from the bucket.
+
+        Returns:
+            The seconds to wait for the token, or None if the limiter lock or
+            the token would come after max_wait, in which case the token is
+            not taken. Without max_wait, the lock is waited for at most
+            LOCK_MAX_WAIT seconds.
+        """
+        cache = self.cache
+        start = time.monotonic()
+        lock_wait = LOCK_MAX_WAIT if max_wait is None else max_wait
+        lock_token = uuid.uuid4().hex
+        while not cache.add(self.lock_key, lock_token, LOCK_TIMEOUT):
+            if time.monotonic() - start >= lock_wait:
+                return None
+            time.sleep(LOCK_RETRY_DELAY)
+        try:
+            now = time.time()
+            state = cache.get(self.state_key)
+            if state is None:
+                tokens = float(self.burst)
+            else:
+                tokens, updated_at = state
+                tokens = min(self.burst,
+                             tokens + max(now - updated_at, 0) * self.rate)
+
+            # A negative count of tokens is the backlog of reserved calls.
+            wait = max(1 - tokens, 0) / self.rate
+            if max_wait is not None \
+                    and wait > max_wait - (time.monotonic() - start):
+                return None
+            cache.set(self.state_key, (tokens - 1, now), STATE_TIMEOUT)
+            return wait
+        finally:
+            # Held over LOCK_TIMEOUT, the lock may have expired and been taken
+            # by another process: only release it if it is still ours. The
+            # django cache has no atomic compare and delete, which leaves a
+            # narrow race between the two calls.
+            if cache.get(self.lock_key) == lock_token:
+                cache.delete(self.lock_key)
+
+
+_RATE_LIMITER = None
+_RATE_LIMITER_SETTINGS = None
+_RATE_LIMITER_LOCK = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the rate limiter configured in the settings.
+
+    The SOCOLISSIMO_RATE_LIMIT setting gives the sustained rate, in calls per
+    second, and SOCOLISSIMO_RATE_LIMIT_BURST the burst size. The bucket is
+    kept in the SOCOLISSIMO_RATE_LIMIT_CACHE django cache, and calls wait at
+    most SOCOLISSIMO_RATE_LIMIT_MAX_WAIT seconds for a token. Returns None
+    when no rate is configured.
+    """
+    global _RATE_LIMITER, _RATE_LIMITER_SETTINGS  # pylint: disable=W0603
+    rate = getattr(settings, 'SOCOLISSIMO_RATE_LIMIT', None)
+    if rate is None:
+        return None
+    limiter_settings = (
+        rate,
+        getattr(settings, 'SOCOLISSIMO_RATE_LIMIT_BURST', None),
+        getattr(settings, 'SOCOLISSIMO_RATE_LIMIT_CACHE', 'default'),
+        getattr(settings, 'SOCOLISSIMO_RATE_LIMIT_MAX_WAIT', None),
+    )
+    with _RATE_LIMITER_LOCK:
+        if _RATE_LIMITER_SETTINGS != limiter_settings:
+            rate, burst, cache_alias, max_wait = limiter_settings
+            _RATE_LIMITER = RateLimiter(rate, burst, cache_alias,
+                                        max_wait=max_wait)
+            _RATE_LIMITER_SETTINGS = limiter_settings
+        return _RATE_LIMITER
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""Retries, deadlines and circuit breaking of the webservice calls."""
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from socolissimo.exceptions import (DeadlineExceeded, LocalError,
+                                    ServiceTimeout, ServiceUnavailable,
+                                    SoColissimoException,
+                                    TransientServiceError)
+
+
+# Default number of attempts of a call, the first one included.
+DEFAULT_RETRY_MAX_ATTEMPTS = 3
+# Default backoff before the first retry, doubled at each retry, in seconds.
+DEFAULT_RETRY_BACKOFF = 0.5
+# Default maximum backoff between two attempts, in seconds.
+DEFAULT_RETRY_MAX_BACKOFF = 10
+# Default time budget of a call, retries included, in seconds.
+DEFAULT_DEADLINE = 60
+# Default number of consecutive failures opening the circuit.
+DEFAULT_CIRCUIT_FAILURE_THRESHOLD = 5
+# Default time the circuit stays open before probing the service, in seconds.
+DEFAULT_CIRCUIT_RESET_TIMEOUT = 30
+
+# A context variable rather than a thread local, so that the deadline of a
+# call of the async client follows its task.
+_DEADLINE = contextvars.ContextVar('socolissimo_deadline', default=None)
+
+
+def _get_setting(value, name, default):
+    """Return value, or the setting name when value is None."""
+    if value is not None:
+        return value
+    return getattr(settings, name, default)
+
+
+@contextmanager
+def deadline(at):
+    """Bound the timeouts of the HTTP requests of the current thread, or of
+    the current asyncio task.
+
+    Args:
+        at (float): The deadline, as a time.monotonic() value, or None for no
+            deadline.
+    """
+    token = _DEADLINE.set(at)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def get_deadline():
+    """Return the deadline of the current thread, or of the current asyncio
+    task, as a time.monotonic() value, or None."""
+    return _DEADLINE.get()
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast while the webservice is down.
+
+    After failure_threshold consecutive transient failures, the circuit
+    opens: calls fail at once with ServiceUnavailable, instead of piling up
+    on a service which does not answer. Once reset_timeout seconds have
+    passed, the next call probes the service first, and the circuit closes
+    again if the probe succeeds.
+
+    Args:
+        probe (callable): Tell if the service is up, such as
+            SoColissimoClient.check_service_health.
+        failure_threshold (int, optional): Defaults to the
+            SOCOLISSIMO_CIRCUIT_FAILURE_THRESHOLD setting.
+        reset_timeout (float, optional): Defaults to the
+            SOCOLISSIMO_CIRCUIT_RESET_TIMEOUT setting.
+    """
+
+    def __init__(self, probe, failure_threshold=None, reset_timeout=None):
+        self.probe = probe
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def failure_threshold(self):
+        """Number of consecutive failures opening the circuit."""
+        return _get_setting(self._failure_threshold,
+                            'SOCOLISSIMO_CIRCUIT_FAILURE_THRESHOLD',
+                            DEFAULT_CIRCUIT_FAILURE_THRESHOLD)
+
+    @property
+    def reset_timeout(self):
+        """Seconds the circuit stays open before probing the service."""
+        return _get_setting(self._reset_timeout,
+                            'SOCOLISSIMO_CIRCUIT_RESET_TIMEOUT',
+                            DEFAULT_CIRCUIT_RESET_TIMEOUT)
+
+    @property
+    def is_open(self):
+        """Whether the calls currently fail fast."""
+        return self._opened_at is not None
+
+    def before_call(self):
+        """Check the circuit before a call, probing the service if due.
+
+        Raises:
+            ServiceUnavailable: The circuit is open.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._probing \
+                    or time.monotonic() - self._opened_at < self.reset_timeout:
+                raise ServiceUnavailable('SoColissimo service is down')
+            self._probing = True
+
+        try:
+            healthy = self.probe()
+        except Exception:  # pylint: disable=W0703
+            healthy = False
+        with self._lock:
+            self._probing = False
+            if healthy:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._opened_at = time.monotonic()
+        raise ServiceUnavailable('SoColissimo service is still down')
+
+    def record_success(self):
+        """Record a call answered by the service."""
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        """Record a transient failure of the service."""
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def reset(self):
+        """Close the circuit."""
+        self.record_success()
+
+
+class RetryPolicy(object):
+    """
+    Retry the webservice calls failing with a TransientServiceError.
+
+    Attempts are separated by an exponential backoff with full jitter, and
+    the whole call, retries included, is bounded by a deadline which also
+    bounds the HTTP timeouts. Permanent errors, such as validation errors or
+    errorIDs not known to be transient, are raised at once.
+
+    A ServiceTimeout is only retried with retry_timeouts, as the label may
+    have been generated by the timed out request.
+
+    Args:
+        circuit_breaker (CircuitBreaker, optional): Circuit checked before
+            each attempt.
+        max_attempts (int, optional): Defaults to the
+            SOCOLISSIMO_RETRY_MAX_ATTEMPTS setting.
+        backoff (float, optional): Defaults to the SOCOLISSIMO_RETRY_BACKOFF
+            setting.
+        max_backoff (float, optional): Defaults to the
+            SOCOLISSIMO_RETRY_MAX_BACKOFF setting.
+        deadline (float, optional): Defaults to the SOCOLISSIMO_DEADLINE
+            setting. A deadline of 0 disables it.
+        retry_timeouts (bool, optional): Defaults to the
+            SOCOLISSIMO_RETRY_TIMEOUTS setting, or False.
+    """
+
+    def __init__(self, circuit_breaker=None, max_attempts=None, backoff=None,
+                 max_backoff=None, deadline=None, retry_timeouts=None):
+        self.circuit_breaker = circuit_breaker
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._deadline = deadline
+        self._retry_timeouts = retry_timeouts
+
+    @property
+    def max_attempts(self):
+        """Number of attempts of a call, the first one included."""
+        return _get_setting(self._max_attempts,
+                            'SOCOLISSIMO_RETRY_MAX_ATTEMPTS',
+                            DEFAULT_RETRY_MAX_ATTEMPTS)
+
+    @property
+    def backoff(self):
+        """Backoff before the first retry, in seconds."""
+        return _get_setting(self._backoff, 'SOCOLISSIMO_RETRY_BACKOFF',
+                            DEFAULT_RETRY_BACKOFF)
+
+    @property
+    def max_backoff(self):
+        """Maximum backoff between two attempts, in seconds."""
+        return _get_setting(self._max_backoff, 'SOCOLISSIMO_RETRY_MAX_BACKOFF',
+                            DEFAULT_RETRY_MAX_BACKOFF)
+
+    @property
+    def deadline(self):
+        """Time budget of a call, retries included, in seconds."""
+        return _get_setting(self._deadline, 'SOCOLISSIMO_DEADLINE',
+                            DEFAULT_DEADLINE)
+
+    @property
+    def retry_timeouts(self):
+        """Whether calls failing with a ServiceTimeout are retried."""
+        return _get_setting(self._retry_timeouts, 'SOCOLISSIMO_RETRY_TIMEOUTS',
+                            False)
+
+    def call(self, func):
+        """Call func, retrying it on transient errors.
+
+        Args:
+            func (callable): The webservice call.
+
+        Returns:
+            The result of func.
+
+        Raises:
+            ServiceUnavailable: The circuit is open.
+            DeadlineExceeded: The deadline passed before a retry.
+            TransientServiceError: The last attempt failed.
+            Whatever func raises, for the other errors.
+        """
+        budget = self.deadline
+        call_deadline = time.monotonic() + budget if budget else None
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_call()
+            try:
+                with deadline(call_deadline):
+                    result = func()
+            except TransientServiceError as exc:
+                delay = self._record_failure(exc, attempt, budget,
+                                             call_deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            except LocalError:
+                # The service was not called, or did not answer: the call
+                # tells nothing of its health.
+                raise
+            except SoColissimoException:
+                # The service answered, even with an error.
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_success()
+                raise
+            else:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_success()
+                return result
+
+    async def call_async(self, func):
+        """Coroutine variant of call, for the async client.
+
+        The backoff is awaited on the event loop, and the probe of an open
+        circuit runs in the default executor.
+
+        Args:
+            func (callable): Returns an awaitable webservice call.
+
+        Returns:
+            The result of the awaitable.
+
+        Raises:
+            See call.
+        """
+        budget = self.deadline
+        call_deadline = time.monotonic() + budget if budget else None
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.circuit_breaker is not None:
+                if self.circuit_breaker.is_open:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self.circuit_breaker.before_call)
+                else:
+                    self.circuit_breaker.before_call()
+            try:
+                with deadline(call_deadline):
+                    result = await func()
+            except TransientServiceError as exc:
+                delay = self._record_failure(exc, attempt, budget,
+                                             call_deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            except LocalError:
+                raise
+            except SoColissimoException:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_success()
+                raise
+            else:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_success()
+                return result
+
+    def _record_failure(self, exc, attempt, budget, call_deadline):
+        """Record a transient failure of an attempt.
+
+        Returns:
+            The backoff before the next attempt, in seconds, or None when the
+            failure is not retried.
+
+        Raises:
+            DeadlineExceeded: The deadline would pass during the backoff.
+        """
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_failure()
+        if attempt >= self.max_attempts or (
+                isinstance(exc, ServiceTimeout) and not self.retry_timeouts):
+            return None
+        delay = random.uniform(0, min(
+            self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        if call_deadline is not None \
+                and time.monotonic() + delay >= call_deadline:
+            raise DeadlineExceeded(
+                'No answer within {}s, last error : {}'.format(budget, exc))
+        return delay
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""Routing of the calls between several endpoints of the web service
+SoColissimo.
+
+The endpoints are configured in order of preference by the
+SOCOLISSIMO_ENDPOINTS setting, such as a nearby proxy followed by the
+webservice itself. Each call goes to the endpoint in rotation with the fewest
+consecutive failures and the lowest expected latency, the first configured
+one on ties. An endpoint which keeps failing is taken out of rotation, and
+put back once its supervision page reports it up again.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from copy import deepcopy
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from socolissimo.client import SUPERVISION_URL
+from socolissimo.exceptions import (LocalError, SoColissimoException,
+                                    TransientServiceError)
+
+
+logger = logging.getLogger(__name__)
+
+# Default number of consecutive failures taking an endpoint out of rotation.
+DEFAULT_ENDPOINT_FAILURE_THRESHOLD = 3
+# Default error rate taking an endpoint out of rotation.
+DEFAULT_ENDPOINT_MAX_ERROR_RATE = 0.5
+# Default time between two checks of an endpoint out of rotation, in seconds.
+DEFAULT_ENDPOINT_PROBE_INTERVAL = 30
+# Default age of the statistics of an endpoint before it is tried again, in
+# seconds.
+DEFAULT_ENDPOINT_STATS_TTL = 60
+# Weight of the latest call in the moving averages of the statistics.
+SMOOTHING = 0.2
+
+
+class Endpoint(object):
+    """
+    An endpoint of the webservice, with the statistics of its calls.
+
+    Args:
+        url (str): URL of the getLetterColissimo calls, None for the location
+            given by the WSDL.
+        supervision_url (str, optional): URL of the supervision page of the
+            endpoint, answering "[OK]" when it is up.
+        name (str, optional): Name of the endpoint in the logs. Defaults to
+            its url.
+
+    Attributes:
+        latency: Moving average of the duration of the calls, in seconds, or
+            None before the first call.
+        error_rate: Moving average of the share of failed calls.
+        failures: Number of consecutive failed calls.
+        in_rotation: Whether the calls are sent to the endpoint.
+    """
+
+    def __init__(self, url, supervision_url=None, name=None):
+        self.url = url
+        self.supervision_url = supervision_url
+        self.name = name or url or 'wsdl'
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.in_rotation = True
+        self.measured_at = None
+        self.removed_at = None
+        self.probing = False
+
+    def reset(self):
+        """Forget the statistics and put the endpoint back in rotation."""
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.in_rotation = True
+        self.measured_at = None
+        self.removed_at = None
+
+    def __repr__(self):
+        return '<Endpoint {}>'.format(self.name)
+
+
+def parse_endpoints(config):
+    """Create the endpoints of the SOCOLISSIMO_ENDPOINTS setting.
+
+    Args:
+        config (list): The endpoints, in order of preference, each one either
+            the URL of the calls, or a dict of the arguments of Endpoint. None
+            for the location given by the WSDL, supervised by SUPERVISION_URL.
+
+    Returns:
+        A list of Endpoint.
+
+    Raises:
+        ImproperlyConfigured: An endpoint is invalid, or none is given.
+    """
+    if config is None:
+        return [Endpoint(None, SUPERVISION_URL)]
+    endpoints = []
+    for options in config:
+        if isinstance(options, str):
+            options = {'url': options}
+        try:
+            endpoints.append(Endpoint(**options))
+        except TypeError as exc:
+            raise ImproperlyConfigured(
+                'Invalid SoColissimo endpoint {!r} : {}'.format(options, exc))
+    if not endpoints:
+        raise ImproperlyConfigured('Please provide a SoColissimo endpoint')
+    return endpoints
+
+
+def check_supervision(url):
+    """Tell if a supervision page reports its endpoint up."""
+    # pylint: disable=C0415
+    from socolissimo.transport import get_session, get_timeout
+    response = get_session().get(url, timeout=get_timeout())
+    return response.status_code == 200 and response.text.strip() == '[OK]'
+
+
+class EndpointRouter(object):
+    """
+    Choose the endpoint of each call from the statistics of the previous
+    ones.
+
+    The endpoints in rotation are ranked by their number of consecutive
+    failures, then by their latency divided by their success rate, which is
+    the expected time of a successful call: a single failure sends the next
+    calls, and the retry of the failed one, to another endpoint. Endpoints
+    not called for stats_ttl seconds rank first, so that they are measured
+    again. When every endpoint is out of rotation, they are all ranked.
+
+    An endpoint leaves the rotation after failure_threshold consecutive
+    failures, or once its error rate reaches max_error_rate. Every
+    probe_interval seconds, the next call starts a background thread checking
+    its supervision page, and putting it back in rotation if the page reports
+    it up: the call itself never waits for the check, so choose may be called
+    from an event loop. An endpoint without a supervision page is put back
+    without check. A single endpoint
+    stays in rotation, the circuit breaker of the client failing the calls
+    fast while it is down.
+
+    Args:
+        endpoints (list of Endpoint): The endpoints, in order of preference.
+        failure_threshold (int, optional): Defaults to the
+            SOCOLISSIMO_ENDPOINT_FAILURE_THRESHOLD setting.
+        max_error_rate (float, optional): Defaults to the
+            SOCOLISSIMO_ENDPOINT_MAX_ERROR_RATE setting.
+        probe_interval (float, optional): Defaults to the
+            SOCOLISSIMO_ENDPOINT_PROBE_INTERVAL setting.
+        stats_ttl (float, optional): Defaults to the
+            SOCOLISSIMO_ENDPOINT_STATS_TTL setting.
+        check (callable, optional): Tell if a supervision page, given its
+            URL, reports its endpoint up. Defaults to check_supervision.
+    """
+
+    def __init__(self, endpoints, failure_threshold=None, max_error_rate=None,
+                 probe_interval=None, stats_ttl=None, check=None):
+        self.endpoints = list(endpoints)
+        self._failure_threshold = failure_threshold
+        self._max_error_rate = max_error_rate
+        self._probe_interval = probe_interval
+        self._stats_ttl = stats_ttl
+        self.check = check or check_supervision
+        self._lock = threading.Lock()
+        self._probes = []
+
+    @property
+    def failure_threshold(self):
+        """Number of consecutive failures taking an endpoint out of
+        rotation."""
+        if self._failure_threshold is not None:
+            return self._failure_threshold
+        return getattr(settings, 'SOCOLISSIMO_ENDPOINT_FAILURE_THRESHOLD',
+                       DEFAULT_ENDPOINT_FAILURE_THRESHOLD)
+
+    @property
+    def max_error_rate(self):
+        """Error rate taking an endpoint out of rotation."""
+        if self._max_error_rate is not None:
+            return self._max_error_rate
+        return getattr(settings, 'SOCOLISSIMO_ENDPOINT_MAX_ERROR_RATE',
+                       DEFAULT_ENDPOINT_MAX_ERROR_RATE)
+
+    @property
+    def probe_interval(self):
+        """Seconds between two checks of an endpoint out of rotation."""
+        if self._probe_interval is not None:
+            return self._probe_interval
+        return getattr(settings, 'SOCOLISSIMO_ENDPOINT_PROBE_INTERVAL',
+                       DEFAULT_ENDPOINT_PROBE_INTERVAL)
+
+    @property
+    def stats_ttl(self):
+        """Seconds before an endpoint not called is measured again."""
+        if self._stats_ttl is not None:
+            return self._stats_ttl
+        return getattr(settings, 'SOCOLISSIMO_ENDPOINT_STATS_TTL',
+                       DEFAULT_ENDPOINT_STATS_TTL)
+
+    def choose(self):
+        """Return the endpoint of the next call, starting the checks of the
+        endpoints out of rotation which are due."""
+        self._probe_due()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints
+                          if endpoint.in_rotation] or self.endpoints
+            # min keeps the first of the best ranked endpoints.
+            return min(candidates,
+                       key=lambda endpoint: self._rank(endpoint, now))
+
+    @contextmanager
+    def route(self):
+        """Choose the endpoint of a call, and record the outcome of the call.
+
+        Network errors, timeouts and server errors (any TransientServiceError
+        or OSError) are failures of the endpoint; the other
+        SoColissimoException are answers of the endpoint, like successes,
+        except the LocalError which are not recorded.
+
+        Yields:
+            The Endpoint of the call.
+        """
+        endpoint = self.choose()
+        start = time.monotonic()
+        try:
+            yield endpoint
+        except (TransientServiceError, OSError):
+            self.record(endpoint, time.monotonic() - start, failed=True)
+            raise
+        except LocalError:
+            raise
+        except SoColissimoException:
+            self.record(endpoint, time.monotonic() - start)
+            raise
+        else:
+            self.record(endpoint, time.monotonic() - start)
+
+    def record(self, endpoint, latency, failed=False):
+        """Record the outcome of a call to an endpoint.
+
+        Args:
+            endpoint (Endpoint): The endpoint called.
+            latency (float): Duration of the call, in seconds.
+            failed (bool, optional): Whether the call failed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._is_stale(endpoint, now):
+                endpoint.latency = None
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += SMOOTHING * (latency - endpoint.latency)
+            endpoint.error_rate += SMOOTHING * (failed - endpoint.error_rate)
+            endpoint.failures = endpoint.failures + 1 if failed else 0
+            endpoint.measured_at = now
+            if endpoint.in_rotation and (
+                    endpoint.failures >= self.failure_threshold
+                    or endpoint.error_rate >= self.max_error_rate):
+                self._remove(endpoint, now)
+
+    def check_health(self):
+        """Check the supervision page of every endpoint.
+
+        Endpoints reported down are taken out of rotation, and endpoints
+        reported up are put back.
+
+        Returns:
+            True if an endpoint is up, or if no endpoint has a supervision
+            page.
+        """
+        supervised = [endpoint for endpoint in self.endpoints
+                      if endpoint.supervision_url]
+        healthy = [self._probe(endpoint) for endpoint in supervised]
+        return any(healthy) or not supervised
+
+    def wait_probes(self, timeout=None):
+        """Wait for the checks started by the calls to finish.
+
+        Args:
+            timeout (float, optional): Maximum time to wait for each check, in
+                seconds. Defaults to no limit.
+        """
+        with self._lock:
+            probes = list(self._probes)
+        for probe in probes:
+            probe.join(timeout)
+
+    def _rank(self, endpoint, now):
+        if self._is_stale(endpoint, now):
+            return 0, 0.0
+        return endpoint.failures, \
+            endpoint.latency / max(1 - endpoint.error_rate, 0.01)
+
+    def _is_stale(self, endpoint, now):
+        return endpoint.measured_at is None \
+            or now - endpoint.measured_at > self.stats_ttl
+
+    def _remove(self, endpoint, now):
+        if len(self.endpoints) == 1:
+            # Nowhere else to go, the circuit breaker takes over.
+            return
+        endpoint.in_rotation = False
+        endpoint.removed_at = now
+        logger.warning('SoColissimo endpoint %s taken out of rotation',
+                       endpoint.name)
+
+    def _probe_due(self):
+        """Start checking the endpoints out of rotation for probe_interval
+        seconds, each one by a single background thread."""
+        now = time.monotonic()
+        with self._lock:
+            due = [endpoint for endpoint in self.endpoints
+                   if not endpoint.in_rotation and not endpoint.probing
+                   and now - endpoint.removed_at >= self.probe_interval]
+            self._probes = [probe for probe in self._probes
+                            if probe.is_alive()]
+            for endpoint in due:
+                endpoint.probing = True
+                probe = threading.Thread(
+                    target=self._probe_in_background, args=(endpoint,),
+                    name='socolissimo-probe-{}'.format(endpoint.name),
+                    daemon=True)
+                self._probes.append(probe)
+                probe.start()
+
+    def _probe_in_background(self, endpoint):
+        try:
+            self._probe(endpoint)
+        finally:
+            endpoint.probing = False
+
+    def _probe(self, endpoint):
+        """Check the supervision page of an endpoint, putting it in or out
+        of rotation.
+
+        Returns:
+            Whether the endpoint is up, True without supervision page.
+        """
+        healthy = True
+        if endpoint.supervision_url:
+            try:
+                healthy = self.check(endpoint.supervision_url)
+            except Exception:  # pylint: disable=W0703
+                healthy = False
+        now = time.monotonic()
+        with self._lock:
+            if healthy and not endpoint.in_rotation:
+                endpoint.reset()
+                logger.info('SoColissimo endpoint %s back in rotation',
+                            endpoint.name)
+            elif not healthy:
+                if endpoint.in_rotation:
+                    self._remove(endpoint, now)
+                else:
+                    endpoint.removed_at = now
+        return healthy
+
+
+_ROUTER = None
+_ROUTER_SETTINGS = None
+_ROUTER_LOCK = threading.Lock()
+
+
+def get_router():
+    """Return the router of the endpoints of the SOCOLISSIMO_ENDPOINTS
+    setting, see parse_endpoints.
+
+    The router is created once, and again only if the setting changes, so
+    the statistics of the endpoints are shared by every client of the
+    process.
+
+    Raises:
+        ImproperlyConfigured: An endpoint is invalid.
+    """
+    global _ROUTER, _ROUTER_SETTINGS  # pylint: disable=W0603
+    config = getattr(settings, 'SOCOLISSIMO_ENDPOINTS', None)
+    with _ROUTER_LOCK:
+        if _ROUTER is None or _ROUTER_SETTINGS != config:
+            _ROUTER = EndpointRouter(parse_endpoints(config))
+            _ROUTER_SETTINGS = deepcopy(config)
+        return _ROUTER
@@ -3,9 +3,11 @@
 import datetime
 
 from django.forms.forms import Form
+from django.forms.utils import ErrorDict, ErrorList
 from django.forms.fields import (DateTimeField, IntegerField, ChoiceField,
                                  CharField, DecimalField, Field, EmailField,
                                  BooleanField)
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import EMPTY_VALUES
 
@@ -24,6 +26,18 @@ class SchemaValidationError(ValidationError):
                           super(SchemaValidationError, self).__str__())
 
 
+class SchemaData(dict):
+    """
+    Plain data of a schema, as a dict.
+
+    Values can also be set as attributes, like on a suds instance, so that
+    schemas can set their constants the same way on both.
+    """
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
 class SoColissimoSchema(Form):
     """
     Specify and validate the format expected by an complexType in the WSDL.
@@ -31,9 +45,47 @@ class SoColissimoSchema(Form):
     Attributes:
         soap_type_name: The name of the complexType that this schema reflects,
             as defined in the WSDL.
+        constants: The fixed values enforced by the SoColissimo specification,
+            by field name. They are set on the prototype of the suds
+            instances, see SoapClientPool.type_prototypes.
     """
 
     soap_type_name = None
+    constants = {}
+
+    @classmethod
+    def constant_items(cls):
+        """Return the constants, as a sorted tuple of (name, value) pairs."""
+        return tuple(sorted(cls.constants.items()))
+
+    @classmethod
+    def compiled(cls):
+        """
+        Return the flat validator of this schema, compiled at first call.
+
+        Returns:
+            A CompiledSchema.
+        """
+        compiled = cls.__dict__.get('_compiled_schema')
+        if compiled is None:
+            compiled = CompiledSchema(cls)
+            cls._compiled_schema = compiled
+        return compiled
+
+    def validated_data(self):
+        """
+        Validate the form's data.
+
+        Returns:
+            The cleaned_data of the form.
+
+        Raises :
+            SchemaValidationError: The schema do not validate.
+        """
+        if not self.is_valid():
+            raise SchemaValidationError(self.__class__.__name__,
+                                        repr(self.errors))
+        return self.cleaned_data
 
     def build_instance(self):
         """
@@ -50,29 +102,56 @@ class SoColissimoSchema(Form):
         Raises :
             SchemaValidationError: The schema do not validate.
         """
-        if not self.is_valid():
-            raise SchemaValidationError(self.__class__.__name__,
-                                        repr(self.errors))
+        cleaned_data = self.validated_data()
 
         from socolissimo.client import SOAP_CLIENT
-        instance = SOAP_CLIENT.soap_client.factory.create(self.soap_type_name)
+        instance = SOAP_CLIENT.type_prototypes.create(self.soap_type_name,
+                                                      self.constant_items())
 
-        for field, value in self.cleaned_data.items():
+        for field, value in cleaned_data.items():
             if value not in EMPTY_VALUES:
+                if isinstance(value, (SoColissimoSchema, SchemaRecord)):
+                    value = value.build_instance()
                 setattr(instance, field, value)
 
         self._set_constants(instance)
         return instance
 
-    def _set_constants(self, instance):
+    def build_data(self):
+        """
+        Build the plain data for the soap type represented by this schema,
+        using the form's data.
+
+        This is the counterpart of build_instance without suds, the values
+        being the same than the ones set on the suds instance.
+
+        Returns:
+            A SchemaData, nested schemas being SchemaData as well.
+
+        Raises :
+            SchemaValidationError: The schema do not validate.
+        """
+        data = SchemaData(self.constants)
+        for field, value in self.validated_data().items():
+            if value not in EMPTY_VALUES:
+                if isinstance(value, (SoColissimoSchema, SchemaRecord)):
+                    value = value.build_data()
+                data[field] = value
+
+        self._set_constants(data)
+        return data
+
+    @classmethod
+    def _set_constants(cls, instance):
         """
-        Allow subclasses to set constant values on the suds instance.
+        Allow subclasses to set values enforced by the SoColissimo
+        specification which change over time, so can't be constants.
 
-        Such constants are enforced by the SoColissimo specification.
+        This is a classmethod, so compiled schemas call it without any form.
 
         Args:
-            instance (suds object): Subclasses must set the constants directly
-                on this suds instance.
+            instance (suds object or SchemaData): Subclasses must set the
+                constants directly on this instance, as attributes.
         """
         pass
 
@@ -96,7 +175,7 @@ class NestedSchemaField(Field):
         the nested schema.
 
         Returns:
-            A suds object representing the child schema, or None.
+            The validated child schema, or None.
 
         Raises :
             SchemaValidationError: The child schema do not validate.
@@ -104,7 +183,172 @@ class NestedSchemaField(Field):
         if not value:
             return value
         form = self.form_class(value)
-        return form.build_instance()
+        form.validated_data()
+        return form
+
+
+class SchemaRecord(object):
+    """
+    Validated data of a schema, as produced by a CompiledSchema.
+
+    Each compiled schema has its own record class, with one slot per field of
+    the schema.
+    """
+
+    __slots__ = ()
+    compiled_schema = None
+
+    def items(self):
+        """Iterate over the (field, value) pairs of the record."""
+        for field in self.__slots__:
+            yield field, getattr(self, field)
+
+    def build_instance(self):
+        """Build a suds object instance from the record, see
+        SoColissimoSchema.build_instance."""
+        return self.compiled_schema.build_instance(self)
+
+    def build_data(self):
+        """Build the plain data from the record, see
+        SoColissimoSchema.build_data."""
+        return self.compiled_schema.build_data(self)
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__, dict(self.items()))
+
+
+class _CleaningContext(object):  # pylint: disable=R0903
+    """Stand-in for the form instance when calling a schema method."""
+
+    __slots__ = ('data', 'cleaned_data')
+
+    def __init__(self, data, cleaned_data):
+        self.data = data
+        self.cleaned_data = cleaned_data
+
+
+class CompiledSchema(object):
+    """
+    Flat validator compiled once from a schema class.
+
+    It applies the same cleaning than the schema form (fields cleaning,
+    clean_<field> methods, nested schemas) and raises the same
+    SchemaValidationError, but without instantiating the form, copying its
+    fields and going through the form machinery on each call. The validated
+    data is returned as a compact SchemaRecord.
+
+    Args:
+        schema_class (SoColissimoSchema subclass): The schema to compile.
+    """
+
+    def __init__(self, schema_class):
+        self.schema_class = schema_class
+        self.schema_name = schema_class.__name__
+        self.soap_type_name = schema_class.soap_type_name
+        self.constants = schema_class.constant_items()
+        self.fields = []
+        for name, field in schema_class.base_fields.items():
+            nested = None
+            if isinstance(field, NestedSchemaField):
+                nested = field.form_class.compiled()
+            clean_method = getattr(schema_class, 'clean_{}'.format(name), None)
+            self.fields.append((name, field, field.widget.value_from_datadict,
+                                nested, clean_method))
+        self.record_class = type(
+            '{}Record'.format(self.schema_name), (SchemaRecord,),
+            {'__slots__': tuple(name for name, _, _, _, _ in self.fields),
+             'compiled_schema': self})
+
+    def validate(self, data):
+        """
+        Validate the data of the schema.
+
+        Args:
+            data (dict): The source data, as given to the schema form.
+
+        Returns:
+            A SchemaRecord of the cleaned data.
+
+        Raises:
+            SchemaValidationError: The data do not validate.
+        """
+        errors = ErrorDict()
+        if data is None:
+            raise SchemaValidationError(self.schema_name, repr(errors))
+
+        cleaned_data = {}
+        context = _CleaningContext(data, cleaned_data)
+        for name, field, value_from_datadict, nested, clean_method \
+                in self.fields:
+            value = value_from_datadict(data, None, name)
+            try:
+                if nested is not None and value:
+                    cleaned_data[name] = nested.validate(value)
+                else:
+                    cleaned_data[name] = field.clean(value)
+                if clean_method is not None:
+                    cleaned_data[name] = clean_method(context)
+            except ValidationError as exc:
+                errors.setdefault(name, ErrorList()).extend(exc.error_list)
+                cleaned_data.pop(name, None)
+
+        if errors:
+            raise SchemaValidationError(self.schema_name, repr(errors))
+
+        record = self.record_class()
+        for name, value in cleaned_data.items():
+            setattr(record, name, value)
+        return record
+
+    def validate_many(self, datas):
+        """
+        Validate the data of many schema instances at once.
+
+        Args:
+            datas (iterable of dict): The source data.
+
+        Returns:
+            A list with, for each data in input order, either the SchemaRecord
+            or the SchemaValidationError raised.
+        """
+        results = []
+        for data in datas:
+            try:
+                results.append(self.validate(data))
+            except SchemaValidationError as exc:
+                results.append(exc)
+        return results
+
+    def _fill(self, record, instance, setter, build):
+        for field, value in record.items():
+            if value not in EMPTY_VALUES:
+                if isinstance(value, SchemaRecord):
+                    value = build(value)
+                setter(instance, field, value)
+        self.schema_class._set_constants(instance)  # pylint: disable=W0212
+        return instance
+
+    def build_instance(self, record):
+        """
+        Build a suds object instance from a record of this schema.
+
+        Empty values are omitted, as in SoColissimoSchema.build_instance.
+        """
+        from socolissimo.client import SOAP_CLIENT
+        instance = SOAP_CLIENT.type_prototypes.create(self.soap_type_name,
+                                                      self.constants)
+        return self._fill(record, instance, setattr,
+                          SchemaRecord.build_instance)
+
+    def build_data(self, record):
+        """
+        Build the plain data from a record of this schema.
+
+        Empty values are omitted, as in SoColissimoSchema.build_data.
+        """
+        return self._fill(record, SchemaData(self.constants),
+                          dict.__setitem__,
+                          SchemaRecord.build_data)
 
 
 class ServiceCallContext(SoColissimoSchema):
@@ -122,16 +366,19 @@ class ServiceCallContext(SoColissimoSchema):
     totalAmount = IntegerField(required=False, min_value=0)
     commandNumber = CharField(required=False)
 
-    def _set_constants(self, service):
+    constants = {
+        'returnType': 'CreatePDFFile',
+        'serviceType': 'SO',
+        'crbt': False,
+        'portPaye': False,
+        'languageConsignor': "FR",
+        'languageConsignee': "FR",
+    }
+
+    @classmethod
+    def _set_constants(cls, service):
         service.dateValidation = datetime.datetime.today() \
             + datetime.timedelta(7)
-        service.returnType = 'CreatePDFFile'
-        service.serviceType = 'SO'
-        service.crbt = False
-
-        service.portPaye = False
-        service.languageConsignor = "FR"
-        service.languageConsignee = "FR"
 
 
 class Parcel(SoColissimoSchema):
@@ -165,10 +412,11 @@ class Parcel(SoColissimoSchema):
             delivery_mode = "DOM"
         return delivery_mode
 
-    def _set_constants(self, parcel):
-        parcel.insuranceRange = "00"
-        parcel.ReturnReceipt = False
-        parcel.Recommendation = False
+    constants = {
+        'insuranceRange': "00",
+        'ReturnReceipt': False,
+        'Recommendation': False,
+    }
 
 
 class Address(SoColissimoSchema):
@@ -201,6 +449,39 @@ class Address(SoColissimoSchema):
     DoorCode2 = CharField(required=False)
     Interphone = CharField(required=False)
 
+    def clean_postalCode(self):
+        """
+        Check the postal code and city pair against the postal index, when
+        the SOCOLISSIMO_ADDRESS_CHECK setting is set, so that invalid pairs
+        are not sent to the webservice. The city is replaced by the spelling
+        of the index. Countries missing from the index are not checked.
+        """
+        postal_code = self.cleaned_data.get('postalCode')
+        if not getattr(settings, 'SOCOLISSIMO_ADDRESS_CHECK', False):
+            return postal_code
+        country = self.cleaned_data.get('countryCode')
+        city = self.cleaned_data.get('city')
+        if not country or not city:
+            return postal_code
+
+        from socolissimo.postal import get_postal_index
+        index = get_postal_index()
+        if country not in index.countries:
+            return postal_code
+        canonical_city = index.canonical_city(country, postal_code, city)
+        if canonical_city:
+            self.cleaned_data['city'] = canonical_city
+            return postal_code
+        if not index.cities(country, postal_code):
+            raise ValidationError('Unknown postal code {}'.format(
+                postal_code))
+        msg = 'City {} does not match postal code {}'.format(city,
+                                                              postal_code)
+        suggestions = index.suggest(country, postal_code, city)
+        if suggestions:
+            msg = '{}, did you mean {} ?'.format(msg, suggestions[0])
+        raise ValidationError(msg)
+
 
 class RecipientAddress(Address):
     """
@@ -209,10 +490,9 @@ class RecipientAddress(Address):
     Recipient addresses has additionnal required fields : name, surname, email.
     """
 
-    def __init__(self, *args, **kwargs):
-        super(RecipientAddress, self).__init__(*args, **kwargs)
-        for field_name in ('Name', 'Surname', 'email'):
-            self.fields[field_name].required = True
+    Name = CharField(required=True, help_text='Nom')
+    Surname = CharField(required=True, help_text='Prénom')
+    email = EmailField(required=True)
 
 
 class ParcelRecipient(SoColissimoSchema):
@@ -221,10 +501,11 @@ class ParcelRecipient(SoColissimoSchema):
 
     addressVO = NestedSchemaField(RecipientAddress)
 
-    def _set_constants(self, recipient):
-        recipient.alert = "none"
-        recipient.codeBarForreference = False
-        recipient.deliveryError = False
+    constants = {
+        'alert': "none",
+        'codeBarForreference': False,
+        'deliveryError': False,
+    }
 
 
 class ParcelSender(SoColissimoSchema):
@@ -233,5 +514,6 @@ class ParcelSender(SoColissimoSchema):
 
     addressVO = NestedSchemaField(Address)
 
-    def _set_constants(self, sender):
-        sender.alert = "none"
+    constants = {
+        'alert': "none",
+    }
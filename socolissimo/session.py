@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Shipment sessions: letters of a dispatch run sharing their service call
+context and sender.
+
+Within a dispatch run, the sender and most of the service call context are
+the same for every parcel. A session validates and builds them once, so each
+letter only validates and builds its parcel and recipient.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from socolissimo import metrics
+from socolissimo.client import DEFAULT_MAX_WORKERS
+from socolissimo.exceptions import SoColissimoException
+from socolissimo.schema import (Parcel, ParcelRecipient, ParcelSender,
+                                ServiceCallContext)
+
+
+class ShipmentSession(object):
+    """
+    Letters issued by a client with a shared service call context and sender.
+
+    Create it with SoColissimoClient.shipment_session. The shared parts are
+    built when the session starts: their dateValidation is the one of the
+    start of the session.
+
+    A letter may still have its own service call context, such as its
+    commandNumber, merged into the shared one. This service call context is
+    then validated and built for the letter.
+
+    Args:
+        client (SoColissimoClient): The client issuing the letters.
+        service_call_context (dict): The shared service call context.
+        sender (dict): The shared sender.
+
+    Raises:
+        SchemaValidationError: The shared labelling data do not validate.
+    """
+
+    def __init__(self, client, service_call_context, sender):
+        self.client = client
+        self.service_call_context = dict(service_call_context)
+        with metrics.time_phase(metrics.PHASE_VALIDATE, client.engine):
+            self._shared = {
+                'service': ServiceCallContext.compiled().validate(
+                    self.service_call_context),
+                'exp': ParcelSender.compiled().validate(sender),
+            }
+        self._built = client._build_parts(  # pylint: disable=W0212
+            self._shared)
+        self._pending = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def get_letter(self, parcel, recipient, service_call_context=None):
+        """Issue a letter of the session, see SoColissimoClient.get_letter.
+
+        Args:
+            parcel (dict): The parcel of the letter.
+            recipient (dict): The recipient of the letter.
+            service_call_context (dict, optional): Values of the service call
+                context specific to the letter, such as its commandNumber.
+
+        Returns:
+            A tuple (parcel_number, pdf_url)
+
+        Raises:
+            SoColissimoException: Something goes wrong with the webservice call.
+            SchemaValidationError: The labelling data do not validate.
+        """
+        return self._issue(*self._validate(parcel, recipient,
+                                           service_call_context))
+
+    def add_parcel(self, parcel, recipient, service_call_context=None):
+        """Validate a letter of the session and add it to the batch issued by
+        submit.
+
+        The arguments are the ones of get_letter.
+
+        Raises:
+            SchemaValidationError: The labelling data do not validate. The
+                letter is not added.
+        """
+        self._pending.append(self._validate(parcel, recipient,
+                                            service_call_context))
+
+    def submit(self, max_workers=DEFAULT_MAX_WORKERS):
+        """Issue the letters added since the last submit concurrently, see
+        SoColissimoClient.get_letters.
+
+        Args:
+            max_workers (int, optional): Maximum number of concurrent calls
+                to the webservice.
+
+        Returns:
+            A list with one outcome per letter, in the order they were added.
+            Each outcome is either a tuple (parcel_number, pdf_url), or the
+            SoColissimoException raised for this letter.
+        """
+        pending, self._pending = self._pending, []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._get_letter_outcome, records,
+                                       built)
+                       for records, built in pending]
+        return [future.result() for future in futures]
+
+    def _get_letter_outcome(self, records, built):
+        """Issue a letter, returning the expected exceptions as outcome."""
+        try:
+            return self._issue(records, built)
+        except SoColissimoException as exc:
+            return exc
+
+    def _issue(self, records, built):
+        """Issue a validated letter with the shared parts of the session."""
+        return self.client._issue_records(  # pylint: disable=W0212
+            records, built)
+
+    def _validate(self, parcel, recipient, service_call_context):
+        """Validate the data specific to a letter.
+
+        Returns:
+            A tuple of the dict of the validated SchemaRecord and the dict of
+            the built parts, by Letter field name.
+        """
+        with metrics.time_phase(metrics.PHASE_VALIDATE, self.client.engine):
+            records = dict(self._shared)
+            built = self._built
+            if service_call_context:
+                context = dict(self.service_call_context,
+                               **service_call_context)
+                records['service'] = ServiceCallContext.compiled().validate(
+                    context)
+                built = {'exp': built['exp']}
+            records['parcel'] = Parcel.compiled().validate(parcel)
+            records['dest'] = ParcelRecipient.compiled().validate(recipient)
+        return records, built
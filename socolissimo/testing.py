@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the SoColissimo webservice, for tests."""
+import itertools
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+WSDL_PATH = os.path.join(os.path.dirname(__file__), 'testdata',
+                         'WSColiPosteLetterService.wsdl')
+WSDL_LOCATION = ('https://ws.colissimo.fr/soap.shippingclpV2/services/'
+                 'WSColiPosteLetterService')
+
+RESPONSE_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<soapenv:Envelope '
+    'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soapenv:Body>'
+    '<getLetterColissimoResponse xmlns="http://sls.ws.coliposte.fr">'
+    '<getLetterColissimoReturn>'
+    '<PdfUrl>{pdf_url}</PdfUrl>'
+    '<errorID>{error_id}</errorID>'
+    '<error>{error}</error>'
+    '<parcelNumber>{parcel_number}</parcelNumber>'
+    '</getLetterColissimoReturn>'
+    '</getLetterColissimoResponse>'
+    '</soapenv:Body>'
+    '</soapenv:Envelope>')
+
+# errorID of the calls failing at random.
+RANDOM_ERROR_ID = 30000
+# Path of the supervision page.
+SUPERVISION_PATH = '/supervision.jsp'
+
+FAULT_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<soapenv:Envelope '
+    'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soapenv:Body><soapenv:Fault>'
+    '<faultcode>soapenv:Server</faultcode>'
+    '<faultstring>{faultstring}</faultstring>'
+    '</soapenv:Fault></soapenv:Body>'
+    '</soapenv:Envelope>')
+
+
+def make_label_pdf(parcel_number):
+    """Build a minimal one page PDF label, showing the parcel number."""
+    content = 'BT /F1 24 Tf 20 200 Td ({}) Tj ET'.format(parcel_number)
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 283 425] '
+        '/Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+        '<< /Length {} >>\nstream\n{}\nendstream'.format(len(content),
+                                                        content),
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    pdf = '%PDF-1.4\n'
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += '{} 0 obj\n{}\nendobj\n'.format(number, obj)
+    xref_offset = len(pdf)
+    pdf += 'xref\n0 {}\n0000000000 65535 f \n'.format(len(objects) + 1)
+    pdf += ''.join('{:010d} 00000 n \n'.format(offset) for offset in offsets)
+    pdf += 'trailer\n<< /Size {} /Root 1 0 R >>\n'.format(len(objects) + 1)
+    pdf += 'startxref\n{}\n%%EOF\n'.format(xref_offset)
+    return pdf.encode('latin-1')
+
+
+class _LetterServiceHandler(BaseHTTPRequestHandler):
+    """Request handler of the fake webservice."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Serve the WSDL and the PDF labels."""
+        service = self.server.service
+        if self.path == SUPERVISION_PATH:
+            body = b'[OK]' if service.healthy else b'[KO]'
+            self._respond(200, body, 'text/plain')
+        elif self.path.endswith('?wsdl'):
+            self._respond(200, service.wsdl, 'text/xml; charset=utf-8')
+        elif self.path.startswith('/pdf/') and self.path.endswith('.pdf'):
+            parcel_number = self.path[len('/pdf/'):-len('.pdf')]
+            service.downloads.append(parcel_number)
+            self._respond(200, make_label_pdf(parcel_number),
+                          'application/pdf')
+        else:
+            self._respond(404, b'', 'text/plain')
+
+    def do_POST(self):  # pylint: disable=C0103
+        """Answer a getLetterColissimo call."""
+        service = self.server.service
+        service.connections.add(self.client_address)
+        length = int(self.headers.get('Content-Length', 0))
+        envelope = self.rfile.read(length)
+        status, body = service.handle_letter(envelope)
+        self._respond(status, body, 'text/xml; charset=utf-8')
+
+    def _respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        pass
+
+
+class FakeLetterService(object):
+    """A local HTTP server standing in for the WSColiPosteLetterService.
+
+    It serves the stand-in WSDL, with the service address pointing to itself,
+    answers every getLetterColissimo call with a canned response, and serves
+    the PDF label of each parcel number. Use it as a context manager, or call
+    start() and stop().
+
+    Args:
+        error_id (int, optional): The errorID returned by every call.
+        error (str, optional): The error message returned by every call.
+        latency (float, optional): Seconds waited before answering a call.
+        error_rate (float, optional): Share of the calls answered with the
+            errorID RANDOM_ERROR_ID, drawn at random.
+        fault_rate (float, optional): Share of the calls answered with a
+            server fault, drawn at random.
+        seed (optional): Seed of the random draws, for repeatable runs.
+
+    Attributes:
+        failures: The number of next calls answered with a server fault.
+        healthy: Whether the supervision page reports the service up.
+        envelopes: The SOAP envelopes received, in arrival order.
+        connections: The client addresses of the connections the calls were
+            received on.
+        downloads: The parcel numbers of the PDF labels downloaded.
+    """
+
+    def __init__(self, error_id=0, error='', latency=0, error_rate=0,
+                 fault_rate=0, seed=None):
+        self.error_id = error_id
+        self.error = error
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fault_rate = fault_rate
+        self.failures = 0
+        self.healthy = True
+        self.envelopes = []
+        self.connections = set()
+        self.downloads = []
+        self._counter = itertools.count(1)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base URL of the server."""
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    @property
+    def endpoint_url(self):
+        """URL of the webservice endpoint."""
+        return '{}{}'.format(self.url, 'WSColiPosteLetterService')
+
+    @property
+    def supervision_url(self):
+        """URL of the supervision page."""
+        return '{}{}'.format(self.url.rstrip('/'), SUPERVISION_PATH)
+
+    @property
+    def wsdl_url(self):
+        """URL of the WSDL."""
+        return '{}{}'.format(self.endpoint_url, '?wsdl')
+
+    @property
+    def wsdl(self):
+        """The WSDL document, pointing to this server."""
+        with open(WSDL_PATH, 'rb') as wsdl_file:
+            wsdl = wsdl_file.read()
+        return wsdl.replace(WSDL_LOCATION.encode('utf-8'),
+                            self.endpoint_url.encode('utf-8'))
+
+    def handle_letter(self, envelope):
+        """Record the request envelope and build the response.
+
+        Returns:
+            A tuple (HTTP status, response envelope).
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.envelopes.append(envelope)
+            draw = self._random.random()
+            if self.failures or draw < self.fault_rate:
+                self.failures = max(self.failures - 1, 0)
+                fault = FAULT_TEMPLATE.format(faultstring='Service failure')
+                return 500, fault.encode('utf-8')
+            error_id, error = self.error_id, self.error
+            if draw < self.fault_rate + self.error_rate:
+                error_id, error = RANDOM_ERROR_ID, 'Random failure'
+            parcel_number = '8V{:09d}'.format(next(self._counter))
+        response = RESPONSE_TEMPLATE.format(
+            pdf_url='{}pdf/{}.pdf'.format(self.url, parcel_number),
+            error_id=error_id, error=error, parcel_number=parcel_number)
+        return 200, response.encode('utf-8')
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                           _LetterServiceHandler)
+        self._server.daemon_threads = True
+        self._server.service = self
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the server."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,12 +1,82 @@
 # -*- coding: utf-8 -*-
 """Module tests."""
+import asyncio
 import datetime
-from mock import patch
-from django.test import SimpleTestCase
+import io
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from xml.etree import ElementTree
+import requests
+from mock import patch, Mock
+from suds.client import Client
+from suds.transport import Request, TransportError
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage
+from django.apps import apps
+from django.core.management import call_command
+from unittest import skipIf
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         override_settings)
+from django.utils import timezone
 from socolissimo import client as client_module
-from socolissimo.client import SoColissimoClient
+from socolissimo.accounts import AccountRegistry, get_account_registry
+from socolissimo.aio import AsyncSoColissimoClient
+from socolissimo.bulk import (Checkpoint, build_letter, read_records,
+                              run_bulk)
+from socolissimo.client import (SoColissimoClient, SoColissimoException,
+                                ENGINE_TEMPLATE)
+from socolissimo.envelope import SoapFault, parse_letter_response
+from socolissimo.exceptions import (DeadlineExceeded, RateLimitExceeded,
+                                    ServiceTimeout, ServiceUnavailable,
+                                    TransientServiceError, UnknownAccount)
+from socolissimo import benchmarks, health, metrics, transport
+from socolissimo.health import HealthMonitor, get_health_monitor
+from socolissimo.idempotency import LetterResultCache
+from socolissimo.jobs.models import LabelJob
+from socolissimo.jobs.worker import LabelWorker
+from socolissimo.resilience import CircuitBreaker, RetryPolicy, deadline
+from socolissimo.postal import (PostalIndex, get_postal_index,
+                                normalize_city)
+from socolissimo.pipeline import LetterPipeline
+from socolissimo.printing import iter_print_files
+from socolissimo.prototypes import TypePrototypes, clone_instance
+from socolissimo.ratelimit import RateLimiter
+from socolissimo.routing import Endpoint, EndpointRouter, get_router
+from socolissimo.labels import (LabelCache, fetch_label, fetch_labels,
+                               get_label_cache)
+from socolissimo.management.commands.socolissimo_refresh_wsdl import \
+    snapshot_documents
+from socolissimo.testing import (FAULT_TEMPLATE, FakeLetterService,
+                                 make_label_pdf)
+from socolissimo.views import prometheus_metrics
+from socolissimo.transport import (RequestsTransport, TimingPlugin,
+                                   get_session, get_timeout)
 import copy
-from socolissimo.schema import SchemaValidationError
+from socolissimo.schema import (SchemaValidationError, ServiceCallContext,
+                                Parcel, ParcelRecipient, ParcelSender,
+                                RecipientAddress, Address)
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+try:
+    from importlib import reload
+except ImportError:  # Python 2
+    pass
+try:
+    basestring
+except NameError:  # Python 3
+    basestring = str
 
 
 CONTRACT_NUMBER = '123'
@@ -38,6 +108,97 @@ LETTER_REQUIRED_KWARGS = dict(
             'city': 'Bourg-en-Bresse'}
     })
 
+LETTER_FULL_KWARGS = dict(
+    service_call_context={
+        'dateDeposite': datetime.datetime(2016, 3, 1, 10, 30),
+        'commercialName': 'Chuck & Norris <Inc>',
+        'VATCode': 1,
+        'VATPercentage': 2000,
+        'VATAmount': 200,
+        'transportationAmount': 1000,
+        'totalAmount': 1200,
+        'commandNumber': 'CMD-42'
+    },
+    parcel={
+        'weight': '2',
+        'DeliveryMode': 'RDV',
+        'horsGabarit': True,
+        'insuranceValue': 5000,
+        'HorsGabaritAmount': 10,
+        'Instructions': 'Fragile'
+    },
+    recipient={
+        'addressVO': {
+            'Name': 'Norris',
+            'Surname' : 'Chuck',
+            'email': 'chuck.norris@awesome.com',
+            'Civility': 'M',
+            'companyName': 'Roundhouse',
+            'line0': '2e étage',
+            'line1': 'Bâtiment B',
+            'line2': '1 round-kick street',
+            'line3': 'Lieu dit "Texas"',
+            'countryCode': 'MC',
+            'postalCode': '98000',
+            'city': 'Monaco',
+            'phone': '0102030405',
+            'MobileNumber': '0602030405',
+            'DoorCode1': '1234',
+            'DoorCode2': '5678',
+            'Interphone': 'Norris'}
+    },
+    sender={
+        'addressVO': {
+            'companyName': 'Awesome shop',
+            'line2': '1 round-kick street',
+            'countryCode': 'FR',
+            'postalCode': '01000',
+            'city': 'Bourg-en-Bresse'}
+    })
+
+
+def xml_tree(envelope):
+    """Namespace resolved tree of an XML document, for comparisons."""
+    def node_tree(node):
+        return (node.tag, (node.text or '').strip(), sorted(node.attrib.items()),
+                [node_tree(child) for child in node])
+    return node_tree(ElementTree.fromstring(envelope))
+
+
+def patch_soap_client(service, **options):
+    """Patch the shared soap client to be built from the WSDL of a
+    FakeLetterService, the options being the ones of the suds client."""
+    return patch.object(client_module.SOAP_CLIENT, 'client',
+                        Client(service.wsdl_url, **options))
+
+
+@contextmanager
+def fake_letter_service(**options):
+    """Run a FakeLetterService called through the shared soap client, see
+    patch_soap_client."""
+    with FakeLetterService() as service, \
+            patch_soap_client(service, **options):
+        yield service
+
+
+class FakeServiceTestCase(SimpleTestCase):
+    """Test case running a FakeLetterService for each test, as self.service,
+    called through the shared soap client."""
+
+    def setUp(self):
+        super(FakeServiceTestCase, self).setUp()
+        self.service = FakeLetterService()
+        self.service.start()
+        self.addCleanup(self.service.stop)
+        soap_client_patch = patch_soap_client(self.service,
+                                              **self.soap_client_options())
+        soap_client_patch.start()
+        self.addCleanup(soap_client_patch.stop)
+
+    def soap_client_options(self):
+        """Return the options of the suds client of the service."""
+        return {}
+
 
 class TestClient(SimpleTestCase):
     def get_client(self):
@@ -72,12 +233,17 @@ class TestClient(SimpleTestCase):
             self.assertEqual(client.password, PASSWORD)
 
     def test_check_service_health(self):
-        with patch('socolissimo.client.requests') as mock_requests:
-            mock_requests.get.return_value.status_code = 200
-            mock_requests.get.return_value.content = '  [OK]  '
+        # Own router, not to take the default endpoint out of rotation.
+        endpoints = [{'url': None,
+                      'supervision_url': client_module.SUPERVISION_URL}]
+        with patch('socolissimo.transport.get_session') as mock_session, \
+                self.settings(SOCOLISSIMO_ENDPOINTS=endpoints):
+            mock_get = mock_session.return_value.get
+            mock_get.return_value.status_code = 200
+            mock_get.return_value.text = '  [OK]  '
             self.assertTrue(SoColissimoClient.check_service_health())
 
-            mock_requests.get.return_value.content = '[KO]'
+            mock_get.return_value.text = '[KO]'
             self.assertFalse(SoColissimoClient.check_service_health())
 
     def test_get_letter_ok(self):
@@ -145,7 +311,7 @@ class TestClient(SimpleTestCase):
         # Not a valid choice
         assert_invalid_param('service_call_context.VATCode', 4)
         # Not a valid percentage format
-        assert_invalid_param('service_call_context.VATPercentage', 20.00)
+        assert_invalid_param('service_call_context.VATPercentage', 20.5)
         assert_invalid_param('service_call_context.VATPercentage', -1)
         assert_invalid_param('service_call_context.VATPercentage', 10000)
         # Not a valid VAT amount
@@ -161,3 +327,1941 @@ class TestClient(SimpleTestCase):
         assert_invalid_param('parcel.insuranceValue', -1)
         # Not a valid transportation amount
         assert_invalid_param('parcel.HorsGabaritAmount', -1)
+
+    def test_get_letters(self):
+        client = self.get_client()
+        invalid_letter = copy.deepcopy(LETTER_REQUIRED_KWARGS)
+        invalid_letter['parcel']['weight'] = '31'
+        rejected_letter = copy.deepcopy(LETTER_REQUIRED_KWARGS)
+        rejected_letter['parcel']['weight'] = '5'
+
+        def soap_call(letter):
+            response = Mock(parcelNumber='8V123', PdfUrl='http://pdf')
+            response.errorID = 30000 if letter.parcel.weight == 5 else 0
+            return response
+
+        # Each worker thread has its own soap client.
+        with patch('suds.client.Method.__call__', side_effect=soap_call):
+            results = client.get_letters([LETTER_REQUIRED_KWARGS,
+                                          invalid_letter,
+                                          rejected_letter,
+                                          LETTER_REQUIRED_KWARGS],
+                                         max_workers=2)
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0], ('8V123', 'http://pdf'))
+        self.assertIsInstance(results[1], SchemaValidationError)
+        self.assertIsInstance(results[2], SoColissimoException)
+        self.assertEqual(results[3], ('8V123', 'http://pdf'))
+
+
+class TestSoapClientPool(SimpleTestCase):
+    def setUp(self):
+        self.master = client_module.SOAP_CLIENT.master
+
+    def get_pool(self, **kwargs):
+        pool = client_module.SoapClientPool(**kwargs)
+        pool.client = self.master
+        return pool
+
+    def test_thread_mode(self):
+        pool = self.get_pool(mode=client_module.POOL_THREAD)
+        soap_client = pool.soap_client
+        self.assertIsNot(soap_client, self.master)
+        self.assertIs(soap_client.wsdl, self.master.wsdl)
+        self.assertIs(pool.soap_client, soap_client)
+        with pool.checkout() as checked_out:
+            self.assertIs(checked_out, soap_client)
+
+        other_clients = []
+        thread = threading.Thread(
+            target=lambda: other_clients.append(pool.soap_client))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_clients[0], soap_client)
+
+        # A new master, i.e. a new WSDL, discards the clones.
+        pool.client = Client(client_module.get_wsdl_url())
+        self.assertIsNot(pool.soap_client, soap_client)
+
+    def test_checkout_mode(self):
+        pool = self.get_pool(mode=client_module.POOL_CHECKOUT, size=2,
+                             timeout=0.1)
+        with pool.checkout() as first, pool.checkout() as second:
+            self.assertIsNot(first, second)
+            self.assertIs(first.wsdl, self.master.wsdl)
+            with self.assertRaises(client_module.SoapClientPoolTimeout):
+                with pool.checkout():
+                    pass
+
+        with pool.checkout() as third:
+            self.assertIn(third, (first, second))
+
+    def test_checkout_waits_for_release(self):
+        pool = self.get_pool(mode=client_module.POOL_CHECKOUT, size=1)
+        checked_out = []
+
+        def worker():
+            with pool.checkout() as soap_client:
+                checked_out.append(soap_client)
+
+        with pool.checkout() as soap_client:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual(checked_out, [])
+        thread.join()
+        self.assertEqual(checked_out, [soap_client])
+
+
+class TestWarmUp(SimpleTestCase):
+    def test_lazy_imports(self):
+        code = ('import sys\n'
+                'from django.conf import settings\n'
+                'settings.configure()\n'
+                'import socolissimo.client\n'
+                'print(",".join(sorted(name for name in sys.modules\n'
+                '                      if name.split(".")[0] in (\n'
+                '                          "suds", "requests")\n'
+                '                      or name.startswith("django.forms"))))')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'')
+
+    def test_client_does_not_load_wsdl(self):
+        pool = client_module.SoapClientPool()
+        with patch.object(client_module, 'SOAP_CLIENT', pool):
+            SoColissimoClient(contract_number=CONTRACT_NUMBER,
+                              password=PASSWORD)
+        self.assertIsNone(pool.client)
+
+    def test_warm_up(self):
+        pool = client_module.SoapClientPool()
+        with patch.object(client_module, 'SOAP_CLIENT', pool):
+            client_module.warm_up()
+        self.assertIsNotNone(pool.client)
+        self.assertIs(pool.template.soap_client, pool.client)
+        for schema_class in (ServiceCallContext, Parcel, ParcelRecipient,
+                             ParcelSender):
+            self.assertIn('_compiled_schema', schema_class.__dict__)
+
+    def test_ready(self):
+        config = apps.get_app_config('socolissimo')
+        with patch.object(client_module, 'warm_up') as warm_up:
+            config.ready()
+            self.assertFalse(warm_up.called)
+            with self.settings(SOCOLISSIMO_WARM_UP=True):
+                config.ready()
+            self.assertEqual(warm_up.call_count, 1)
+
+            # The server starts even if the service cannot be reached.
+            warm_up.side_effect = requests.ConnectionError('Unreachable')
+            with self.settings(SOCOLISSIMO_WARM_UP=True), \
+                    self.assertLogs('socolissimo.apps', 'ERROR'):
+                config.ready()
+
+    def test_session_dropped_after_fork(self):
+        session = get_session()
+        requests_transport = copy.deepcopy(RequestsTransport())
+        transport._forget_session()  # pylint: disable=W0212
+        self.assertIsNot(get_session(), session)
+        # Transports created before the fork use the session of the child.
+        self.assertIs(requests_transport.session, get_session())
+        own_session = requests.Session()
+        self.assertIs(copy.deepcopy(RequestsTransport(own_session)).session,
+                      own_session)
+
+
+class TestAccounts(SimpleTestCase):
+    ACCOUNTS = {
+        'brand_a': {'contract_number': '111111', 'password': 'a'},
+        'brand_b': {'contract_number': '222222', 'password': 'b',
+                    'engine': ENGINE_TEMPLATE},
+    }
+
+    def test_registry(self):
+        registry = AccountRegistry(self.ACCOUNTS)
+        self.assertEqual(registry.names(), ['brand_a', 'brand_b'])
+        self.assertIn('brand_a', registry)
+        client = registry.get('brand_b')
+        self.assertEqual(client.contract_number, 222222)
+        self.assertEqual(client.engine, ENGINE_TEMPLATE)
+        self.assertIs(registry.get('brand_b'), client)
+        self.assertRaises(UnknownAccount, registry.get, 'brand_c')
+
+    def test_invalid_account(self):
+        self.assertRaises(ImproperlyConfigured, AccountRegistry,
+                          {'brand_a': {'contract_number': 'abc',
+                                       'password': 'a'}})
+        self.assertRaises(ImproperlyConfigured, AccountRegistry,
+                          {'brand_a': {'contract': '111111'}})
+
+    def test_settings(self):
+        with self.settings(SOCOLISSIMO_ACCOUNTS=self.ACCOUNTS):
+            registry = get_account_registry()
+            self.assertIs(get_account_registry(), registry)
+        with self.settings(SOCOLISSIMO_ACCOUNTS={
+                'brand_c': {'contract_number': '333333', 'password': 'c'}}):
+            self.assertEqual(get_account_registry().names(), ['brand_c'])
+
+    def test_get_letters(self):
+        registry = AccountRegistry(self.ACCOUNTS)
+        letters = [dict(LETTER_REQUIRED_KWARGS, account='brand_a'),
+                   dict(LETTER_REQUIRED_KWARGS, account='brand_b'),
+                   dict(LETTER_REQUIRED_KWARGS, account='brand_c'),
+                   dict(LETTER_REQUIRED_KWARGS, account='brand_a')]
+        with fake_letter_service() as service:
+            outcomes = registry.get_letters(letters, max_workers=2)
+        self.assertEqual(len(outcomes), 4)
+        self.assertIsInstance(outcomes[2], UnknownAccount)
+        for outcome in outcomes[:2] + outcomes[3:]:
+            self.assertIsInstance(outcome, tuple)
+        self.assertEqual(len(service.envelopes), 3)
+        self.assertEqual(sum(b'111111' in envelope
+                             for envelope in service.envelopes), 2)
+        self.assertEqual(sum(b'222222' in envelope
+                             for envelope in service.envelopes), 1)
+
+
+class TestRequestsTransport(SimpleTestCase):
+    def test_keep_alive(self):
+        with fake_letter_service(transport=RequestsTransport()) as service:
+            client = client_module.SoColissimoClient(
+                contract_number=CONTRACT_NUMBER, password=PASSWORD)
+            for _ in range(3):
+                client.get_letter(**LETTER_REQUIRED_KWARGS)
+        self.assertEqual(len(service.envelopes), 3)
+        self.assertEqual(len(service.connections), 1)
+
+    def test_clones_share_session(self):
+        soap_client = client_module.SOAP_CLIENT.clone()
+        self.assertIsInstance(soap_client.options.transport,
+                              RequestsTransport)
+        self.assertIs(soap_client.options.transport.session, get_session())
+
+    def test_http_error(self):
+        response = Mock(status_code=500, reason='Server Error',
+                        content=b'<fault/>')
+        with patch.object(get_session(), 'post', return_value=response):
+            with self.assertRaises(TransportError) as context:
+                RequestsTransport().send(Request('http://ws', b''))
+        self.assertEqual(context.exception.httpcode, 500)
+        self.assertEqual(context.exception.fp.read(), b'<fault/>')
+
+
+class TestAsyncClient(FakeServiceTestCase):
+    def setUp(self):
+        super(TestAsyncClient, self).setUp()
+        self.client = AsyncSoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD,
+            retry_policy=RetryPolicy(max_attempts=1))
+
+    def test_get_letter(self):
+        parcel_number, pdf_url = asyncio.run(
+            self.client.get_letter(**LETTER_REQUIRED_KWARGS))
+        self.assertEqual(parcel_number, '8V000000001')
+        self.assertEqual(pdf_url,
+                         '{}pdf/8V000000001.pdf'.format(self.service.url))
+        self.assertIn(b'>Chuck Norris</', self.service.envelopes[0])
+
+    def test_get_letter_error(self):
+        self.service.error_id = 30000
+        self.service.error = 'Invalid postal code'
+        with self.assertRaises(SoColissimoException):
+            asyncio.run(self.client.get_letter(**LETTER_REQUIRED_KWARGS))
+
+    def test_get_letters(self):
+        invalid_letter = copy.deepcopy(LETTER_REQUIRED_KWARGS)
+        invalid_letter['parcel']['weight'] = '31'
+        letters = [LETTER_REQUIRED_KWARGS] * 20 + [invalid_letter]
+
+        results = asyncio.run(self.client.get_letters(letters,
+                                                      max_concurrency=5))
+
+        self.assertEqual(len(results), 21)
+        self.assertEqual(len(set(results[:20])), 20)
+        self.assertIsInstance(results[20], SchemaValidationError)
+        self.assertEqual(len(self.service.envelopes), 20)
+
+    def test_get_letter_retries(self):
+        probe = Mock(return_value=False)
+        circuit_breaker = CircuitBreaker(probe, failure_threshold=3,
+                                         reset_timeout=60)
+        for engine in client_module.ENGINES:
+            self.service.envelopes = []
+            circuit_breaker.reset()
+            client = AsyncSoColissimoClient(
+                contract_number=CONTRACT_NUMBER, password=PASSWORD,
+                engine=engine, retry_policy=RetryPolicy(
+                    circuit_breaker, max_attempts=3, backoff=0))
+            self.service.failures = 2
+            parcel_number, _ = asyncio.run(
+                client.get_letter(**LETTER_REQUIRED_KWARGS))
+            self.assertTrue(parcel_number.startswith('8V'))
+            self.assertEqual(len(self.service.envelopes), 3)
+
+            # The failures open the circuit, which then fails fast.
+            self.service.failures = 3
+            with self.assertRaises(TransientServiceError):
+                asyncio.run(client.get_letter(**LETTER_REQUIRED_KWARGS))
+            self.assertTrue(circuit_breaker.is_open)
+            with self.assertRaises(ServiceUnavailable):
+                asyncio.run(client.get_letter(**LETTER_REQUIRED_KWARGS))
+            self.assertEqual(len(self.service.envelopes), 6)
+
+        # The deadline bounds the timeout of the calls.
+        async def post_within_deadline(url, body, headers, timeout):
+            self.assertLessEqual(timeout, 1)
+            raise asyncio.TimeoutError()
+
+        client = AsyncSoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD,
+            retry_policy=RetryPolicy(max_attempts=1, deadline=1))
+        with patch('socolissimo.aio.http_post', post_within_deadline):
+            with self.assertRaises(ServiceTimeout):
+                asyncio.run(client.get_letter(**LETTER_REQUIRED_KWARGS))
+
+    def test_get_letter_result_cache(self):
+        caches['default'].clear()
+        with self.settings(SOCOLISSIMO_RESULT_CACHE='default'):
+            client = AsyncSoColissimoClient(contract_number=CONTRACT_NUMBER,
+                                            password=PASSWORD,
+                                            engine=ENGINE_TEMPLATE)
+        letter = copy.deepcopy(LETTER_REQUIRED_KWARGS)
+        letter['service_call_context']['commandNumber'] = 'CMD-42'
+        result = asyncio.run(client.get_letter(**letter))
+        self.assertEqual(asyncio.run(client.get_letter(**letter)), result)
+        self.assertEqual(len(self.service.envelopes), 1)
+
+        # Identical concurrent letters are issued once.
+        letter['service_call_context']['commandNumber'] = 'CMD-43'
+        results = asyncio.run(client.get_letters([letter] * 5))
+        self.assertEqual(len(set(results)), 1)
+        self.assertNotEqual(results[0], result)
+        self.assertEqual(len(self.service.envelopes), 2)
+
+    def test_get_letters_network_errors(self):
+        async def unavailable(url, body, headers, timeout):
+            return 503, b'Service Unavailable'
+
+        async def timeout(url, body, headers, timeout):
+            raise asyncio.TimeoutError()
+
+        letters = [LETTER_REQUIRED_KWARGS] * 3
+        with patch('socolissimo.aio.http_post', unavailable):
+            results = asyncio.run(self.client.get_letters(letters))
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsInstance(result, TransientServiceError)
+        with patch('socolissimo.aio.http_post', timeout):
+            results = asyncio.run(self.client.get_letters(letters))
+        for result in results:
+            self.assertIsInstance(result, ServiceTimeout)
+
+        # Connection refused by a stopped server.
+        closed = FakeLetterService()
+        closed.start()
+        closed.stop()
+        with self.settings(SOCOLISSIMO_ENDPOINTS=[closed.endpoint_url]):
+            results = asyncio.run(self.client.get_letters(letters))
+        for result in results:
+            self.assertIsInstance(result, TransientServiceError)
+
+    def test_get_letters_rate_limit(self):
+        caches['default'].clear()
+        self.client.rate_limiter = RateLimiter(rate=50, burst=1)
+        letters = [LETTER_REQUIRED_KWARGS] * 6
+        start = time.monotonic()
+        results = asyncio.run(self.client.get_letters(letters))
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(len(set(results)), 6)
+
+        # Letters waiting too long for a token are refused.
+        caches['default'].clear()
+        self.client.rate_limiter = RateLimiter(rate=1, burst=1, max_wait=0.5)
+        results = asyncio.run(self.client.get_letters(letters[:3]))
+        self.assertEqual(len([result for result in results
+                              if isinstance(result, RateLimitExceeded)]), 2)
+        self.assertEqual(len(self.service.envelopes), 7)
+
+        # The deadline of the call bounds the wait for a token.
+        caches['default'].clear()
+        client = AsyncSoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD,
+            retry_policy=RetryPolicy(max_attempts=1, deadline=0.5))
+        client.rate_limiter = RateLimiter(rate=1, burst=1)
+        results = asyncio.run(client.get_letters(letters[:3]))
+        self.assertEqual(len([result for result in results
+                              if isinstance(result, DeadlineExceeded)]), 2)
+        self.assertEqual(len(self.service.envelopes), 8)
+
+
+class TestResultCache(FakeServiceTestCase):
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        with self.settings(SOCOLISSIMO_RESULT_CACHE='default'):
+            self.client = client_module.SoColissimoClient(
+                contract_number=CONTRACT_NUMBER, password=PASSWORD)
+        self.client.result_cache.cache.clear()
+
+    def test_get_letter_cached(self):
+        result = self.client.get_letter(**LETTER_REQUIRED_KWARGS)
+        self.assertEqual(self.client.get_letter(**LETTER_REQUIRED_KWARGS),
+                         result)
+        self.assertEqual(len(self.service.envelopes), 1)
+
+        self.client.get_letter(**LETTER_FULL_KWARGS)
+        self.assertEqual(len(self.service.envelopes), 2)
+
+        uncached_client = client_module.SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD,
+            use_result_cache=False)
+        self.assertIsNone(uncached_client.result_cache)
+        uncached_client.get_letter(**LETTER_REQUIRED_KWARGS)
+        self.assertEqual(len(self.service.envelopes), 3)
+
+    def test_command_number(self):
+        letter = copy.deepcopy(LETTER_REQUIRED_KWARGS)
+        letter['service_call_context']['commandNumber'] = 'CMD-42'
+        result = self.client.get_letter(**letter)
+
+        letter['parcel']['weight'] = 2
+        self.assertEqual(self.client.get_letter(**letter), result)
+        self.assertEqual(len(self.service.envelopes), 1)
+
+    def test_errors_not_cached(self):
+        self.service.error_id = 30000
+        self.assertRaises(client_module.SoColissimoException,
+                          self.client.get_letter, **LETTER_REQUIRED_KWARGS)
+        self.service.error_id = 0
+        self.client.get_letter(**LETTER_REQUIRED_KWARGS)
+        self.assertEqual(len(self.service.envelopes), 2)
+
+    def test_get_letters(self):
+        results = self.client.get_letters([LETTER_REQUIRED_KWARGS] * 10)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(len(self.service.envelopes), 1)
+
+    def test_coalescing(self):
+        result_cache = LetterResultCache()
+        entered = threading.Semaphore(0)
+        calls = []
+
+        class InFlight(dict):
+            def get(self, key, default=None):
+                # Each thread looks for the call in flight once.
+                entered.release()
+                return super(InFlight, self).get(key, default)
+
+        result_cache._in_flight = InFlight()  # pylint: disable=W0212
+
+        def issue_letter():
+            calls.append(None)
+            # Held until every thread has found this call in flight.
+            for _ in threads:
+                entered.acquire(timeout=5)
+            return ('8V000000001', 'http://pdf')
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            result_cache.get_or_call('socolissimo:test', issue_letter)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [('8V000000001', 'http://pdf')] * 5)
+
+
+class TestResilience(FakeServiceTestCase):
+    def setUp(self):
+        super(TestResilience, self).setUp()
+        self.probe = Mock(return_value=False)
+        self.circuit_breaker = CircuitBreaker(self.probe, failure_threshold=10,
+                                              reset_timeout=60)
+
+    def make_client(self, engine=None, **policy):
+        policy.setdefault('backoff', 0)
+        retry_policy = RetryPolicy(self.circuit_breaker, **policy)
+        return client_module.SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD, engine=engine,
+            retry_policy=retry_policy)
+
+    def test_retry_server_faults(self):
+        for engine in (client_module.ENGINE_SUDS, ENGINE_TEMPLATE):
+            self.service.envelopes = []
+            self.service.failures = 2
+            client = self.make_client(engine)
+            parcel_number, _ = client.get_letter(**LETTER_REQUIRED_KWARGS)
+            self.assertTrue(parcel_number.startswith('8V'))
+            self.assertEqual(len(self.service.envelopes), 3)
+
+            self.service.failures = 3
+            self.assertRaises(TransientServiceError, client.get_letter,
+                              **LETTER_REQUIRED_KWARGS)
+
+    def test_error_ids(self):
+        client = self.make_client(max_attempts=2)
+        self.service.error_id = 30000
+        self.assertRaises(client_module.SoColissimoException,
+                          client.get_letter, **LETTER_REQUIRED_KWARGS)
+        self.assertEqual(len(self.service.envelopes), 1)
+
+        with self.settings(SOCOLISSIMO_TRANSIENT_ERROR_IDS=(30000,)):
+            self.assertRaises(TransientServiceError, client.get_letter,
+                              **LETTER_REQUIRED_KWARGS)
+        self.assertEqual(len(self.service.envelopes), 3)
+
+    def test_network_errors(self):
+        self.service.stop()
+        client = self.make_client()
+        self.assertRaises(TransientServiceError, client.get_letter,
+                          **LETTER_REQUIRED_KWARGS)
+        self.service.start()
+
+    def test_fault_classification(self):
+        classify_fault = client_module.classify_fault
+        self.assertIs(classify_fault(500, 'soapenv:Server'),
+                      TransientServiceError)
+        self.assertIs(classify_fault(200, 'Server'), TransientServiceError)
+        self.assertIs(classify_fault(500, 'soapenv:Client'),
+                      client_module.SoColissimoException)
+        self.assertIs(classify_fault(503, None), TransientServiceError)
+        self.assertIs(classify_fault(404, None),
+                      client_module.SoColissimoException)
+
+        # A server fault is retried by every engine and client, even when
+        # answered with an unexpected status.
+        fault = FAULT_TEMPLATE.format(faultstring='Failure').encode('utf-8')
+
+        def handle_letter(envelope):
+            self.service.envelopes.append(envelope)
+            return 200, fault
+
+        # suds logs the unexpected status.
+        with patch.object(self.service, 'handle_letter', handle_letter), \
+                patch('suds.client.log'):
+            for engine in client_module.ENGINES:
+                self.service.envelopes = []
+                client = self.make_client(engine, max_attempts=2)
+                self.assertRaises(TransientServiceError, client.get_letter,
+                                  **LETTER_REQUIRED_KWARGS)
+                self.assertEqual(len(self.service.envelopes), 2)
+
+                self.service.envelopes = []
+                client = AsyncSoColissimoClient(
+                    contract_number=CONTRACT_NUMBER, password=PASSWORD,
+                    engine=engine,
+                    retry_policy=RetryPolicy(max_attempts=2, backoff=0))
+                with self.assertRaises(TransientServiceError):
+                    asyncio.run(client.get_letter(**LETTER_REQUIRED_KWARGS))
+                self.assertEqual(len(self.service.envelopes), 2)
+
+    def test_circuit_breaker(self):
+        self.circuit_breaker = CircuitBreaker(self.probe, failure_threshold=2,
+                                              reset_timeout=60)
+        client = self.make_client(max_attempts=1)
+        self.service.failures = 2
+        for _ in range(2):
+            self.assertRaises(TransientServiceError, client.get_letter,
+                              **LETTER_REQUIRED_KWARGS)
+        self.assertTrue(self.circuit_breaker.is_open)
+        self.assertRaises(ServiceUnavailable, client.get_letter,
+                          **LETTER_REQUIRED_KWARGS)
+        self.assertEqual(len(self.service.envelopes), 2)
+        self.assertFalse(self.probe.called)
+
+        self.circuit_breaker._reset_timeout = 0
+        self.assertRaises(ServiceUnavailable, client.get_letter,
+                          **LETTER_REQUIRED_KWARGS)
+        self.assertEqual(self.probe.call_count, 1)
+
+        self.probe.return_value = True
+        client.get_letter(**LETTER_REQUIRED_KWARGS)
+        self.assertFalse(self.circuit_breaker.is_open)
+        self.assertEqual(len(self.service.envelopes), 3)
+
+    def test_local_errors(self):
+        retry_policy = RetryPolicy(self.circuit_breaker, max_attempts=1)
+        self.circuit_breaker.record_failure()
+        # Errors of the client, the service not answering, are no success.
+        for exc in (RateLimitExceeded('Limited'), DeadlineExceeded('Late'),
+                    client_module.SoapClientPoolTimeout('Busy')):
+            self.assertRaises(type(exc), retry_policy.call,
+                              Mock(side_effect=exc))
+            self.assertEqual(self.circuit_breaker._failures, 1)
+        self.assertRaises(client_module.SoColissimoException,
+                          retry_policy.call,
+                          Mock(side_effect=client_module.SoColissimoException(
+                              'Error 30000')))
+        self.assertEqual(self.circuit_breaker._failures, 0)
+
+    def test_deadline(self):
+        client = self.make_client(max_attempts=5, backoff=30, deadline=1)
+        self.service.failures = 5
+        # Draw the longest backoff, beyond the deadline.
+        with patch('socolissimo.resilience.random.uniform',
+                   side_effect=lambda low, high: high):
+            self.assertRaises(DeadlineExceeded, client.get_letter,
+                              **LETTER_REQUIRED_KWARGS)
+        self.assertEqual(len(self.service.envelopes), 1)
+
+    def test_deadline_bounds_timeouts(self):
+        self.assertEqual(get_timeout(), (5, 30))
+        with deadline(time.monotonic() + 2):
+            connect_timeout, read_timeout = get_timeout()
+        self.assertLessEqual(connect_timeout, 2)
+        self.assertLessEqual(read_timeout, 2)
+        self.assertEqual(get_timeout(), (5, 30))
+
+
+class TestHealthMonitor(SimpleTestCase):
+    def setUp(self):
+        self.probe = Mock(return_value=True)
+
+    def test_check(self):
+        monitor = HealthMonitor(interval=30, history_size=2, probe=self.probe)
+        self.assertIsNone(monitor.status)
+        self.assertFalse(monitor.is_healthy())
+
+        for healthy in (True, False, True):
+            self.probe.return_value = healthy
+            monitor.poll()
+        self.probe.side_effect = requests.ConnectionError
+        status = monitor.poll()
+
+        self.assertFalse(status.healthy)
+        self.assertGreaterEqual(status.latency, 0)
+        self.assertLess(monitor.age, 30)
+        self.assertEqual([status.healthy for status in monitor.history],
+                         [True, False])
+        self.assertFalse(monitor.is_healthy())
+
+    def test_shared_through_cache(self):
+        caches['default'].clear()
+        other_probe = Mock(return_value=False)
+        monitor = HealthMonitor(interval=30, cache_alias='default',
+                                probe=self.probe)
+        other_monitor = HealthMonitor(interval=30, cache_alias='default',
+                                      probe=other_probe)
+
+        monitor.poll()
+        status = other_monitor.poll()
+
+        self.assertEqual(self.probe.call_count, 1)
+        self.assertFalse(other_probe.called)
+        self.assertEqual(status, monitor.status)
+        self.assertTrue(other_monitor.is_healthy())
+
+    def test_background_polling(self):
+        monitor = HealthMonitor(interval=0.01, probe=self.probe)
+        monitor.start()
+        self.addCleanup(monitor.stop)
+        for _ in range(100):
+            if len(monitor.history) >= 2:
+                break
+            time.sleep(0.01)
+        self.assertGreaterEqual(len(monitor.history), 2)
+        self.assertTrue(monitor.is_healthy())
+
+    def test_dropped_after_fork(self):
+        self.addCleanup(health._forget_health_monitor)  # pylint: disable=W0212
+        with patch.object(HealthMonitor, 'start') as start:
+            monitor = get_health_monitor()
+            health._forget_health_monitor()  # pylint: disable=W0212
+            self.assertIsNot(get_health_monitor(), monitor)
+        self.assertEqual(start.call_count, 2)
+
+
+class TestMetrics(FakeServiceTestCase):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.sink = metrics.HistogramSink()
+        metrics.add_sink(self.sink)
+        self.addCleanup(metrics.remove_sink, self.sink)
+
+    def soap_client_options(self):
+        return {'plugins': [TimingPlugin()]}
+
+    def test_phases(self):
+        phases = ['validate', 'build', 'marshal', 'network', 'parse']
+        for engine in (client_module.ENGINE_SUDS, ENGINE_TEMPLATE):
+            client = client_module.SoColissimoClient(
+                contract_number=CONTRACT_NUMBER, password=PASSWORD,
+                engine=engine)
+            client.get_letter(**LETTER_REQUIRED_KWARGS)
+            client.get_letter(**LETTER_REQUIRED_KWARGS)
+            for phase in phases:
+                histogram = self.sink.histogram(metrics.PHASE_METRIC,
+                                                phase=phase, engine=engine)
+                self.assertEqual(histogram['count'], 2)
+                self.assertEqual(histogram['buckets'][-1][1], 2)
+                self.assertGreater(histogram['sum'], 0)
+        self.assertEqual(self.sink.counter(metrics.CALLS_METRIC,
+                                           outcome='ok'), 4)
+
+    def test_error_ids(self):
+        self.service.error_id = 30000
+        client = client_module.SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD)
+        self.assertRaises(client_module.SoColissimoException,
+                          client.get_letter, **LETTER_REQUIRED_KWARGS)
+        self.assertEqual(self.sink.counter(metrics.ERRORS_METRIC,
+                                           error_id=30000), 1)
+        self.assertEqual(self.sink.counter(metrics.CALLS_METRIC,
+                                           outcome='error'), 1)
+
+    def test_disabled(self):
+        metrics.remove_sink(self.sink)
+        self.assertFalse(metrics.is_enabled())
+        self.assertIs(metrics.time_phase('validate', 'suds'),
+                      metrics.time_phase('build', 'suds'))
+        client = client_module.SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD)
+        client.get_letter(**LETTER_REQUIRED_KWARGS)
+        self.assertIsNone(self.sink.histogram(metrics.PHASE_METRIC,
+                                              phase='validate', engine='suds'))
+
+    def test_prometheus_view(self):
+        metrics.HISTOGRAM.reset()
+        self.addCleanup(metrics.HISTOGRAM.reset)
+        self.addCleanup(metrics.remove_sink, metrics.HISTOGRAM)
+        metrics.enable_histogram()
+        metrics.observe(metrics.PHASE_METRIC, 0.003, phase='parse',
+                        engine='suds')
+        metrics.increment(metrics.ERRORS_METRIC, error_id='30000')
+
+        response = prometheus_metrics(RequestFactory().get('/metrics'))
+
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        lines = response.content.decode('utf-8').splitlines()
+        self.assertIn('# TYPE socolissimo_phase_seconds histogram', lines)
+        self.assertIn('socolissimo_phase_seconds_bucket{engine="suds",'
+                      'phase="parse",le="0.0025"} 0', lines)
+        self.assertIn('socolissimo_phase_seconds_bucket{engine="suds",'
+                      'phase="parse",le="0.005"} 1', lines)
+        self.assertIn('socolissimo_phase_seconds_bucket{engine="suds",'
+                      'phase="parse",le="+Inf"} 1', lines)
+        self.assertIn('socolissimo_phase_seconds_count{engine="suds",'
+                      'phase="parse"} 1', lines)
+        self.assertIn('socolissimo_errors_total{error_id="30000"} 1', lines)
+
+
+class TestBenchmarks(SimpleTestCase):
+    def test_run(self):
+        master = client_module.SOAP_CLIENT.client
+        results = benchmarks.run(error_rate=0.5, calls=4, batch_size=4,
+                                 concurrency_levels=(1, 2), validations=2,
+                                 startups=1)
+
+        self.assertIs(client_module.SOAP_CLIENT.client, master)
+        self.assertEqual(results['startup']['cold']['count'], 1)
+        self.assertEqual(set(results['validation']),
+                         set(schema_class.__name__ for schema_class, _
+                             in benchmarks.VALIDATED_SCHEMAS))
+        for engine in client_module.ENGINES:
+            self.assertEqual(results['single_call'][engine]['count'], 4)
+            self.assertGreater(results['single_call'][engine]['errors'], 0)
+            self.assertEqual(set(results['batch'][engine]), {'1', '2'})
+        json.dumps(results)
+
+        comparison = dict(
+            (path, ratio) for path, _, _, ratio
+            in benchmarks.compare(results, results))
+        self.assertEqual(comparison['batch.suds.2.throughput'], 1)
+        self.assertNotIn('parameters.calls', comparison)
+
+
+class TestLabelJobs(FakeServiceTestCase, TestCase):
+    def setUp(self):
+        super(TestLabelJobs, self).setUp()
+        self.client = client_module.SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD,
+            use_result_cache=False, retry_policy=RetryPolicy(max_attempts=1))
+        self.worker = LabelWorker(self.client, batch_size=2, max_attempts=2)
+
+    def test_enqueue(self):
+        invalid_letter = copy.deepcopy(LETTER_REQUIRED_KWARGS)
+        invalid_letter['parcel']['weight'] = '31'
+        self.assertRaises(SchemaValidationError, LabelJob.enqueue,
+                          **invalid_letter)
+
+        job = LabelJob.objects.get(pk=LabelJob.enqueue(**LETTER_FULL_KWARGS).pk)
+        self.assertEqual(job.status, LabelJob.PENDING)
+        self.assertEqual(job.payload['service_call_context']['dateDeposite'],
+                         '2016-03-01T10:30:00')
+
+    def test_process(self):
+        jobs = [LabelJob.enqueue(**LETTER_REQUIRED_KWARGS) for _ in range(3)]
+
+        self.assertEqual(self.worker.run_once(), 2)
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertEqual(self.worker.run_once(), 0)
+
+        for job in jobs:
+            job.refresh_from_db()
+            self.assertEqual(job.status, LabelJob.DONE)
+            self.assertEqual(job.attempts, 1)
+            self.assertEqual(job.pdf_url, '{}pdf/{}.pdf'.format(
+                self.service.url, job.parcel_number))
+        self.assertEqual(len(set(job.parcel_number for job in jobs)), 3)
+
+    def test_transient_errors(self):
+        job = LabelJob.enqueue(**LETTER_REQUIRED_KWARGS)
+        self.service.failures = 2
+
+        self.worker.run_once()
+        job.refresh_from_db()
+        self.assertEqual(job.status, LabelJob.PENDING)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertEqual(self.worker.run_once(), 0)
+
+        LabelJob.objects.update(run_after=timezone.now())
+        self.worker.run_once()
+        job.refresh_from_db()
+        self.assertEqual(job.status, LabelJob.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIn('Service failure', job.error)
+
+    def test_timeouts(self):
+        job = LabelJob.enqueue(**LETTER_REQUIRED_KWARGS)
+        job, = self.worker.claim()
+        self.worker.record(job, ServiceTimeout('Read timed out'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, LabelJob.FAILED)
+        self.assertIn('the label may have been generated', job.error)
+
+        # Unless timeouts are retried.
+        self.client.retry_policy = RetryPolicy(max_attempts=1,
+                                               retry_timeouts=True)
+        LabelJob.objects.update(status=LabelJob.PENDING, attempts=0)
+        job, = self.worker.claim()
+        self.worker.record(job, ServiceTimeout('Read timed out'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, LabelJob.PENDING)
+
+    def test_permanent_errors(self):
+        job = LabelJob.enqueue(**LETTER_REQUIRED_KWARGS)
+        self.service.error_id = 30000
+        self.worker.run_once()
+        job.refresh_from_db()
+        self.assertEqual(job.status, LabelJob.FAILED)
+        self.assertEqual(job.attempts, 1)
+
+    def test_expired_lease(self):
+        job = LabelJob.enqueue(**LETTER_REQUIRED_KWARGS)
+        self.assertEqual(len(self.worker.claim()), 1)
+        self.assertEqual(self.worker.claim(), [])
+
+        # Its letter may have been issued, so the job fails rather than
+        # being issued again.
+        other_job = LabelJob.enqueue(**LETTER_REQUIRED_KWARGS)
+        LabelJob.objects.filter(pk=job.pk).update(
+            claimed_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(self.worker.claim(), [other_job])
+        job.refresh_from_db()
+        self.assertEqual(job.status, LabelJob.FAILED)
+        self.assertIn('the label may have been generated', job.error)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(self.service.envelopes, [])
+
+    def test_command(self):
+        LabelJob.enqueue(**LETTER_REQUIRED_KWARGS)
+        out = io.StringIO()
+        with self.settings(SOCOLISSIMO_CONTRACT_NUMBER=CONTRACT_NUMBER,
+                           SOCOLISSIMO_PASSWORD=PASSWORD):
+            call_command('socolissimo_worker', once=True, stdout=out)
+        self.assertIn('1 label jobs processed', out.getvalue())
+        self.assertEqual(LabelJob.objects.get().status, LabelJob.DONE)
+
+
+class TestBulk(FakeServiceTestCase):
+    COLUMNS = (
+        ('service_call_context.dateDeposite', '2016-03-01 10:30'),
+        ('service_call_context.commercialName', 'Chuck Norris'),
+        ('parcel.weight', '10.20'),
+        ('recipient.addressVO.Name', 'Norris'),
+        ('recipient.addressVO.Surname', 'Chuck'),
+        ('recipient.addressVO.email', 'chuck.norris@awesome.com'),
+        ('recipient.addressVO.line2', '1 round-kick street'),
+        ('recipient.addressVO.countryCode', 'FR'),
+        ('recipient.addressVO.postalCode', '01000'),
+        ('recipient.addressVO.city', 'Bourg-en-Bresse'),
+        ('sender.addressVO.line2', '1 round-kick street'),
+        ('sender.addressVO.countryCode', 'FR'),
+        ('sender.addressVO.postalCode', '01000'),
+        ('sender.addressVO.city', 'Bourg-en-Bresse'),
+    )
+
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.client = SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD,
+            use_result_cache=False, retry_policy=RetryPolicy(max_attempts=1))
+
+    def write_csv(self, rows):
+        path = os.path.join(self.directory, 'shipments.csv')
+        with open(path, 'w', encoding='utf-8') as csv_file:
+            csv_file.write(';'.join(name for name, _ in self.COLUMNS) + '\n')
+            for row in rows:
+                csv_file.write(';'.join(row) + '\n')
+        return path
+
+    def test_build_letter(self):
+        letter = build_letter({'City': 'Bourg-en-Bresse',
+                               'parcel.weight': '1',
+                               'parcel.Instructions': '',
+                               'Comment': 'ignored'},
+                              {'City': 'recipient.addressVO.city',
+                               'Comment': None})
+        self.assertEqual(letter, {
+            'service_call_context': {},
+            'parcel': {'weight': '1'},
+            'recipient': {'addressVO': {'city': 'Bourg-en-Bresse'}},
+            'sender': {}})
+
+    def test_read_records(self):
+        source = io.StringIO(
+            json.dumps({'order': 42, 'parcel.weight': '1'}) + '\n\n'
+            + json.dumps(LETTER_REQUIRED_KWARGS, default=str) + '\n')
+        records = read_records(source, 'jsonl')
+        record_id, letter = next(records)
+        self.assertEqual(record_id, '1')
+        self.assertEqual(letter['parcel'], {'weight': '1'})
+        record_id, letter = next(records)
+        self.assertEqual(record_id, '2')
+        self.assertEqual(letter['recipient'],
+                         LETTER_REQUIRED_KWARGS['recipient'])
+
+        source = io.StringIO(json.dumps({'order': 42}) + '\n')
+        self.assertEqual(next(read_records(source, 'jsonl',
+                                           id_column='order'))[0], '42')
+
+    def test_command(self):
+        valid = [value for _, value in self.COLUMNS]
+        invalid = list(valid)
+        invalid[2] = '100'
+        path = self.write_csv([valid, invalid, valid])
+        with self.settings(SOCOLISSIMO_CONTRACT_NUMBER=CONTRACT_NUMBER,
+                           SOCOLISSIMO_PASSWORD=PASSWORD):
+            call_command('socolissimo_bulk', path, delimiter=';',
+                         max_workers=2, stdout=io.StringIO())
+            self.assertEqual(len(self.service.envelopes), 2)
+            with open(path + '.results.jsonl') as output:
+                outcomes = dict((outcome['record'], outcome) for outcome
+                                in map(json.loads, output))
+            self.assertEqual(set(outcomes), set(['1', '2', '3']))
+            self.assertEqual(outcomes['2']['error_type'],
+                             'SchemaValidationError')
+            self.assertIn('pdf_url', outcomes['1'])
+
+            # A second run only retries the failed record.
+            stdout = io.StringIO()
+            call_command('socolissimo_bulk', path, delimiter=';',
+                         stdout=stdout)
+            self.assertEqual(len(self.service.envelopes), 2)
+            self.assertIn('0 labels generated, 1 failed, 0 timed out, 2 '
+                          'skipped',
+                          stdout.getvalue())
+
+    def test_interrupted(self):
+        checkpoint_path = os.path.join(self.directory, 'checkpoint')
+
+        def records():
+            yield '1', LETTER_REQUIRED_KWARGS
+            yield '2', LETTER_REQUIRED_KWARGS
+            raise KeyboardInterrupt()
+
+        checkpoint = Checkpoint(checkpoint_path)
+        output = io.StringIO()
+        with self.assertRaises(KeyboardInterrupt):
+            run_bulk(self.client, records(), output, checkpoint)
+        checkpoint.close()
+        self.assertEqual(len(output.getvalue().splitlines()), 2)
+
+        # A torn line is ignored.
+        with open(checkpoint_path, 'a') as checkpoint_file:
+            checkpoint_file.write('{"rec')
+        checkpoint = Checkpoint(checkpoint_path)
+        self.assertEqual(checkpoint.done, set(['1', '2']))
+        counts = run_bulk(self.client, [('1', LETTER_REQUIRED_KWARGS),
+                                        ('3', LETTER_REQUIRED_KWARGS)],
+                          io.StringIO(), checkpoint)
+        checkpoint.close()
+        self.assertEqual(counts, {'ok': 1, 'failed': 0, 'unknown': 0,
+                                  'skipped': 1})
+        self.assertEqual(len(self.service.envelopes), 3)
+
+    def test_timeout(self):
+        checkpoint_path = os.path.join(self.directory, 'checkpoint')
+        client = Mock()
+        client.get_letter_outcome.return_value = ServiceTimeout('timed out')
+
+        checkpoint = Checkpoint(checkpoint_path)
+        counts = run_bulk(client, [('1', {})], io.StringIO(), checkpoint)
+        checkpoint.close()
+        self.assertEqual(counts, {'ok': 0, 'failed': 0, 'unknown': 1,
+                                  'skipped': 0})
+
+        # The label may exist, the record is not issued again.
+        checkpoint = Checkpoint(checkpoint_path)
+        self.assertEqual(checkpoint.unknown, set(['1']))
+        counts = run_bulk(client, [('1', {})], io.StringIO(), checkpoint)
+        checkpoint.close()
+        self.assertEqual(counts['skipped'], 1)
+        self.assertEqual(client.get_letter_outcome.call_count, 1)
+
+        # Unless asked to.
+        client.get_letter_outcome.return_value = ('123', 'url')
+        checkpoint = Checkpoint(checkpoint_path)
+        counts = run_bulk(client, [('1', {})], io.StringIO(), checkpoint,
+                          retry_unknown=True)
+        checkpoint.close()
+        self.assertEqual(counts['ok'], 1)
+        checkpoint = Checkpoint(checkpoint_path)
+        checkpoint.close()
+        self.assertEqual(checkpoint.done, set(['1']))
+        self.assertEqual(checkpoint.unknown, set())
+
+    def test_bounded_read_ahead(self):
+        release = threading.Event()
+        read = []
+        client = Mock()
+        client.get_letter_outcome.side_effect = \
+            lambda letter: release.wait() and ('123', 'url')
+
+        def records():
+            for index in range(20):
+                read.append(index)
+                yield str(index), {}
+
+        thread = threading.Thread(target=run_bulk, args=(
+            client, records(), io.StringIO()),
+            kwargs={'max_workers': 2, 'max_pending': 3})
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(len(read), 4)
+        release.set()
+        thread.join()
+        self.assertEqual(len(read), 20)
+
+
+class TestPipeline(FakeServiceTestCase):
+    def make_client(self, engine=None):
+        return SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD, engine=engine,
+            use_result_cache=False, retry_policy=RetryPolicy(max_attempts=1))
+
+    def test_prepare_and_send(self):
+        for engine in client_module.ENGINES:
+            client = self.make_client(engine)
+            prepared = pickle.loads(pickle.dumps(
+                client.prepare_letter(**LETTER_FULL_KWARGS)))
+            self.assertIn(b'contractNumber>123</',
+                          prepared.envelope)
+            self.assertEqual(self.service.envelopes, [])
+            parcel_number, pdf_url = client.send_prepared(prepared)
+            self.assertTrue(parcel_number)
+            self.assertEqual(len(self.service.envelopes), 1)
+            self.service.envelopes = []
+
+        invalid = dict(LETTER_REQUIRED_KWARGS, parcel={'weight': 100})
+        self.assertRaises(SchemaValidationError, client.prepare_letter,
+                          **invalid)
+
+    def test_send_prepared_result_cache(self):
+        client = self.make_client()
+        client.result_cache = LetterResultCache()
+        self.addCleanup(caches['default'].clear)
+        prepared = client.prepare_letter(**LETTER_REQUIRED_KWARGS)
+        first = client.send_prepared(prepared)
+        self.assertEqual(client.send_prepared(prepared), first)
+        self.assertEqual(len(self.service.envelopes), 1)
+
+    def test_pipeline(self):
+        client = self.make_client(ENGINE_TEMPLATE)
+        invalid = dict(LETTER_REQUIRED_KWARGS, parcel={'weight': 100})
+        letters = [LETTER_REQUIRED_KWARGS, invalid, LETTER_FULL_KWARGS]
+        outcomes = client.get_letters(letters, max_workers=2, processes=2)
+        self.assertIsInstance(outcomes[0], tuple)
+        self.assertIsInstance(outcomes[1], SchemaValidationError)
+        self.assertIsInstance(outcomes[2], tuple)
+        self.assertEqual(len(self.service.envelopes), 2)
+
+    def test_backpressure(self):
+        client = self.make_client(ENGINE_TEMPLATE)
+        release = threading.Event()
+        read = []
+
+        def letters():
+            for _ in range(10):
+                read.append(None)
+                yield LETTER_REQUIRED_KWARGS
+
+        def send_prepared(prepared):
+            release.wait()
+            return '123', 'url'
+
+        pipeline = LetterPipeline(client, processes=1, max_workers=1,
+                                  max_pending=3)
+        outcomes = []
+        with patch.object(client, 'send_prepared', send_prepared):
+            thread = threading.Thread(target=lambda: outcomes.extend(
+                pipeline.get_letters(letters())))
+            thread.start()
+            time.sleep(0.5)
+            self.assertEqual(len(read), 4)
+            release.set()
+            thread.join()
+        self.assertEqual(outcomes, [('123', 'url')] * 10)
+
+
+class TestShipmentSession(FakeServiceTestCase):
+    def make_session(self, engine=None):
+        client = SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD, engine=engine,
+            use_result_cache=False, retry_policy=RetryPolicy(max_attempts=1))
+        return client.shipment_session(
+            LETTER_FULL_KWARGS['service_call_context'],
+            LETTER_FULL_KWARGS['sender'])
+
+    def test_get_letter(self):
+        for engine in client_module.ENGINES:
+            self.service.envelopes = []
+            session = self.make_session(engine)
+            with patch.object(ServiceCallContext, 'compiled') as compiled, \
+                    patch.object(ParcelSender, 'compiled') as sender_compiled:
+                session.get_letter(LETTER_FULL_KWARGS['parcel'],
+                                   LETTER_FULL_KWARGS['recipient'])
+                session.get_letter(LETTER_REQUIRED_KWARGS['parcel'],
+                                   LETTER_REQUIRED_KWARGS['recipient'])
+            self.assertFalse(compiled.called)
+            self.assertFalse(sender_compiled.called)
+            self.assertEqual(len(self.service.envelopes), 2)
+            for envelope in self.service.envelopes:
+                self.assertIn(b'commandNumber>CMD-42</', envelope)
+                self.assertIn(b'city>Bourg-en-Bresse</', envelope)
+            self.assertIn(b'weight>10.2', self.service.envelopes[1])
+
+    def test_service_call_context(self):
+        session = self.make_session(ENGINE_TEMPLATE)
+        session.get_letter(LETTER_REQUIRED_KWARGS['parcel'],
+                           LETTER_REQUIRED_KWARGS['recipient'],
+                           service_call_context={'commandNumber': 'CMD-43'})
+        envelope = self.service.envelopes[0]
+        self.assertIn(b'commandNumber>CMD-43</', envelope)
+        self.assertIn(b'totalAmount>1200</', envelope)
+
+        self.assertRaises(SchemaValidationError, session.get_letter,
+                          LETTER_REQUIRED_KWARGS['parcel'],
+                          LETTER_REQUIRED_KWARGS['recipient'],
+                          service_call_context={'VATCode': 9})
+
+    def test_submit(self):
+        session = self.make_session()
+        session.add_parcel(LETTER_FULL_KWARGS['parcel'],
+                           LETTER_FULL_KWARGS['recipient'])
+        self.assertRaises(SchemaValidationError, session.add_parcel,
+                          {'weight': 100}, LETTER_FULL_KWARGS['recipient'])
+        session.add_parcel(LETTER_REQUIRED_KWARGS['parcel'],
+                           LETTER_REQUIRED_KWARGS['recipient'])
+        self.assertEqual(len(session), 2)
+
+        outcomes = session.submit(max_workers=2)
+        self.assertEqual(len(outcomes), 2)
+        for outcome in outcomes:
+            self.assertIsInstance(outcome, tuple)
+        self.assertEqual(len(session), 0)
+        self.assertEqual(len(self.service.envelopes), 2)
+        self.assertEqual(session.submit(), [])
+
+        self.service.error_id = 30000
+        session.add_parcel(LETTER_REQUIRED_KWARGS['parcel'],
+                           LETTER_REQUIRED_KWARGS['recipient'])
+        outcome, = session.submit()
+        self.assertIsInstance(outcome, SoColissimoException)
+
+    def test_invalid_shared_data(self):
+        client = SoColissimoClient(contract_number=CONTRACT_NUMBER,
+                                   password=PASSWORD)
+        self.assertRaises(SchemaValidationError, client.shipment_session,
+                          {'commercialName': 'Chuck Norris'},
+                          LETTER_FULL_KWARGS['sender'])
+
+
+class TestRouting(SimpleTestCase):
+    def make_router(self, **kwargs):
+        logger_patch = patch('socolissimo.routing.logger')
+        self.logger = logger_patch.start()
+        self.addCleanup(logger_patch.stop)
+        self.checked = []
+        self.healthy = set()
+
+        def check(url):
+            self.checked.append(url)
+            return url in self.healthy
+
+        options = dict(failure_threshold=2, max_error_rate=0.5,
+                       probe_interval=60, stats_ttl=60, check=check)
+        options.update(kwargs)
+        return EndpointRouter([Endpoint('http://a/', 'http://a/supervision'),
+                               Endpoint('http://b/', 'http://b/supervision'),
+                               Endpoint('http://c/')], **options)
+
+    def test_ranking(self):
+        router = self.make_router()
+        endpoint_a, endpoint_b, endpoint_c = router.endpoints
+        # Endpoints never called are tried first, in order.
+        self.assertIs(router.choose(), endpoint_a)
+        router.record(endpoint_a, 0.3)
+        self.assertIs(router.choose(), endpoint_b)
+        router.record(endpoint_b, 0.1)
+        self.assertIs(router.choose(), endpoint_c)
+        router.record(endpoint_c, 0.2)
+        self.assertIs(router.choose(), endpoint_b)
+
+        # A failure ranks the endpoint after the ones without failure.
+        router.record(endpoint_b, 0.1, failed=True)
+        self.assertIs(router.choose(), endpoint_c)
+        self.assertTrue(endpoint_b.in_rotation)
+        router.record(endpoint_c, 0.2)
+        # Endpoints whose statistics are too old are measured again.
+        router._stats_ttl = 0
+        self.assertIs(router.choose(), endpoint_a)
+
+    def test_rotation(self):
+        router = self.make_router()
+        endpoint_a, endpoint_b, endpoint_c = router.endpoints
+        with router.route() as endpoint:
+            self.assertIs(endpoint, endpoint_a)
+        with self.assertRaises(TransientServiceError):
+            with router.route() as endpoint:
+                self.assertIs(endpoint, endpoint_b)
+                raise TransientServiceError('Down')
+        self.assertEqual(endpoint_b.failures, 1)
+        self.assertTrue(endpoint_b.in_rotation)
+        # The service answering with an error is not a failure.
+        with self.assertRaises(SoColissimoException):
+            with router.route() as endpoint:
+                self.assertIs(endpoint, endpoint_c)
+                raise SoColissimoException('Error 30000')
+        self.assertEqual(endpoint_c.failures, 0)
+        self.assertIsNotNone(endpoint_c.latency)
+
+        router.record(endpoint_b, 0.1, failed=True)
+        self.assertFalse(endpoint_b.in_rotation)
+        self.assertTrue(self.logger.warning.called)
+
+        # Not checked again before the probe interval.
+        router.choose()
+        self.assertEqual(self.checked, [])
+        router._probe_interval = 0
+        router.choose()
+        router.wait_probes()
+        self.assertEqual(self.checked, ['http://b/supervision'])
+        self.assertFalse(endpoint_b.in_rotation)
+        self.healthy.add('http://b/supervision')
+        # The call does not wait for the check, which runs in background.
+        checking = threading.Event()
+        self.addCleanup(checking.set)
+        router.check = lambda url: checking.wait(5)
+        self.assertIs(router.choose(), endpoint_a)
+        self.assertTrue(endpoint_b.probing)
+        self.assertFalse(endpoint_b.in_rotation)
+        checking.set()
+        router.wait_probes()
+        self.assertFalse(endpoint_b.probing)
+        self.assertIs(router.choose(), endpoint_b)
+        self.assertTrue(endpoint_b.in_rotation)
+        self.assertIsNone(endpoint_b.latency)
+
+    def test_error_rate(self):
+        router = self.make_router(failure_threshold=10)
+        endpoint_a = router.endpoints[0]
+        for _ in range(4):
+            router.record(endpoint_a, 0.1, failed=True)
+            router.record(endpoint_a, 0.1)
+        self.assertTrue(endpoint_a.in_rotation)
+        for _ in range(3):
+            router.record(endpoint_a, 0.1, failed=True)
+        self.assertFalse(endpoint_a.in_rotation)
+
+        # With every endpoint out of rotation, they are all ranked.
+        for endpoint in router.endpoints:
+            endpoint.in_rotation = False
+            endpoint.removed_at = time.monotonic()
+        self.assertIs(router.choose(), router.endpoints[1])
+
+    def test_check_health(self):
+        router = self.make_router()
+        endpoint_a, endpoint_b, endpoint_c = router.endpoints
+        self.healthy.add('http://b/supervision')
+        self.assertTrue(router.check_health())
+        self.assertFalse(endpoint_a.in_rotation)
+        self.assertTrue(endpoint_b.in_rotation)
+        self.assertTrue(endpoint_c.in_rotation)
+        self.healthy.clear()
+        self.assertFalse(router.check_health())
+
+        # A single endpoint stays in rotation.
+        router = EndpointRouter([Endpoint(None, 'http://a/supervision')],
+                                failure_threshold=1, check=lambda url: False)
+        router.record(router.endpoints[0], 0.1, failed=True)
+        self.assertFalse(router.check_health())
+        self.assertTrue(router.endpoints[0].in_rotation)
+
+    def test_settings(self):
+        with self.settings(SOCOLISSIMO_ENDPOINTS=None):
+            endpoint, = get_router().endpoints
+            self.assertIsNone(endpoint.url)
+            self.assertEqual(endpoint.supervision_url,
+                             client_module.SUPERVISION_URL)
+        with self.settings(SOCOLISSIMO_ENDPOINTS=[
+                'http://proxy/', {'url': 'http://mirror/', 'name': 'mirror'}]):
+            router = get_router()
+            self.assertIs(get_router(), router)
+            self.assertEqual([endpoint.name for endpoint in router.endpoints],
+                             ['http://proxy/', 'mirror'])
+        for endpoints in ([], [{'address': 'http://proxy/'}]):
+            with self.settings(SOCOLISSIMO_ENDPOINTS=endpoints):
+                self.assertRaises(ImproperlyConfigured, get_router)
+
+    def test_failover(self):
+        primary, backup = FakeLetterService(), FakeLetterService(latency=0.05)
+        for service in (primary, backup):
+            service.start()
+            self.addCleanup(service.stop)
+        soap_client_patch = patch_soap_client(primary)
+        soap_client_patch.start()
+        self.addCleanup(soap_client_patch.stop)
+        endpoints = [{'url': service.endpoint_url,
+                      'supervision_url': service.supervision_url}
+                     for service in (primary, backup)]
+
+        for engine in client_module.ENGINES:
+            with self.settings(SOCOLISSIMO_ENDPOINTS=list(endpoints),
+                               SOCOLISSIMO_ENDPOINT_FAILURE_THRESHOLD=2,
+                               SOCOLISSIMO_ENDPOINT_PROBE_INTERVAL=0):
+                primary.envelopes, backup.envelopes = [], []
+                primary.healthy, primary.failures = True, 0
+                client = SoColissimoClient(
+                    contract_number=CONTRACT_NUMBER, password=PASSWORD,
+                    engine=engine, use_result_cache=False,
+                    retry_policy=RetryPolicy(max_attempts=2, backoff=0))
+                router = get_router()
+                for endpoint in router.endpoints:
+                    endpoint.reset()
+                for _ in range(10):
+                    client.get_letter(**LETTER_REQUIRED_KWARGS)
+                # Each endpoint is measured, then the fastest takes the calls.
+                self.assertEqual(len(primary.envelopes), 9)
+                self.assertEqual(len(backup.envelopes), 1)
+
+                # A failed call is retried on the other endpoint, which takes
+                # the next calls.
+                primary.healthy, primary.failures = False, 100
+                for _ in range(3):
+                    client.get_letter(**LETTER_REQUIRED_KWARGS)
+                self.assertEqual(len(primary.envelopes), 10)
+                self.assertEqual(len(backup.envelopes), 4)
+                self.assertTrue(router.endpoints[0].in_rotation)
+
+                # Measured again once its statistics are outdated, the
+                # failing endpoint is taken out of rotation.
+                with self.settings(SOCOLISSIMO_ENDPOINT_STATS_TTL=0), \
+                        self.assertLogs('socolissimo.routing', 'WARNING'):
+                    client.get_letter(**LETTER_REQUIRED_KWARGS)
+                self.assertEqual(len(primary.envelopes), 11)
+                self.assertFalse(router.endpoints[0].in_rotation)
+                with self.settings(SOCOLISSIMO_ENDPOINT_STATS_TTL=0):
+                    client.get_letter(**LETTER_REQUIRED_KWARGS)
+                router.wait_probes()
+                self.assertEqual(len(primary.envelopes), 11)
+
+                # Until its supervision page reports it up again.
+                primary.healthy, primary.failures = True, 0
+                client.get_letter(**LETTER_REQUIRED_KWARGS)
+                router.wait_probes()
+                self.assertTrue(router.endpoints[0].in_rotation)
+                client.get_letter(**LETTER_REQUIRED_KWARGS)
+                self.assertEqual(len(primary.envelopes), 12)
+
+
+class TestRateLimiter(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_token_bucket(self):
+        limiter = RateLimiter(rate=10, burst=2)
+        waits = [limiter._reserve() for _ in range(4)]
+        self.assertEqual(waits[:2], [0, 0])
+        self.assertAlmostEqual(waits[2], 0.1, delta=0.02)
+        self.assertAlmostEqual(waits[3], 0.2, delta=0.02)
+
+    def test_shared_bucket(self):
+        limiter = RateLimiter(rate=1, burst=1)
+        other_limiter = RateLimiter(rate=1, burst=1)
+        separate_limiter = RateLimiter(rate=1, burst=1, key='other')
+        self.assertEqual(limiter._reserve(), 0)
+        self.assertGreater(other_limiter._reserve(), 0.9)
+        self.assertEqual(separate_limiter._reserve(), 0)
+
+    def test_max_wait(self):
+        limiter = RateLimiter(rate=1, burst=1, max_wait=0.5)
+        limiter.acquire()
+        self.assertRaises(RateLimitExceeded, limiter.acquire)
+        # The refused call did not take a token.
+        self.assertLess(limiter._reserve(), 1.01)
+
+        with deadline(time.monotonic() + 0.1):
+            self.assertRaises(DeadlineExceeded, RateLimiter(1).acquire)
+
+    def test_lock(self):
+        cache = caches['default']
+        limiter = RateLimiter(rate=1, burst=1, max_wait=0.05)
+        # A lock held by another process is waited for within the bounds of
+        # the call.
+        cache.set(limiter.lock_key, 'other', 60)
+        self.assertRaises(RateLimitExceeded, limiter.acquire)
+        with deadline(time.monotonic() + 0.05):
+            self.assertRaises(DeadlineExceeded, RateLimiter(1).acquire)
+        with patch('socolissimo.ratelimit.LOCK_MAX_WAIT', 0.05):
+            self.assertRaises(RateLimitExceeded, RateLimiter(1).acquire)
+        cache.delete(limiter.lock_key)
+
+        # A lock which expired and was taken by another process meanwhile is
+        # not released.
+        get = cache.get
+
+        def get_after_expiry(key, *args, **kwargs):
+            if key == limiter.state_key:
+                cache.set(limiter.lock_key, 'other', 60)
+            return get(key, *args, **kwargs)
+
+        with patch.object(cache, 'get', get_after_expiry):
+            limiter.acquire()
+        self.assertEqual(cache.get(limiter.lock_key), 'other')
+
+    def test_sustained_rate(self):
+        limiter = RateLimiter(rate=100, burst=1)
+        start = time.monotonic()
+        threads = [threading.Thread(target=limiter.acquire)
+                   for _ in range(11)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_client(self):
+        with fake_letter_service(), \
+                self.settings(SOCOLISSIMO_RATE_LIMIT=1000):
+            client = client_module.SoColissimoClient(
+                contract_number=CONTRACT_NUMBER, password=PASSWORD)
+            self.assertEqual(client.rate_limiter.rate, 1000)
+            with patch.object(client.rate_limiter, 'acquire') as acquire:
+                client.get_letter(**LETTER_REQUIRED_KWARGS)
+                client.engine = ENGINE_TEMPLATE
+                client.get_letter(**LETTER_FULL_KWARGS)
+        self.assertEqual(acquire.call_count, 2)
+
+
+class TestWsdlCache(SimpleTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_cache_settings(self):
+        with self.settings(SOCOLISSIMO_WSDL_CACHE_DIR=self.cache_dir,
+                           SOCOLISSIMO_WSDL_CACHE_TTL=60):
+            cache = client_module.get_wsdl_cache()
+            self.assertEqual(cache.location, self.cache_dir)
+            self.assertEqual(cache.duration, datetime.timedelta(seconds=60))
+
+            pool = client_module.SoapClientPool()
+            pool.instanciate()
+            self.assertTrue(any(name.endswith('.px')
+                                for name in os.listdir(self.cache_dir)))
+
+    def test_missing_bundled_wsdl(self):
+        with self.settings(SOCOLISSIMO_USE_BUNDLED_WSDL=True,
+                           SOCOLISSIMO_WSDL_SNAPSHOT_DIR=self.cache_dir):
+            self.assertRaises(ImproperlyConfigured, client_module.get_wsdl_url)
+
+    def test_refresh_command(self):
+        snapshot_dir = os.path.join(self.cache_dir, 'wsdl')
+        with FakeLetterService() as service, \
+                self.settings(SOCOLISSIMO_WSDL_URL=service.wsdl_url,
+                              SOCOLISSIMO_WSDL_CACHE_DIR=self.cache_dir,
+                              SOCOLISSIMO_WSDL_SNAPSHOT_DIR=snapshot_dir):
+            call_command('socolissimo_refresh_wsdl', snapshot=True,
+                         stdout=io.StringIO())
+            snapshot_path = client_module.get_wsdl_snapshot_path()
+
+        with open(snapshot_path, 'rb') as snapshot:
+            self.assertIn(service.endpoint_url.encode('utf-8'),
+                          snapshot.read())
+        self.assertTrue(any(name.endswith('.px')
+                            for name in os.listdir(self.cache_dir)))
+
+        # The snapshot is used offline.
+        with self.settings(SOCOLISSIMO_USE_BUNDLED_WSDL=True,
+                           SOCOLISSIMO_WSDL_SNAPSHOT_DIR=snapshot_dir):
+            client = client_module.create_soap_client()
+        self.assertTrue(client.factory.create('Letter'))
+
+    def test_snapshot_imports(self):
+        documents = {
+            'http://ws/service?wsdl':
+                b'<definitions><types><xsd:schema>'
+                b'<xsd:import namespace="urn:a" schemaLocation="a.xsd"/>'
+                b'</xsd:schema></types>'
+                b'<soap:address location="http://ws/service"/></definitions>',
+            'http://ws/a.xsd':
+                b'<schema><include schemaLocation=\'/b.xsd?x=1&amp;y=2\'/>'
+                b'<import schemaLocation="http://ws/service?wsdl"/></schema>',
+            'http://ws/b.xsd?x=1&y=2': b'<schema/>',
+        }
+        command_module = ('socolissimo.management.commands.'
+                          'socolissimo_refresh_wsdl')
+        with patch('{}.requests.get'.format(command_module)) as get:
+            get.side_effect = lambda url, timeout: Mock(content=documents[url])
+            snapshot = snapshot_documents('http://ws/service?wsdl',
+                                          'service.wsdl')
+        self.assertEqual(snapshot, {
+            'service.wsdl':
+                b'<definitions><types><xsd:schema>'
+                b'<xsd:import namespace="urn:a" schemaLocation="schema1.xsd"/>'
+                b'</xsd:schema></types>'
+                b'<soap:address location="http://ws/service"/></definitions>',
+            'schema1.xsd':
+                b'<schema><include schemaLocation=\'schema2.xsd\'/>'
+                b'<import schemaLocation="service.wsdl"/></schema>',
+            'schema2.xsd': b'<schema/>',
+        })
+
+
+class TestTypePrototypes(SimpleTestCase):
+    def setUp(self):
+        self.master = client_module.SOAP_CLIENT.master
+
+    def test_create(self):
+        prototypes = TypePrototypes(self.master)
+        constants = (('alert', 'none'),)
+        first = prototypes.create('DestEnvVO', constants)
+        expected = self.master.factory.create('DestEnvVO')
+        expected.alert = 'none'
+        self.assertEqual(str(first), str(expected))
+
+        # Instances are independent copies of the prototype.
+        first.alert = 'email'
+        first.addressVO = self.master.factory.create('AddressVO')
+        second = prototypes.create('DestEnvVO', constants)
+        self.assertEqual(second.alert, 'none')
+        self.assertIsNone(second.addressVO)
+        self.assertIs(second.__metadata__, first.__metadata__)
+        self.assertEqual(str(second), str(expected))
+
+        self.assertIsNone(prototypes.create('DestEnvVO').alert)
+
+    def test_clone_instance(self):
+        letter = self.master.factory.create('Letter')
+        letter.exp = self.master.factory.create('ExpEnvVO')
+        letter.exp.addressVO = self.master.factory.create('AddressVO')
+        letter.items = [self.master.factory.create('AddressVO')]
+        clone = clone_instance(letter)
+        self.assertIsNot(clone.exp, letter.exp)
+        self.assertIsNot(clone.exp.addressVO, letter.exp.addressVO)
+        self.assertIsNot(clone.items, letter.items)
+        self.assertIsNot(clone.items[0], letter.items[0])
+        self.assertEqual(str(clone), str(letter))
+
+        clone.exp.addressVO.city = 'Bourg-en-Bresse'
+        self.assertIsNone(letter.exp.addressVO.city)
+
+    def test_build_instance(self):
+        service = ServiceCallContext.compiled().validate(
+            LETTER_REQUIRED_KWARGS['service_call_context']).build_instance()
+        self.assertEqual(service.returnType, 'CreatePDFFile')
+        self.assertGreater(service.dateValidation, datetime.datetime.today())
+
+    def test_invalidated_with_wsdl(self):
+        pool = client_module.SoapClientPool()
+        pool.client = self.master
+        prototypes = pool.type_prototypes
+        self.assertIs(pool.type_prototypes, prototypes)
+        pool.client = Client(client_module.get_wsdl_url())
+        self.assertIsNot(pool.type_prototypes, prototypes)
+        self.assertIs(pool.type_prototypes.soap_client, pool.client)
+
+
+TEST_POSTAL_INDEX = os.path.join(os.path.dirname(__file__), 'testdata',
+                                 'postal_codes.tsv')
+
+
+@override_settings(SOCOLISSIMO_POSTAL_INDEX=TEST_POSTAL_INDEX)
+class TestPostalIndex(SimpleTestCase):
+    def setUp(self):
+        self.index = get_postal_index()
+
+    def address(self, **kwargs):
+        return dict(LETTER_REQUIRED_KWARGS['sender']['addressVO'], **kwargs)
+
+    def test_normalize_city(self):
+        self.assertEqual(normalize_city(' Saint-Étienne '), 'ST ETIENNE')
+        self.assertEqual(normalize_city("Sainte  Maxime"), 'STE MAXIME')
+        self.assertEqual(normalize_city("L'Haÿ-les-Roses"), 'L HAY LES ROSES')
+
+    def test_lookup(self):
+        self.assertEqual(self.index.canonical_city('FR', '01000',
+                                                   'Bourg-en-Bresse'),
+                         'BOURG EN BRESSE')
+        self.assertEqual(self.index.canonical_city('FR', '59160', 'Lomme'),
+                         'LILLE')
+        self.assertEqual(self.index.canonical_city('MC', '98000', 'Monaco'),
+                         'MONACO')
+        self.assertIsNone(self.index.canonical_city('FR', '01000', 'Paris'))
+        self.assertIsNone(self.index.canonical_city('FR', '00000', 'Paris'))
+        self.assertEqual(self.index.cities('FR', '01000'),
+                         ['BOURG EN BRESSE', 'ST DENIS LES BOURG'])
+        self.assertEqual(self.index.suggest('FR', '42000', 'Saint-Etiene'),
+                         ['ST ETIENNE'])
+        self.assertEqual(self.index.countries, frozenset(['FR', 'MC']))
+
+    def test_compile(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        output = os.path.join(output_dir, 'postal_codes.tsv.gz')
+        call_command('socolissimo_compile_postal_index',
+                     os.path.join(os.path.dirname(__file__), 'testdata',
+                                  'laposte_hexasmal.csv'),
+                     output=output, stdout=io.StringIO())
+        index = PostalIndex.load(output)
+        self.assertEqual(len(index), len(self.index))
+        self.assertEqual(index.canonical_city('FR', '75015', 'Paris 15'),
+                         'PARIS')
+
+    def test_address_check(self):
+        address = self.address(city='Bourg en Bresse', postalCode='42000')
+        # Not checked by default.
+        Address.compiled().validate(address)
+
+        with self.settings(SOCOLISSIMO_ADDRESS_CHECK=True):
+            # The city is sent with the spelling of the index.
+            self.assertEqual(Address.compiled().validate(self.address()).city,
+                             'BOURG EN BRESSE')
+            self.assertEqual(Address(self.address()).validated_data()['city'],
+                             'BOURG EN BRESSE')
+            SoColissimoClient._validate_letter(  # pylint: disable=W0212
+                **LETTER_FULL_KWARGS)
+            with self.assertRaises(SchemaValidationError) as context:
+                Address.compiled().validate(address)
+            self.assertIn('does not match postal code 42000',
+                          str(context.exception))
+
+            address = self.address(city='Bourg-en-Brese')
+            with self.assertRaises(SchemaValidationError) as context:
+                Address.compiled().validate(address)
+            self.assertIn('did you mean BOURG EN BRESSE',
+                          str(context.exception))
+            self.assertRaises(SchemaValidationError,
+                              Address(address).validated_data)
+
+            address = self.address(postalCode='00000')
+            with self.assertRaises(SchemaValidationError) as context:
+                Address.compiled().validate(address)
+            self.assertIn('Unknown postal code', str(context.exception))
+
+        # The index of the package is checked by default.
+        with self.settings(SOCOLISSIMO_ADDRESS_CHECK=True,
+                           SOCOLISSIMO_POSTAL_INDEX=None):
+            with patch('socolissimo.postal.PACKAGED_POSTAL_INDEX',
+                       TEST_POSTAL_INDEX):
+                Address.compiled().validate(self.address())
+            with patch('socolissimo.postal.PACKAGED_POSTAL_INDEX',
+                       TEST_POSTAL_INDEX + '.missing'):
+                self.assertRaises(ImproperlyConfigured,
+                                  Address.compiled().validate, self.address())
+
+
+class TestEnvelopeTemplate(SimpleTestCase):
+    def setUp(self):
+        # Through the module, as TestClient reloads it.
+        self.client = client_module.SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD,
+            engine=ENGINE_TEMPLATE)
+
+    def test_invalid_engine(self):
+        self.assertRaises(ValueError, client_module.SoColissimoClient,
+                          contract_number=CONTRACT_NUMBER, password=PASSWORD,
+                          engine='fast')
+
+    def test_matches_suds_envelope(self):
+        soap_client = client_module.clone_soap_client(
+            client_module.SOAP_CLIENT.soap_client)
+        soap_client.set_options(nosend=True)
+        template = client_module.SOAP_CLIENT.envelope_template
+
+        for letter_kwargs in (LETTER_REQUIRED_KWARGS, LETTER_FULL_KWARGS):
+            with patch('socolissimo.schema.datetime') as mock_datetime:
+                mock_datetime.datetime.today.return_value = \
+                    datetime.datetime(2016, 3, 1)
+                mock_datetime.timedelta = datetime.timedelta
+
+                records = self.client._validate_letter(**letter_kwargs)
+                letter = self.client._build_letter(soap_client, records)
+                suds_envelope = soap_client.service.getLetterColissimo(
+                    letter).envelope
+                letter_data = self.client._build_letter_data(records)
+                envelope = template.render(letter=letter_data)
+
+            self.assertEqual(xml_tree(envelope), xml_tree(suds_envelope))
+
+    def test_parse_response(self):
+        reply = (b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org'
+                 b'/soap/envelope/"><soapenv:Body><getLetterColissimoResponse>'
+                 b'<getLetterColissimoReturn><PdfUrl>http://pdf</PdfUrl>'
+                 b'<errorID>0</errorID><error/><parcelNumber>8V1</parcelNumber>'
+                 b'</getLetterColissimoReturn></getLetterColissimoResponse>'
+                 b'</soapenv:Body></soapenv:Envelope>')
+        response = parse_letter_response(reply)
+        self.assertEqual(response.errorID, 0)
+        self.assertEqual(response.parcelNumber, '8V1')
+        self.assertEqual(response.PdfUrl, 'http://pdf')
+
+        fault = (b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org'
+                 b'/soap/envelope/"><soapenv:Body><soapenv:Fault>'
+                 b'<faultcode>soapenv:Server</faultcode>'
+                 b'<faultstring>Boom</faultstring></soapenv:Fault>'
+                 b'</soapenv:Body></soapenv:Envelope>')
+        self.assertRaises(SoapFault, parse_letter_response, fault)
+        self.assertRaises(SoapFault, parse_letter_response, b'<html>')
+
+    def test_get_letter(self):
+        with fake_letter_service() as service:
+            parcel_number, pdf_url = self.client.get_letter(
+                **LETTER_FULL_KWARGS)
+            self.assertEqual(parcel_number, '8V000000001')
+            self.assertIn(b'>Chuck &amp; Norris &lt;Inc&gt;</',
+                          service.envelopes[0])
+
+            service.error_id = 30000
+            self.assertRaises(client_module.SoColissimoException,
+                              self.client.get_letter, **LETTER_FULL_KWARGS)
+
+
+class TestCompiledSchema(SimpleTestCase):
+    def assert_same_validation(self, schema_class, data):
+        try:
+            expected = schema_class(data).build_data()
+        except SchemaValidationError as exc:
+            with self.assertRaises(SchemaValidationError) as context:
+                schema_class.compiled().validate(data)
+            self.assertEqual(str(context.exception), str(exc))
+        else:
+            record = schema_class.compiled().validate(data)
+            self.assertEqual(record.build_data(), expected)
+
+    def test_same_validation_than_forms(self):
+        schemas = (
+            ('service_call_context', ServiceCallContext),
+            ('parcel', Parcel),
+            ('recipient', ParcelRecipient),
+            ('sender', ParcelSender),
+        )
+        invalid_values = {
+            'service_call_context': [('VATCode', 4), ('VATAmount', -1),
+                                     ('VATPercentage', 10000),
+                                     ('dateDeposite', 'yesterday'),
+                                     ('commercialName', '')],
+            'parcel': [('weight', '-1'), ('weight', '31'),
+                       ('weight', '10.005'), ('DeliveryMode', 'XXX'),
+                       ('insuranceValue', -1)],
+            'recipient': [('addressVO', {}),
+                          ('addressVO', {'city': 'Paris'})],
+            'sender': [('addressVO', {'line2': 'street'})],
+        }
+        with patch('socolissimo.schema.datetime') as mock_datetime:
+            mock_datetime.datetime.today.return_value = \
+                datetime.datetime(2016, 3, 1)
+            mock_datetime.timedelta = datetime.timedelta
+
+            for kwargs in (LETTER_REQUIRED_KWARGS, LETTER_FULL_KWARGS):
+                for key, schema_class in schemas:
+                    self.assert_same_validation(schema_class, kwargs[key])
+                    self.assert_same_validation(schema_class, None)
+                    for field, value in invalid_values[key]:
+                        data = dict(kwargs[key], **{field: value})
+                        self.assert_same_validation(schema_class, data)
+
+            for field in ('Name', 'Surname', 'email', 'city', 'countryCode'):
+                address = dict(LETTER_REQUIRED_KWARGS['recipient']['addressVO'])
+                del address[field]
+                self.assert_same_validation(RecipientAddress, address)
+
+    def test_records(self):
+        record = Parcel.compiled().validate({'weight': '10.00'})
+        self.assertEqual(record.weight, 10)
+        self.assertEqual(record.DeliveryMode, 'DOM')
+        self.assertFalse(hasattr(record, '__dict__'))
+
+        recipient = ParcelRecipient.compiled().validate(
+            LETTER_REQUIRED_KWARGS['recipient'])
+        self.assertEqual(recipient.addressVO.city, 'Bourg-en-Bresse')
+        instance = recipient.build_instance()
+        self.assertEqual(instance.alert, 'none')
+        self.assertEqual(instance.addressVO.city, 'Bourg-en-Bresse')
+
+    def test_validate_many(self):
+        results = Parcel.compiled().validate_many(
+            [{'weight': '1'}, {'weight': '31'}, {}])
+        self.assertEqual(results[0].weight, 1)
+        self.assertIsInstance(results[1], SchemaValidationError)
+        self.assertIsInstance(results[2], SchemaValidationError)
+
+    def test_validate_letters(self):
+        client = client_module.SoColissimoClient(
+            contract_number=CONTRACT_NUMBER, password=PASSWORD)
+        invalid_letter = copy.deepcopy(LETTER_REQUIRED_KWARGS)
+        del invalid_letter['recipient']['addressVO']['email']
+        results = client.validate_letters([LETTER_REQUIRED_KWARGS,
+                                           invalid_letter])
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], SchemaValidationError)
+
+
+class TestLabels(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.service = FakeLetterService()
+        self.service.start()
+        self.addCleanup(self.service.stop)
+
+    def pdf_url(self, parcel_number):
+        return '{}pdf/{}.pdf'.format(self.service.url, parcel_number)
+
+    def read(self, path):
+        with open(path, 'rb') as label_file:
+            return label_file.read()
+
+    def test_fetch_label(self):
+        dest = os.path.join(self.directory, 'label.pdf')
+        self.assertEqual(fetch_label(self.pdf_url('8V1'), dest), dest)
+        self.assertEqual(self.read(dest), make_label_pdf('8V1'))
+
+    def test_fetch_label_cached(self):
+        with self.settings(SOCOLISSIMO_LABEL_CACHE_DIR=self.cache_dir):
+            for copy_number in range(2):
+                dest = os.path.join(self.directory,
+                                    '{}.pdf'.format(copy_number))
+                fetch_label(self.pdf_url('8V1'), dest, parcel_number='8V1')
+                self.assertEqual(self.read(dest), make_label_pdf('8V1'))
+        self.assertEqual(self.service.downloads, ['8V1'])
+
+    def test_cache_eviction(self):
+        label_size = len(make_label_pdf('8V1'))
+        # Trimmed down to 2.25 labels, keeping 2 of them.
+        max_size = 2 * label_size + label_size // 2
+        with self.settings(SOCOLISSIMO_LABEL_CACHE_DIR=self.cache_dir,
+                           SOCOLISSIMO_LABEL_CACHE_MAX_SIZE=max_size):
+            cache = get_label_cache()
+            for parcel_number in ('8V1', '8V2', '8V3'):
+                cache.fetch(parcel_number, self.pdf_url(parcel_number))
+                # Ensure distinct modification times.
+                os.utime(cache.path(parcel_number),
+                         (0, len(self.service.downloads)))
+            self.assertIsNone(cache.get('8V1'))
+            self.assertIsNotNone(cache.get('8V2'))
+            self.assertIsNotNone(cache.get('8V3'))
+
+    def test_cache_eviction_threshold(self):
+        label_size = len(make_label_pdf('8V1'))
+        cache = LabelCache(self.cache_dir, max_size=3 * label_size)
+        with patch('socolissimo.labels.os.listdir',
+                   side_effect=os.listdir) as listdir:
+            for parcel_number in ('8V1', '8V2', '8V3'):
+                cache.fetch(parcel_number, self.pdf_url(parcel_number))
+            # Scanned on the first download only, the size being tracked.
+            self.assertEqual(listdir.call_count, 1)
+            cache.fetch('8V4', self.pdf_url('8V4'))
+            self.assertEqual(listdir.call_count, 2)
+            with patch('socolissimo.labels.LABEL_CACHE_SCAN_INTERVAL', 0):
+                cache.fetch('8V5', self.pdf_url('8V5'))
+            self.assertEqual(listdir.call_count, 3)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_cache_eviction_amortized(self):
+        label_size = len(make_label_pdf('8V1'))
+        cache = LabelCache(self.cache_dir, max_size=20 * label_size)
+        for number in range(20):
+            cache.fetch('8V{}'.format(number), self.pdf_url(number))
+        with patch('socolissimo.labels.os.listdir',
+                   side_effect=os.listdir) as listdir:
+            for number in range(20, 40):
+                cache.fetch('8V{}'.format(number), self.pdf_url(number))
+        # Each scan of the full cache frees room for 2 more labels.
+        self.assertEqual(listdir.call_count, 7)
+        self.assertLessEqual(len(os.listdir(self.cache_dir)), 20)
+
+    def test_fetch_label_storage(self):
+        storage = FileSystemStorage(location=self.directory)
+        name = fetch_label(self.pdf_url('8V1'), 'labels/8V1.pdf',
+                           storage=storage)
+        self.assertEqual(name, 'labels/8V1.pdf')
+        with storage.open(name) as label_file:
+            self.assertEqual(label_file.read(), make_label_pdf('8V1'))
+
+    def test_fetch_labels(self):
+        labels = [('8V1', self.pdf_url('8V1')),
+                  ('8V2', '{}missing'.format(self.service.url)),
+                  ('8V3', self.pdf_url('8V3'))]
+        results = fetch_labels(labels, self.directory, max_workers=2)
+
+        self.assertEqual(results[0], os.path.join(self.directory, '8V1.pdf'))
+        self.assertIsInstance(results[1], requests.HTTPError)
+        self.assertEqual(self.read(results[2]), make_label_pdf('8V3'))
+        self.assertEqual([name for name in os.listdir(self.directory)
+                          if name.endswith('.part')], [])
+
+
+@skipIf(pypdf is None, 'pypdf is not installed')
+class TestPrinting(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.service = FakeLetterService()
+        self.service.start()
+        self.addCleanup(self.service.stop)
+        self.labels = [('8V{}'.format(number),
+                        '{}pdf/8V{}.pdf'.format(self.service.url, number))
+                       for number in range(1, 6)]
+
+    def page_texts(self, path):
+        return [page.extract_text() for page in pypdf.PdfReader(path).pages]
+
+    def test_labels_per_file(self):
+        results = self.labels[:2] + [SoColissimoException()] + self.labels[2:]
+        paths = list(iter_print_files(results, self.directory,
+                                      labels_per_file=2))
+
+        self.assertEqual([os.path.basename(path) for path in paths],
+                         ['print-job-0001.pdf', 'print-job-0002.pdf',
+                          'print-job-0003.pdf'])
+        self.assertEqual([self.page_texts(path) for path in paths],
+                         [['8V1', '8V2'], ['8V3', '8V4'], ['8V5']])
+
+    def test_grid(self):
+        paths = list(iter_print_files(self.labels, self.directory,
+                                      grid=(2, 2)))
+        self.assertEqual(len(paths), 1)
+        reader = pypdf.PdfReader(paths[0])
+        self.assertEqual(len(reader.pages), 2)
+        self.assertEqual(float(reader.pages[0].mediabox.width), 595.28)
+        self.assertIn('8V1', reader.pages[0].extract_text())
+        self.assertIn('8V4', reader.pages[0].extract_text())
+        self.assertIn('8V5', reader.pages[1].extract_text())
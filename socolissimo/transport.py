@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Keep-alive HTTP transport for the web service SoColissimo."""
+import io
+import os
+import threading
+import time
+from urllib.request import urlopen
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from suds.plugin import MessagePlugin
+from suds.transport import Reply, Transport, TransportError
+
+from socolissimo import metrics
+from socolissimo.resilience import get_deadline
+
+
+# Default number of kept-alive connections per host.
+DEFAULT_HTTP_POOL_SIZE = 10
+# Default timeouts, in seconds.
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def create_session():
+    """Create a requests session pooling the connections to the webservice.
+
+    The pool holds SOCOLISSIMO_HTTP_POOL_SIZE connections per host. When the
+    SOCOLISSIMO_HTTP_KEEP_ALIVE setting is False, connections are closed
+    after each request.
+    """
+    pool_size = getattr(settings, 'SOCOLISSIMO_HTTP_POOL_SIZE',
+                        DEFAULT_HTTP_POOL_SIZE)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not getattr(settings, 'SOCOLISSIMO_HTTP_KEEP_ALIVE', True):
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session():
+    """Return the requests session shared by every call to the webservice."""
+    global _SESSION  # pylint: disable=W0603
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = create_session()
+    return _SESSION
+
+
+def _forget_session():
+    """Drop the shared session in a forked child, whose pooled connections
+    are the parent's sockets."""
+    global _SESSION  # pylint: disable=W0603
+    _SESSION = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_session)
+
+
+def get_timeout():
+    """Return the (connect, read) timeouts of the HTTP requests, in seconds.
+
+    They are given by the SOCOLISSIMO_CONNECT_TIMEOUT and
+    SOCOLISSIMO_READ_TIMEOUT settings, and bounded by the time left before
+    the deadline of the current thread, if any.
+    """
+    connect_timeout = getattr(settings, 'SOCOLISSIMO_CONNECT_TIMEOUT',
+                              DEFAULT_CONNECT_TIMEOUT)
+    read_timeout = getattr(settings, 'SOCOLISSIMO_READ_TIMEOUT',
+                           DEFAULT_READ_TIMEOUT)
+    at = get_deadline()
+    if at is not None:
+        # requests rejects a zero timeout.
+        remaining = max(at - time.monotonic(), 0.001)
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+    return connect_timeout, read_timeout
+
+
+class RequestsTransport(Transport):
+    """
+    suds transport going through a requests session.
+
+    The session keeps the connections to the webservice alive, so the TCP
+    and TLS handshakes are not paid on every call. Copies of the transport,
+    as made when cloning a soap client, share the same session.
+
+    Without an explicit session, the shared session is looked up on each
+    request rather than kept, so a transport created before a fork, such as
+    in the master process of gunicorn, uses the session of the child and
+    never the pooled connections of its parent.
+
+    Args:
+        session (requests.Session, optional): Defaults to the shared session.
+    """
+
+    def __init__(self, session=None):
+        Transport.__init__(self)
+        self._session = session
+
+    @property
+    def session(self):
+        """The requests session of the requests."""
+        if self._session is not None:
+            return self._session
+        return get_session()
+
+    def open(self, request):
+        """Fetch a document, such as the WSDL."""
+        if not request.url.startswith(('http://', 'https://')):
+            return urlopen(request.url)
+        response = self.session.get(request.url, headers=request.headers,
+                                    timeout=get_timeout())
+        self._check(response)
+        return io.BytesIO(response.content)
+
+    def send(self, request):
+        """Send a SOAP message."""
+        response = self.session.post(request.url, data=request.message,
+                                     headers=request.headers,
+                                     timeout=get_timeout())
+        self._check(response)
+        return Reply(response.status_code, response.headers, response.content)
+
+    @staticmethod
+    def _check(response):
+        """Raise a TransportError on HTTP errors, like suds' transports."""
+        if response.status_code >= 400:
+            raise TransportError(response.reason, response.status_code,
+                                 io.BytesIO(response.content))
+
+    def __deepcopy__(self, memo):
+        return self.__class__(self._session)
+
+
+class TimingPlugin(MessagePlugin):
+    """suds plugin marking when a message is sent and its reply received.
+
+    The marks split the timing of a suds call into its marshal, network and
+    parse phases, see metrics.time_soap_call.
+    """
+
+    def sending(self, context):
+        """Mark the end of the marshalling."""
+        metrics.mark_sending()
+
+    def received(self, context):
+        """Mark the end of the network round trip."""
+        metrics.mark_received()
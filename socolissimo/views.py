@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""Views of the SoColissimo application."""
+from django.http import HttpResponse
+
+from socolissimo import metrics
+
+
+# Content type of the Prometheus text exposition format.
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def prometheus_metrics(request):  # pylint: disable=W0613
+    """Export the metrics aggregated in metrics.HISTOGRAM for Prometheus.
+
+    The histogram sink must be enabled with metrics.enable_histogram().
+    """
+    return HttpResponse(metrics.HISTOGRAM.render_prometheus(),
+                        content_type=PROMETHEUS_CONTENT_TYPE)
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+from urllib.request import pathname2url
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -8,7 +11,13 @@ DATABASES = {
 
 INSTALLED_APPS = (
     'socolissimo',
+    'socolissimo.jobs',
 )
 
 
 SECRET_KEY = 'abcde12345'
+
+# Build the soap client from the stand-in WSDL, so tests run offline.
+SOCOLISSIMO_WSDL_URL = 'file:{}'.format(pathname2url(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'socolissimo', 'testdata',
+    'WSColiPosteLetterService.wsdl')))